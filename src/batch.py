@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""batch: archives several projects into HPC DME with one shared worker pool
+About:
+      This program archives a list of finished projects in a single run, instead
+    of one pyrkit invocation, SLURM job and thread pool per project. Each line of
+    the project list holds the input directory, the project request template,
+    the MultiQC directory and optionally the project ID of one project, separated
+    by tabs or spaces. Lines starting with '#' are ignored.
+      First, pyrkit is run in --dry-run mode for each project, --prepare-jobs at a
+    time, to lint its request template, aggregate its QC table and generate the
+    metadata of its upload hierarchy in '<input_directory>/DME/upload'. The output
+    of pyrkit is kept in '<input_directory>/DME/prepare.log'. A project that fails
+    to prepare is reported and left out of the upload.
+      Then the data objects of every project are uploaded together by a single
+    pool of --threads concurrent requests. The pool is size-aware: the largest
+    files of all projects go first, interleaved with small ones (see
+    scheduler.py), so one project with large BAM files does not finish long after
+    the others. Each project keeps its own upload journal, so the batch can be
+    run again after an interruption and a project can still be resumed on its own
+    with upload.py. Progress is printed per project every --progress seconds.
+USAGE:
+	$ batch.py <projects> <dme_vault> --dme-repo <path> [OPTIONS]
+Example:
+    $ batch.py projects.tsv /CCBR_Archive --dme-repo ~/DME/HPC_DME_APIs/ --threads 16
+"""
+
+from __future__ import print_function
+import sys, os, resource, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Local imports
+import dme_utils as dme
+from journal import Journal
+from scheduler import Scheduler
+from retry import Retry, CircuitBreaker
+from history import History
+from upload import Uploader, manifest, pending, summarize, transient
+
+
+def err(*message, **kwargs):
+    """Prints any provided args to standard error.
+    kwargs can be provided to modify print functions
+    behavior.
+    @param message <any>:
+        Values printed to standard error
+    @params kwargs <print()>
+        Key words to modify print function behavior
+    """
+    print(*message, file=sys.stderr, **kwargs)
+
+
+def projects(filename):
+    """Reads the list of projects to archive.
+    @param filename <str>:
+        One project per line: input directory, request template, MultiQC
+        directory and an optional project ID
+    @return projects <list[dict]>:
+        Each project has the keys name, input, template, multiqc and project_id
+    """
+    found, names = [], set()
+    with open(filename, 'r') as fh:
+        for number, line in enumerate(fh, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) not in (3, 4):
+                raise ValueError('{}:{}: expected 3 or 4 fields, found {}'.format(filename, number, len(fields)))
+            name = os.path.basename(os.path.abspath(fields[0]))
+            if name in names:
+                name = os.path.abspath(fields[0])
+            names.add(name)
+            found.append({
+                'name': name,
+                'input': os.path.abspath(fields[0]),
+                'template': os.path.abspath(fields[1]),
+                'multiqc': os.path.abspath(fields[2]),
+                'project_id': fields[3] if len(fields) == 4 else ''
+            })
+
+    return found
+
+
+def prepare(project, pyrkit, vault, dme_repo):
+    """Runs pyrkit in --dry-run mode to lint, aggregate QC and generate the upload
+    hierarchy of a project.
+    @param project <dict>:
+        Project listed by projects()
+    @return succeeded <bool>:
+        True when pyrkit exited without errors
+    """
+    command = [pyrkit, '-i', project['input'], '-o', vault, '-r', project['template'],
+               '-m', project['multiqc'], '-d', dme_repo, '--dry-run', '--native-upload']
+    if project['project_id']:
+        command += ['-p', project['project_id']]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = process.communicate()
+    directory = os.path.join(project['input'], 'DME')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, 'prepare.log'), 'wb') as fh:
+        fh.write(output)
+
+    return process.returncode == 0
+
+
+def gather(projects, vault):
+    """Lists the entries of every project for a single upload. A collection shared
+    by several projects (i.e. the PI_Lab collection) is only listed once.
+    @param projects <list[dict]>:
+        Prepared projects, see projects()
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @return entries <list[dict]>:
+        Collections and data objects listed by manifest(), with a project key
+    """
+    entries, seen = [], set()
+    for project in projects:
+        for entry in manifest(os.path.join(project['input'], 'DME', 'upload'), vault):
+            if entry['path'] in seen:
+                continue
+            seen.add(entry['path'])
+            entry['project'] = project['name']
+            entries.append(entry)
+
+    return entries
+
+
+def progress(uploader, totals):
+    """Returns the progress of each project of a batch upload.
+    @param uploader <Uploader>:
+        Uploader of the batch
+    @param totals <dict>:
+        [key] = project, [value] = bytes left to upload when the batch started
+    @return lines <list[str]>:
+        One line per project
+    """
+    lines = []
+    stats = uploader.snapshot()['project_stats']
+    for name in sorted(totals):
+        values = stats.get(name, {})
+        done = values.get('bytes', 0)
+        percent = 100.0 * done / totals[name] if totals[name] else 100.0
+        lines.append('{}: {:.2f}/{:.2f} GB ({:.1f}%), {} data objects, {} failed'.format(
+            name, done / 1024.0**3, totals[name] / 1024.0**3, min(percent, 100.0),
+            values.get('dataObjects', 0), values.get('failed', 0)))
+
+    return lines
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'batch: \
+                                                    archives several projects into HPC DME with one shared worker pool.')
+    parser.add_argument('projects',
+                        type = str,
+                        help = 'Required: List of projects to archive, one per line: input directory, \
+                                request template, MultiQC directory and an optional project ID. \
+                                Example: projects.tsv')
+    parser.add_argument('vault',
+                        type = str,
+                        help = 'Required: DME vault to push data. \
+                                Example: /CCBR_Archive')
+    parser.add_argument('-d', '--dme-repo',
+                        type = str,
+                        default = '',
+                        help = 'Required unless --skip-prepare: Path to a HPC DME toolkit install, \
+                                passed to pyrkit. Example: ~/DME/HPC_DME_APIs/')
+    parser.add_argument('--prepare-jobs',
+                        type = int,
+                        default = 4,
+                        help = 'Optional: Number of projects prepared by pyrkit at the same time. \
+                                Default: 4')
+    parser.add_argument('--skip-prepare',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Do not run pyrkit, upload the hierarchies that were \
+                                already generated in <input_directory>/DME/upload.')
+    parser.add_argument('-t', '--threads',
+                        type = int,
+                        default = 16,
+                        help = 'Optional: Number of concurrent requests shared by all projects. \
+                                Default: 16')
+    parser.add_argument('--multipart-threshold',
+                        type = float,
+                        default = 5,
+                        help = 'Optional: Files of at least this many GB are uploaded in parts. \
+                                Default: 5')
+    parser.add_argument('--part-size',
+                        type = int,
+                        default = 512,
+                        help = 'Optional: Size of each part of a multipart upload in MB. Default: 512')
+    parser.add_argument('--part-threads',
+                        type = int,
+                        default = 4,
+                        help = 'Optional: Number of parts of a single file uploaded at the same \
+                                time. Default: 4')
+    parser.add_argument('--retries',
+                        type = int,
+                        default = 5,
+                        help = 'Optional: Maximum number of attempts of a request that fails with \
+                                a transient error. Default: 5')
+    parser.add_argument('--progress',
+                        type = float,
+                        default = 60,
+                        help = 'Optional: Seconds between two progress reports. Default: 60')
+    parser.add_argument('--history',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Upload history used to order the uploads and record \
+                                their throughput. Default: ~/.pyrkit/history.jsonl')
+    parser.add_argument('-n', '--dry-run',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Prepare the projects and plan the upload, do not upload.')
+    # Overrides for the DME server
+    parser.add_argument('--dme-url',
+                        type = str,
+                        default = '',
+                        help = 'Optional: URL of the DME server, overrides the URL in \
+                                $HPC_DM_UTILS/hpcdme.properties.')
+    parser.add_argument('--dme-token',
+                        type = str,
+                        default = '',
+                        help = 'Optional: DME token, overrides the token in \
+                                $HPC_DM_UTILS/tokens/curl-conf.')
+
+    args = parser.parse_args()
+    if not args.skip_prepare and not args.dme_repo:
+        parser.error('--dme-repo is required unless --skip-prepare is provided')
+    return args
+
+
+def main():
+
+    # Collect args
+    args = parsed_arguments()
+
+    vault = '/' + args.vault.strip('/')
+    try:
+        batch = projects(args.projects)
+    except (IOError, ValueError) as e:
+        err('Error: {}'.format(e))
+        sys.exit(1)
+
+    failed = []
+    if not args.skip_prepare:
+        pyrkit = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pyrkit')
+        print('Preparing {} projects, {} at a time'.format(len(batch), args.prepare_jobs))
+        with ThreadPoolExecutor(max_workers=max(args.prepare_jobs, 1)) as pool:
+            outcomes = pool.map(lambda p: prepare(p, pyrkit, vault, args.dme_repo), batch)
+            for project, succeeded in zip(batch, outcomes):
+                print('Prepared {}: {}'.format(project['name'], 'ok' if succeeded else
+                      'failed, see {}'.format(os.path.join(project['input'], 'DME', 'prepare.log'))))
+                if not succeeded:
+                    failed.append(project)
+    for project in batch:
+        if project not in failed and not os.path.isdir(os.path.join(project['input'], 'DME', 'upload')):
+            err('Error: {} has no upload hierarchy, skipping it'.format(project['name']))
+            failed.append(project)
+    batch = [p for p in batch if p not in failed]
+
+    journals = dict((p['name'], Journal(os.path.join(p['input'], 'DME', 'upload.journal'))) for p in batch)
+    entries = gather(batch, vault)
+    totals = dict((p['name'], 0) for p in batch)
+    remaining = [e for e in entries if e['type'] == 'dataObject']
+    remaining = [e for e in remaining if pending([e], journals[e['project']])]
+    for entry in remaining:
+        totals[entry['project']] += entry['size']
+
+    history = History(args.history or None)
+    multipart_threshold = int(args.multipart_threshold * 1024**3)
+    scheduler = Scheduler(args.threads, throughput=history.throughput(default=52428800.0),
+                          multipart_threshold=multipart_threshold, part_threads=args.part_threads)
+    print(scheduler.report(scheduler.order(remaining)))
+    for name in sorted(totals):
+        print('{}: {:.2f} GB to upload'.format(name, totals[name] / 1024.0**3))
+    if args.dry_run:
+        return
+
+    session = dme.DMESession(args.dme_url, args.dme_token, pool_size=args.threads * args.part_threads)
+    retry = Retry(attempts=args.retries, breaker=CircuitBreaker(), transient=transient)
+    uploader = Uploader(session, threads=args.threads, journals=journals, scheduler=scheduler, retry=retry,
+                        multipart_threshold=multipart_threshold, part_size=args.part_size * 1024**2,
+                        part_threads=args.part_threads)
+
+    done = threading.Event()
+    def report():
+        while not done.wait(args.progress):
+            print('\n'.join(['Progress:'] + progress(uploader, totals)))
+    reporter = threading.Thread(target=report)
+    reporter.daemon = True
+    reporter.start()
+    try:
+        stats = uploader.run(entries)
+    finally:
+        done.set()
+
+    print(summarize(stats))
+    for name in sorted(uploader.project_stats):
+        print('{}: {}'.format(name, summarize(uploader.project_stats[name])))
+    try:
+        history.record(stats, args.threads, vault=vault, projects=len(batch),
+                       maxrss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1))
+    except (IOError, OSError) as e:
+        err('Warning: failed to record the upload in {}: {}'.format(history.filename, e))
+
+    for project in failed:
+        err('Error: {} was not archived'.format(project['name']))
+    if failed or uploader.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""budget: time left before a SLURM upload job hits its time limit
+About:
+      An upload job that is killed at its time limit leaves transfers half done.
+    The time budget knows when the job ends, from $SLURM_JOB_END_TIME or from
+    squeue, so the uploader can stop starting data objects that would not finish
+    in time, let the transfers in flight complete, and exit with EXIT_REQUEUE.
+    submit.sh then submits the job again for what is left, which is found from
+    the upload journal.
+"""
+
+from __future__ import print_function
+import os, time, subprocess
+from datetime import datetime
+
+# Exit code of an upload that stopped early and should be submitted again
+EXIT_REQUEUE = 3
+
+
+def job_end_time():
+    """Returns when the current SLURM job reaches its time limit.
+    @return end_time <float>:
+        End time in seconds since the epoch, None outside of a SLURM job or
+        when the job has no time limit
+    """
+    end = os.environ.get('SLURM_JOB_END_TIME')
+    if end and end.isdigit():
+        return float(end)
+    job = os.environ.get('SLURM_JOB_ID')
+    if not job:
+        return None
+    try:
+        output = subprocess.check_output(['squeue', '-h', '-j', job, '-o', '%e'],
+                                         stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+        return time.mktime(datetime.strptime(output, '%Y-%m-%dT%H:%M:%S').timetuple())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+class TimeBudget(object):
+    """Decides if an upload still fits before the deadline of the job.
+    @param deadline <float>:
+        Time the job is killed, in seconds since the epoch
+    @param reserve <float>:
+        Seconds kept free at the end of the job to drain and save progress
+    @param safety <float>:
+        Factor applied to the predicted duration of each upload
+    """
+    def __init__(self, deadline, reserve=600.0, safety=2.0):
+        self.deadline = float(deadline)
+        self.reserve = float(reserve)
+        self.safety = float(safety)
+
+    def remaining(self):
+        """Returns the seconds left before the reserve at the end of the job."""
+        return self.deadline - self.reserve - time.time()
+
+    def allows(self, seconds):
+        """Checks if an upload predicted to take this long can still start.
+        @param seconds <float>:
+            Predicted duration of the upload in seconds
+        @return fits <bool>:
+            True when the upload should finish before the reserve
+        """
+        return seconds * self.safety <= self.remaining()
+
+    def __str__(self):
+        return 'job ends at {}, {:.0f} seconds left before the {:.0f} second reserve'.format(
+            datetime.fromtimestamp(self.deadline).strftime('%Y-%m-%d %H:%M:%S'),
+            max(self.remaining(), 0), self.reserve)
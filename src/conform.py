@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""conform: checks the metadata of an upload hierarchy before anything is sent
+About:
+      This program loads the metadata of every collection and data object of
+    '<dme_base_directory>/upload', as generated by initialize.py and meta, and
+    checks all of it against the rules of the DME vault at once: the attributes
+    each collection_type and every data object require, the controlled
+    vocabularies of attributes such as phi_content and data_compression_status,
+    and the naming of the collections and data objects. Every violation is
+    reported together, so a missing attribute or a bad value is found in a
+    fraction of a second instead of after hours of data transfer.
+      The rules are applied one at a time to all records of the same kind, and
+    the vault-specific rules (i.e. the fields the DTB vault requires on Project
+    collections) are merged over the common ones.
+USAGE:
+	$ conform.py <dme_base_directory> <dme_vault> [OPTIONS]
+Example:
+    $ conform.py /scratch/ccbr123/RNA_hg38/DME /CCBR_Archive
+"""
+
+from __future__ import print_function
+import sys, os, re, json
+
+# Attributes required on every record of a kind, [key] = collection_type or
+# 'dataObject', vault-specific requirements are added to the common ones
+REQUIRED = {
+    'common': {
+        'PI_Lab': ['collection_type', 'pi_name', 'data_owner', 'affiliation'],
+        'Project': ['collection_type', 'project_title', 'project_description', 'project_start_date',
+                    'contact_name', 'poc_email', 'origin', 'method', 'organism'],
+        'Sample': ['collection_type', 'sample_name'],
+        'Analysis': ['collection_type', 'number_of_cases', 'method', 'assembly_name', 'gtf_ver',
+                     'md5_all_inputs_serial'],
+        'dataObject': ['object_name', 'file_type', 'md5_checksum', 'phi_content', 'pii_content',
+                       'data_encryption_status', 'data_compression_status', 'analysis_team']
+    },
+    'CCR_DTB_Archive': {
+        'Project': ['project_id', 'project_scientist', 'project_completed_date']
+    }
+}
+
+# Controlled vocabularies of DME attributes
+VOCABULARIES = {
+    'phi_content': ['PHI Present', 'PHI Not Present', 'Unspecified'],
+    'data_compression_status': ['Compressed', 'Not Compressed']
+}
+
+# Name of a collection for each collection_type, and the level it lives at below the vault
+NAMING = {
+    'PI_Lab': (r'PI_Lab_\S+', 1),
+    'Project': (r'Project_\S+', 2),
+    'Sample': (r'Sample_\S+', 3),
+    'Analysis': (r'Primary_Analysis_\S+', 3)
+}
+
+# Characters allowed in the name of a collection or data object
+VALID_NAME = re.compile(r'^[A-Za-z0-9._+-]+$')
+
+
+def err(*message, **kwargs):
+    """Prints any provided args to standard error.
+    kwargs can be provided to modify print functions
+    behavior.
+    @param message <any>:
+        Values printed to standard error
+    @params kwargs <print()>
+        Key words to modify print function behavior
+    """
+    print(*message, file=sys.stderr, **kwargs)
+
+
+def rules(vault):
+    """Returns the required attributes of each kind of record in a vault.
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @return required <dict>:
+        [key] = collection_type or 'dataObject', [value] = required attributes
+    """
+    required = dict((kind, list(attributes)) for kind, attributes in REQUIRED['common'].items())
+    for kind, attributes in REQUIRED.get(vault.strip('/'), {}).items():
+        required[kind] = required.get(kind, []) + [a for a in attributes if a not in required.get(kind, [])]
+    return required
+
+
+def load(upload_directory, vault):
+    """Loads the metadata of every collection and data object in a single pass.
+    @param upload_directory <str>:
+        Local mock DME hierarchy (i.e. DME/upload)
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @return records <list[dict]>:
+        Each record has the keys type, path, name, depth, values (the metadata
+        as [attribute] = value, None when it could not be read) and error
+    """
+    records = []
+    stack = [(os.path.abspath(upload_directory), '/' + vault.strip('/'), 0)]
+    while stack:
+        local, remote, depth = stack.pop()
+        for entry in os.scandir(local):
+            if entry.name.endswith('.metadata.json'):
+                continue
+            kind = 'collection' if entry.is_dir() else 'dataObject'
+            record = {'type': kind, 'path': '{}/{}'.format(remote, entry.name), 'name': entry.name,
+                      'depth': depth + 1, 'values': None, 'error': None}
+            metadata = os.path.join(local, entry.name + '.metadata.json')
+            try:
+                with open(metadata, 'r') as fh:
+                    pairs = json.load(fh)['metadataEntries']
+                record['values'] = dict((p['attribute'], p['value']) for p in pairs)
+            except (IOError, OSError):
+                record['error'] = 'missing metadata file {}'.format(metadata)
+            except (ValueError, KeyError, TypeError) as e:
+                record['error'] = 'unreadable metadata file {}: {}'.format(metadata, e)
+            records.append(record)
+            if kind == 'collection':
+                stack.append((entry.path, record['path'], depth + 1))
+
+    records.sort(key=lambda r: r['path'])
+    return records
+
+
+def check(records, vault):
+    """Checks records against the rules of a vault.
+    @param records <list[dict]>:
+        Collections and data objects returned by load()
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @return violations <list[tuple]>:
+        (DME path, rule, detail) of each violation
+    """
+    violations = []
+    readable = []
+    for record in records:
+        if record['error']:
+            violations.append((record['path'], 'metadata', record['error']))
+        else:
+            readable.append(record)
+
+    # Group records by the kind of rules that apply to them
+    kinds = {}
+    for record in readable:
+        kind = 'dataObject' if record['type'] == 'dataObject' else record['values'].get('collection_type')
+        kinds.setdefault(kind, []).append(record)
+    for record in kinds.pop(None, []):
+        violations.append((record['path'], 'required', 'collection has no collection_type'))
+
+    required = rules(vault)
+    for kind, group in sorted(kinds.items()):
+        if kind not in required:
+            violations.extend((r['path'], 'collection_type', 'unknown collection_type {!r}'.format(kind))
+                              for r in group)
+            continue
+        for attribute in required[kind]:
+            violations.extend((r['path'], 'required', 'missing {} required on {}'.format(attribute, kind))
+                              for r in group if not str(r['values'].get(attribute, '')).strip())
+        if kind in NAMING:
+            pattern, depth = NAMING[kind]
+            regex = re.compile('^{}$'.format(pattern))
+            violations.extend((r['path'], 'naming', '{} collection must be named {}'.format(kind, pattern))
+                              for r in group if not regex.match(r['name']))
+            violations.extend((r['path'], 'naming', '{} collection must be {} level(s) below the vault'.format(
+                               kind, depth)) for r in group if r['depth'] != depth)
+
+    for attribute, allowed in sorted(VOCABULARIES.items()):
+        violations.extend((r['path'], 'vocabulary', '{}={!r} is not one of {}'.format(
+                           attribute, r['values'][attribute], ', '.join(allowed)))
+                          for r in readable if attribute in r['values'] and r['values'][attribute] not in allowed)
+
+    violations.extend((r['path'], 'naming', 'name may only contain letters, digits and . _ + -')
+                      for r in records if not VALID_NAME.match(r['name']))
+    violations.extend((r['path'], 'naming', 'object_name {} does not match the DME path'.format(
+                       r['values']['object_name']))
+                      for r in kinds.get('dataObject', [])
+                      if r['values'].get('object_name') and r['values']['object_name'] != r['path'])
+
+    violations.sort(key=lambda v: (v[0], v[1]))
+    return violations
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'conform: \
+                                                    checks the metadata of an upload hierarchy before anything is sent.')
+    parser.add_argument('directory',
+                        type = str,
+                        help = 'Required: DME base directory for all intermediate output files. \
+                                It must contain the upload/ hierarchy created by pyrkit. \
+                                Example: /scratch/ccbr123/RNA_hg38/DME')
+    parser.add_argument('vault',
+                        type = str,
+                        help = 'Required: DME vault to push data, selects the rules to check. \
+                                Example: /CCBR_Archive')
+    parser.add_argument('--json',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Print the violations as JSON.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    # Collect args
+    args = parsed_arguments()
+
+    upload_directory = os.path.join(args.directory, 'upload')
+    if not os.path.isdir(upload_directory):
+        err('Error: {} does not exist!'.format(upload_directory))
+        sys.exit(1)
+
+    records = load(upload_directory, args.vault)
+    violations = check(records, args.vault)
+    if args.json:
+        print(json.dumps([{'path': p, 'rule': r, 'detail': d} for p, r, d in violations], indent=2))
+    else:
+        for path, rule, detail in violations:
+            err('{}: {}: {}'.format(rule, path, detail))
+        print('Checked {} collections and {} data objects against the rules of /{}: {} violation(s)'.format(
+            sum(r['type'] == 'collection' for r in records), sum(r['type'] == 'dataObject' for r in records),
+            args.vault.strip('/'), len(violations)))
+
+    if violations:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""dedup: content-addressed index of the data objects stored in a DME vault
+About:
+      The same raw FastQ files are often archived under several analyses, or
+    again under a new Project when a collaborator resends the same samples. The
+    index maps the md5_checksum and size of every data object in a vault to the
+    path of its canonical copy. When a file to upload is already in the index,
+    upload.py registers a reference data object instead: a link to the canonical
+    path, whose metadata records that path in the 'canonical_path' attribute,
+    so the bytes are not transferred again.
+      The index is an append-only JSON lines file, locked like the upload
+    journal, that can be shared by every project archived into the same vault.
+    It is only a cache: rebuild() recreates it from a metadata query of every
+    data object in the vault that has an md5_checksum.
+"""
+
+from __future__ import print_function
+import os, json, threading
+
+# Local imports
+from journal import read_records, append_records
+
+
+def content_checksum(metadata):
+    """Returns the md5_checksum attribute generated by meta for a data object.
+    @param metadata <dict>:
+        Metadata of the data object, i.e. {"metadataEntries": [...]}
+    @return checksum <str>:
+        MD5 of the contents of the file, or None when it is not in the metadata
+    """
+    for pair in metadata['metadataEntries']:
+        if pair['attribute'] == 'md5_checksum':
+            return pair['value']
+    return None
+
+
+class DedupIndex(object):
+    """Maps (checksum, size) of the data objects in a vault to a canonical DME path.
+    @param filename <str>:
+        Path to the index file, it is created on the first append
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def key(checksum, size):
+        return '{}:{}'.format(checksum, int(size))
+
+    def load(self):
+        """Reads every complete record in the index. When the same contents were
+        recorded more than once, the first path is kept as the canonical copy.
+        @return entries <dict>:
+            Index records where [key] = checksum:size and [value] = DME path
+        """
+        for record in read_records(self.filename):
+            key = self.key(record['checksum'], record['size'])
+            if record.get('removed'):
+                self.entries.pop(key, None)
+            else:
+                self.entries.setdefault(key, record['path'])
+
+        return self.entries
+
+    def lookup(self, checksum, size):
+        """Finds the canonical copy of a file.
+        @param checksum <str>:
+            MD5 of the contents of the file
+        @param size <int>:
+            Size of the file in bytes
+        @return path <str>:
+            DME path of the canonical copy, or None when the contents are new
+        """
+        if not checksum:
+            return None
+        return self.entries.get(self.key(checksum, size))
+
+    def add(self, checksum, size, path):
+        """Records the canonical copy of newly uploaded contents.
+        @param checksum <str>:
+            MD5 of the contents of the data object
+        @param size <int>:
+            Size of the data object in bytes
+        @param path <str>:
+            DME path of the data object
+        """
+        if not checksum:
+            return
+        key = self.key(checksum, size)
+        with self._lock:
+            if key in self.entries:
+                return
+            append_records(self.filename, [{'checksum': checksum, 'size': int(size), 'path': path}])
+            self.entries[key] = path
+
+    def discard(self, checksum, size):
+        """Forgets a canonical copy that no longer exists in DME."""
+        key = self.key(checksum, size)
+        with self._lock:
+            path = self.entries.pop(key, None)
+            if path is not None:
+                append_records(self.filename, [{'checksum': checksum, 'size': int(size), 'path': path,
+                                               'removed': True}])
+
+    def rebuild(self, session, vault, page_size=1000):
+        """Recreates the index from the metadata of every data object in a vault
+        that has an md5_checksum. Reference data objects point at their
+        canonical path, so they resolve to the same copy.
+        @param session <DMESession>:
+            Session used to query DME
+        @param vault <str>:
+            DME vault or collection to index (i.e. /CCBR_Archive)
+        @param page_size <int>:
+            Number of data objects returned by each query
+        @return entries <dict>:
+            Index records where [key] = checksum:size and [value] = DME path
+        """
+        query = {'operator': 'AND', 'queries': [{'attribute': 'md5_checksum', 'operator': 'LIKE', 'value': '%'}]}
+        entries = {}
+        for page in session.query_metadata('/' + vault.strip('/'), dataobject_query=query, system=True,
+                                           kinds=('dataObject',), page_size=page_size):
+            for path, values in page.items():
+                if 'source_file_size' not in values:
+                    continue
+                path = values.get('canonical_path', path)
+                entries.setdefault(self.key(values['md5_checksum'], values['source_file_size']), path)
+
+        with self._lock:
+            tmp = '{}.tmp'.format(self.filename)
+            with open(tmp, 'w') as fh:
+                for key in sorted(entries):
+                    checksum, size = key.rsplit(':', 1)
+                    fh.write(json.dumps({'checksum': checksum, 'size': int(size), 'path': entries[key]}, sort_keys=True) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(tmp, self.filename)
+            self.entries = entries
+
+        return self.entries
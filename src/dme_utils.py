@@ -1,15 +1,387 @@
 import json
+import asyncio
 import os
 import logging
 import sys
+import time
+import uuid
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
+from retry import decorrelated_jitter
 
-class DMESession():
+
+class DMEError(Exception):
+    """
+    Raised when a DME request does not return a successful response code
+    """
+
+    def __init__(self, status_code, message, path=''):
+        """
+        Constructor
+        Parameters
+        ----------
+        status_code : int
+            HTTP response code returned by DME
+        message : string
+            Response message returned by DME
+        path : string
+            The DME path of the failed request
+        """
+        self.status_code = status_code
+        self.message = message
+        self.path = path
+        super(DMEError, self).__init__("Response code: {0}, Response message: {1}".format(status_code, message))
+
+
+class MultipartStream():
+    """
+    A file-like multipart/form-data request body. The data object is read from
+    disk in blocks as the body is sent, so large files are never held in memory.
+    """
+
+    def __init__(self, fields, filename, file_field='dataObject', blocksize=1048576, limiter=None, fileobj=None):
+        """
+        Constructor
+        Parameters
+        ----------
+        fields : list(<tuple>)
+            List of (name, content type, bytes) parts sent before the file
+        filename : string
+            Local file to stream as the last part of the body
+        file_field : string
+            Name of the form field holding the file contents
+        blocksize : int
+            Number of bytes read from the file at a time
+        limiter : object
+            Optional bandwidth limiter, its consume(nbytes) method is called
+            before returning each block (see throttle.RateLimiter)
+        fileobj : object
+            Optional reader of the file contents (i.e. a TeeReader), used
+            instead of opening filename
+        """
+        self.limiter = limiter
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={0}'.format(self.boundary)
+        self.blocksize = blocksize
+        self._parts = []
+        for name, content_type, body in fields:
+            header = self._header(name, content_type)
+            self._parts.append(header + body + b'\r\n')
+        self._parts.append(self._header(file_field, 'application/octet-stream', os.path.basename(filename)))
+        self._parts.append(fileobj if fileobj is not None else open(filename, 'rb'))
+        self._parts.append('\r\n--{0}--\r\n'.format(self.boundary).encode())
+        self._length = sum(len(p) for p in self._parts if isinstance(p, bytes)) + os.path.getsize(filename)
+
+    def _header(self, name, content_type, filename=''):
+        disposition = 'form-data; name="{0}"'.format(name)
+        if filename:
+            disposition += '; filename="{0}"'.format(filename)
+        return '--{0}\r\nContent-Disposition: {1}\r\nContent-Type: {2}\r\n\r\n'.format(
+            self.boundary, disposition, content_type).encode()
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        """
+            Returns up to size bytes of the request body
+        """
+        if size is None or size < 0:
+            size = self.blocksize
+        chunk = b''
+        while self._parts and len(chunk) < size:
+            part = self._parts[0]
+            if isinstance(part, bytes):
+                wanted = size - len(chunk)
+                chunk += part[:wanted]
+                if len(part) > wanted:
+                    self._parts[0] = part[wanted:]
+                else:
+                    self._parts.pop(0)
+            else:
+                buf = part.read(size - len(chunk))
+                if buf:
+                    chunk += buf
+                else:
+                    part.close()
+                    self._parts.pop(0)
+        if self.limiter is not None and chunk:
+            self.limiter.consume(len(chunk))
+        return chunk
+
+    def close(self):
+        for part in self._parts:
+            if not isinstance(part, bytes):
+                part.close()
+        self._parts = []
+
+
+class FilePart():
+    """
+    A file-like view of a byte range of a local file, used to stream one part
+    of a multipart upload without reading the whole part into memory.
+    """
+
+    def __init__(self, filename, offset, length, blocksize=1048576, limiter=None):
+        """
+        Constructor
+        Parameters
+        ----------
+        filename : string
+            Local file to read the part from
+        offset : int
+            Position of the first byte of the part
+        length : int
+            Number of bytes in the part
+        blocksize : int
+            Number of bytes read from the file at a time
+        limiter : object
+            Optional bandwidth limiter, see MultipartStream
+        """
+        self.limiter = limiter
+        self.blocksize = blocksize
+        self._length = length
+        self._left = length
+        self._fh = open(filename, 'rb')
+        self._fh.seek(offset)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        """
+            Returns up to size bytes of the part
+        """
+        if size is None or size < 0:
+            size = self.blocksize
+        buf = self._fh.read(min(size, self._left))
+        self._left -= len(buf)
+        if self.limiter is not None and buf:
+            self.limiter.consume(len(buf))
+        return buf
+
+    def close(self):
+        self._fh.close()
+
+
+class Tee():
+    """
+    Reads a local file once and serves its contents to several readers, so the
+    same data object can be streamed to several vaults in one pass over the disk.
+    Blocks are dropped once every reader has consumed them, and a reader that is
+    more than window blocks ahead of the slowest one waits for it to catch up.
+    Readers that have not started when the window is full are detached instead
+    of waited on, since their request may itself be waiting on a throttle or a
+    circuit breaker, and they read the file on their own once they start.
+    """
+
+    def __init__(self, filename, readers, blocksize=1048576, window=16):
+        """
+        Constructor
+        Parameters
+        ----------
+        filename : string
+            Local file to read
+        readers : int
+            Number of readers of the file
+        blocksize : int
+            Number of bytes read from the file at a time
+        window : int
+            Maximum number of blocks held in memory
+        """
+        self.blocksize = blocksize
+        self.window = window
+        self.filename = filename
+        self._fh = open(filename, 'rb')
+        self._length = os.path.getsize(filename)
+        self._blocks = {}
+        self._first = 0
+        self._read = 0
+        self._eof = False
+        self._positions = dict((i, 0) for i in range(readers))
+        self._detached = set()
+        self._condition = threading.Condition()
+        self.readers = [TeeReader(self, i) for i in range(readers)]
+
+    def _block(self, reader, number):
+        """
+            Returns block number of the file for a reader, reading it from disk
+            when the reader is the first one to ask for it, or None when the
+            reader was detached before it started
+        """
+        with self._condition:
+            if reader in self._detached:
+                return None
+            while number >= self._read and not self._eof and number - self._first >= self.window:
+                idle = [r for r, position in self._positions.items() if position == 0]
+                if idle:
+                    for r in idle:
+                        self._positions.pop(r)
+                        self._detached.add(r)
+                    self._release()
+                    continue
+                self._condition.wait()
+            if number < self._read:
+                buf = self._blocks[number]
+            elif self._eof:
+                buf = b''
+            else:
+                buf = self._fh.read(self.blocksize)
+                if buf:
+                    self._blocks[number] = buf
+                    self._read += 1
+                else:
+                    self._eof = True
+                    self._fh.close()
+            self._positions[reader] = number + 1
+            self._release()
+            return buf
+
+    def _release(self):
+        """
+            Drops the blocks every reader has consumed
+        """
+        oldest = min(self._positions.values()) if self._positions else self._read
+        while self._first < oldest:
+            self._blocks.pop(self._first, None)
+            self._first += 1
+        self._condition.notify_all()
+
+    def detach(self, reader):
+        """
+            Stops waiting on a reader, i.e. when its upload failed
+        """
+        with self._condition:
+            self._positions.pop(reader, None)
+            self._release()
+            if not self._positions and not self._eof:
+                self._eof = True
+                self._fh.close()
+
+
+class TeeReader():
+    """
+    A file-like reader of a Tee, used as the source of one request body
+    """
+
+    def __init__(self, tee, index):
+        self._tee = tee
+        self._index = index
+        self._block = 0
+        self._buffer = b''
+        self._fh = None
+        self.consumed = False
+
+    def __len__(self):
+        return self._tee._length
+
+    def read(self, size=-1):
+        """
+            Returns up to size bytes of the file
+        """
+        if size is None or size < 0:
+            size = self._tee.blocksize
+        self.consumed = True
+        while len(self._buffer) < size:
+            buf = self._tee._block(self._index, self._block)
+            if buf is None:
+                # Detached before it started, read the file on its own
+                if self._fh is None:
+                    self._fh = open(self._tee.filename, 'rb')
+                    self._fh.seek(self._block * self._tee.blocksize)
+                buf = self._fh.read(self._tee.blocksize)
+            if not buf:
+                break
+            self._block += 1
+            self._buffer += buf
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def close(self):
+        self.consumed = True
+        if self._fh is not None:
+            self._fh.close()
+        self._tee.detach(self._index)
+
+
+def http_session(pool_size=16, retries=3, backoff=0.5):
+    """
+    Returns a requests session that keeps its connections alive, so requests
+    to the same host reuse a TCP and TLS connection instead of opening a new
+    one each time. The session is configured once and only read afterwards,
+    so a single session can be shared by every worker thread: its connection
+    pools are thread-safe and hand each thread a connection of its own.
+    Connection errors are retried for every request, since nothing was sent
+    yet. Read errors and throttled or unavailable responses are only retried
+    for GET and HEAD requests, the body of an upload is a stream that cannot
+    be sent twice and is retried by retry.Retry instead.
+    Parameters
+    ----------
+    pool_size : int
+        Number of connections kept alive per host, i.e. the number of threads
+        sending requests at the same time
+    retries : int
+        Number of transport-level retries of a request
+    backoff : float
+        Base of the exponential back-off between retries in seconds
+
+    Returns
+    ----------
+    session : requests.Session
+        Session with pooled keep-alive connections
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry as TransportRetry
+    policy = TransportRetry(total=retries, connect=retries, read=retries, status=retries, other=0,
+                            allowed_methods=frozenset(["GET", "HEAD"]), status_forcelist=(429, 502, 503, 504),
+                            backoff_factor=backoff, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(int(pool_size), 1), max_retries=policy)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.verify = False
+    return session
+
+
+class StorageBackend(ABC):
+    """Operations upload.py needs from the storage it pushes into. Paths are DME
+    paths (i.e. /CCBR_Archive/PI_Lab_X/Project_Y) and metadata is the JSON written
+    by initialize.py and meta, i.e. {"metadataEntries": [...]}. Failed requests
+    raise a DMEError. DMESession implements them for HPC DME, along with
+    references and bulk registration that only DME offers, and storage.S3Session
+    for S3-compatible object stores.
+    """
+    # Optional bandwidth limiter shared by every request (see throttle.py)
+    rate_limiter = None
+
+    @abstractmethod
+    def register_collection(self, collection_path, metadata):
+        """Creates or updates a collection and its metadata."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def register_dataobject(self, data_object_path, source_file, metadata, blocksize=1048576, fileobj=None):
+        """Stores a data object and its metadata in a single request. fileobj is an
+        optional reader of the contents of source_file (see Tee)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def register_dataobject_multipart(self, data_object_path, source_file, metadata, part_size=536870912,
+                                      threads=4, retries=3, blocksize=1048576):
+        """Stores a large data object in parts of part_size bytes, threads at a time."""
+        raise NotImplementedError
+
+
+class DMESession(StorageBackend):
     """
     A utility class to perform Data Management Environment requests
     """
 
-    def __init__(self, dme_url = '', dme_token = ''):
+    def __init__(self, dme_url = '', dme_token = '', pool_size=16, timeout=(10, 300), retries=3):
         """
         Constructor
         Parameters
@@ -18,13 +390,28 @@ class DMESession():
             URL to perform the requests
         dme_token : string
             User token
+        pool_size : int
+            Number of connections to DME kept alive, see http_session()
+        timeout : tuple(<float>)
+            Connect and read timeouts of each request in seconds
+        retries : int
+            Number of transport-level retries of a request, see http_session()
         """
         self.dme_utils = 'HPC_DM_UTILS'
+        self.rate_limiter = None
         self.dme_url = dme_url if dme_url != '' else self.get_dme_url()
         self.dme_token = dme_token if dme_token != '' else self.get_token_from_file()
+        self.timeout = timeout
         import requests
         from requests.packages.urllib3.exceptions import InsecureRequestWarning
         requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+        self.http = http_session(pool_size, retries)
+
+    def close(self):
+        """
+            Closes the connections kept alive by the session
+        """
+        self.http.close()
     
     def get_dme_url(self):
         """
@@ -111,8 +498,7 @@ class DMESession():
         full_path = self.dme_url + "/collection/" + dir_path
         params = {"list":"true"}
         
-        import requests
-        get_response = requests.get(full_path, headers=headers, verify=False, params=params)
+        get_response = self.http.get(full_path, headers=headers, timeout=self.timeout, params=params)
         if get_response.status_code != 200:
             logging.error("Error getting DME directory", dir_path)
             raise Exception("Response code: {0}, Response message: {1}".format(get_response.status_code, get_response.text))
@@ -147,10 +533,9 @@ class DMESession():
         dme_token = self.dme_token
         headers = {}
         headers["Authorization"] = "Bearer {0}".format(dme_token)
-        import requests
         full_path = self.dme_url + "/collection" + collection_path
         
-        get_response = requests.get(full_path, headers=headers, verify=False)
+        get_response = self.http.get(full_path, headers=headers, timeout=self.timeout)
         if get_response.status_code != 200:
             #logging.error("Error accessing collection on DME", collection_path)
             print("Response code: {0}, Response message: {1}".format(get_response.status_code, get_response.text))
@@ -194,9 +579,8 @@ class DMESession():
         dme_token = self.dme_token
         headers = {}
         headers["Authorization"] = "Bearer {0}".format(dme_token)
-        import requests
-        full_path = self.dme_url + "/v2/dataObject/" + data_object_path
-        get_response = requests.get(full_path, headers=headers, verify=False)
+        full_path = self._url("/v2/dataObject", data_object_path)
+        get_response = self.http.get(full_path, headers=headers, timeout=self.timeout)
         if get_response.status_code != 200:
             #logging.error("Error accessing dataObject on DME", collection_path)
             print("Response code: {0}, Response message: {1}".format(get_response.status_code, get_response.text))
@@ -219,3 +603,845 @@ class DMESession():
             self_dic[pair['attribute']] = pair['value']
  
         return self_dic
+
+    def get_remote_checksums(self, data_object_paths, threads=8, page_size=1000):
+        """
+            Fetches the checksums of many data objects at once. The data objects
+            under the deepest collection holding every path of a vault (i.e. the
+            project) are pulled with paged compound queries, see query_metadata().
+            Paths the query did not return are looked up on their own, but only
+            when the listing of their parent collection shows that they exist,
+            so data objects that are not yet in DME cost no request of their own.
+            Parameters
+            ----------
+            data_object_paths : list(<str>)
+                The paths of the data objects on DME
+            threads : int
+                Number of concurrent requests of the lookups
+            page_size : int
+                Number of data objects requested by each query
+
+            Returns
+            ----------
+            checksums : dictionary
+                [key] = data object path, [value] = its md5_checksum attribute,
+                or the checksum computed by DME when the attribute is missing.
+                The value is None when the data object does not exist in DME.
+        """
+        def listing(collection_path):
+            try:
+                return collection_path, set(self.list_collection(collection_path)[1])
+            except DMEError as e:
+                if e.status_code == 404:
+                    return collection_path, set()
+                raise
+
+        def checksum(data_object_path):
+            values = self.get_dataObject_attributes(data_object_path)
+            if values is None:
+                return data_object_path, None
+            return data_object_path, values.get('md5_checksum', values.get('checksum'))
+
+        checksums = dict((path, None) for path in data_object_paths)
+        vaults = {}
+        for path in checksums:
+            vaults.setdefault(path.split('/')[1], []).append(os.path.dirname(path))
+        query = {"operator": "AND", "queries": [{"attribute": "md5_checksum", "operator": "LIKE", "value": "%"}]}
+        for collections in vaults.values():
+            try:
+                for page in self.query_metadata(os.path.commonpath(collections), dataobject_query=query,
+                                                system=True, kinds=("dataObject",), page_size=page_size):
+                    for path, values in page.items():
+                        if path in checksums:
+                            checksums[path] = values.get('md5_checksum', values.get('checksum'))
+            except DMEError as e:
+                if e.status_code != 404:
+                    raise
+                # Nothing was archived under this collection yet
+
+        missing = [path for path, value in checksums.items() if value is None]
+        collections = sorted(set(os.path.dirname(path) for path in missing))
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            existing = set()
+            for collection_path, paths in pool.map(listing, collections):
+                existing.update(paths)
+            for data_object_path, value in pool.map(checksum, [p for p in missing if p in existing]):
+                checksums[data_object_path] = value
+        return checksums
+
+    def query_dataobjects(self, collection_path, compound_query, page=1, page_size=100):
+        """
+            Returns one page of the data objects under a collection that match
+            a compound metadata query
+            Parameters
+            ----------
+            collection_path : string
+                The path of the collection (or vault) on DME to search
+            compound_query : dictionary
+                Compound query, i.e. {"operator": "AND", "queries": [{"attribute":
+                "md5_checksum", "operator": "LIKE", "value": "%"}]}
+            page : int
+                Page of results to return, starting at 1
+            page_size : int
+                Number of data objects per page
+
+            Returns
+            ----------
+            response : dictionary
+                {"dataObjects": [...], "page": page, "limit": page_size, "totalCount": total},
+                where each data object holds its "dataObject" (with its "absolutePath")
+                and its "metadataEntries"
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        body = {"compoundQuery": compound_query, "detailedResponse": True,
+                "page": page, "pageSize": page_size, "totalCount": True}
+        post_response = self.http.post(self._url("/v2/dataObject/query", collection_path), headers=headers,
+                                       json=body, timeout=self.timeout)
+        if post_response.status_code != 200:
+            raise DMEError(post_response.status_code, post_response.text, collection_path)
+        return json.loads(post_response.text)
+
+    def query_collections(self, collection_path, compound_query, page=1, page_size=100):
+        """
+            Returns one page of the collections under a collection that match
+            a compound metadata query
+            Parameters
+            ----------
+            collection_path : string
+                The path of the collection (or vault) on DME to search
+            compound_query : dictionary
+                Compound query, i.e. {"operator": "AND", "queries": [{"attribute":
+                "collection_type", "operator": "EQUAL", "value": "Sample"}]}
+            page : int
+                Page of results to return, starting at 1
+            page_size : int
+                Number of collections per page
+
+            Returns
+            ----------
+            response : dictionary
+                {"collections": [...], "page": page, "limit": page_size, "totalCount": total},
+                where each collection holds its "collection" (with its "absolutePath")
+                and its "metadataEntries"
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        body = {"compoundQuery": compound_query, "detailedResponse": True,
+                "page": page, "pageSize": page_size, "totalCount": True}
+        post_response = self.http.post(self._url("/collection/query", collection_path), headers=headers,
+                                       json=body, timeout=self.timeout)
+        if post_response.status_code != 200:
+            raise DMEError(post_response.status_code, post_response.text, collection_path)
+        return json.loads(post_response.text)
+
+    def query_metadata(self, collection_path, collection_query=None, dataobject_query=None,
+                       in_pairs=True, system=False, kinds=("collection", "dataObject"), page_size=1000):
+        """
+            Yields the metadata of every collection and data object under a
+            collection that match compound metadata queries, one page of
+            results at a time. The collections are returned first, then the
+            data objects. The collection itself is not part of the results.
+            Pages are requested until as many records as the totalCount of
+            the query were received, or until a page comes back empty, so a
+            server that returns fewer records than page_size loses none.
+            Parameters
+            ----------
+            collection_path : string
+                The path of the collection on DME to search
+            collection_query : dictionary
+                Compound query of the collections, by default every collection
+                with a collection_type
+            dataobject_query : dictionary
+                Compound query of the data objects, by default every data object
+                with an object_name
+            in_pairs : boolean
+                Return the metadata as key pairs if True, otherwise return
+                {"metadataEntries": [...]} as it comes from DME, like
+                get_collection_dme_meta() and get_dataObject_dme_meta()
+            system : boolean
+                Include the system metadata of data objects (i.e. checksum and
+                source_file_size) along with their user metadata, like
+                get_dataObject_attributes()
+            kinds : tuple(<str>)
+                Kinds of records to query, "collection" and/or "dataObject"
+            page_size : int
+                Number of records requested by each query
+
+            Yields
+            ----------
+            page : dictionary
+                [key] = DME path, [value] = its metadata
+        """
+        def every(attribute):
+            return {"operator": "AND", "queries": [{"attribute": attribute, "operator": "LIKE", "value": "%"}]}
+
+        def metadata(entries):
+            if not in_pairs:
+                return {"metadataEntries": entries}
+            return dict((pair['attribute'], pair['value']) for pair in entries)
+
+        def dataobject(item):
+            self_metadata = item['metadataEntries']['selfMetadataEntries']
+            entries = self_metadata['userMetadataEntries']
+            if system:
+                entries = self_metadata.get('systemMetadataEntries', []) + entries
+            return item['dataObject']['absolutePath'], entries
+
+        searches = []
+        if "collection" in kinds:
+            searches.append((self.query_collections, collection_query or every("collection_type"), "collections",
+                             lambda item: (item['collection']['absolutePath'],
+                                           item['metadataEntries']['selfMetadataEntries'])))
+        if "dataObject" in kinds:
+            searches.append((self.query_dataobjects, dataobject_query or every("object_name"), "dataObjects",
+                             dataobject))
+        for query, compound_query, key, record in searches:
+            page, received = 1, 0
+            while True:
+                response = query(collection_path, compound_query, page=page, page_size=page_size)
+                items = response[key]
+                if not items:
+                    break
+                received += len(items)
+                yield dict((path, metadata(entries)) for path, entries in map(record, items))
+                if received >= int(response.get('totalCount', 0)):
+                    break
+                page += 1
+
+    def list_collection(self, collection_path):
+        """
+            Lists the sub-collections and data objects directly under a collection
+            Parameters
+            ----------
+            collection_path : string
+                The path of the collection on DME
+
+            Returns
+            ----------
+            collections : list(<str>)
+                Paths of the sub-collections
+            dataObjects : list(<str>)
+                Paths of the data objects
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        get_response = self.http.get(self._url("/collection", collection_path), headers=headers,
+                                     params={"list": "true"}, timeout=self.timeout)
+        if get_response.status_code != 200:
+            raise DMEError(get_response.status_code, get_response.text, collection_path)
+        collection = json.loads(get_response.text)['collections'][0]['collection']
+        return ([c['collectionName'] for c in collection.get('subCollections', [])],
+                [d['path'] for d in collection.get('dataObjects', [])])
+
+    def get_dataObject_attributes(self, data_object_path):
+        """
+            Returns the user and system metadata of a data object as key pairs,
+            i.e. md5_checksum and alias along with source_file_size and checksum
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the data object on DME
+
+            Returns
+            ----------
+            attributes : dictionary
+                [key] = attribute, [value] = its value, user metadata taking
+                precedence, or None when the data object does not exist in DME
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        get_response = self.http.get(self._url("/v2/dataObject", data_object_path), headers=headers, timeout=self.timeout)
+        if get_response.status_code == 404:
+            return None
+        if get_response.status_code != 200:
+            raise DMEError(get_response.status_code, get_response.text, data_object_path)
+        self_metadata = json.loads(get_response.text)['metadataEntries']['selfMetadataEntries'][0]
+        values = {}
+        for pair in self_metadata.get('systemMetadataEntries', []) + self_metadata['userMetadataEntries']:
+            values[pair['attribute']] = pair['value']
+        return values
+
+    def iter_dataobject(self, data_object_path, offset=0, length=None, blocksize=1048576):
+        """
+            Streams the contents of a data object, or a byte range of it,
+            without writing it to disk
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the data object on DME
+            offset : int
+                First byte of the range to download
+            length : int
+                Number of bytes to download, or None for the rest of the object
+            blocksize : int
+                Number of bytes returned at a time
+
+            Returns
+            ----------
+            blocks : generator(<bytes>)
+                Contents of the range, one block at a time
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        ranged = offset > 0 or length is not None
+        if ranged:
+            last = '' if length is None else str(offset + length - 1)
+            headers["Range"] = "bytes={0}-{1}".format(offset, last)
+        get_response = self.http.get(self._url("/v2/dataObject", data_object_path) + "/download",
+                                     headers=headers, stream=True, timeout=self.timeout)
+        try:
+            if get_response.status_code not in (200, 206):
+                raise DMEError(get_response.status_code, get_response.text, data_object_path)
+            # A server that ignores the Range header sends the whole object
+            skip = offset if ranged and get_response.status_code == 200 else 0
+            sent = 0
+            for buf in get_response.iter_content(chunk_size=blocksize):
+                if skip:
+                    dropped = min(skip, len(buf))
+                    buf, skip = buf[dropped:], skip - dropped
+                if length is not None:
+                    buf = buf[:length - sent]
+                if not buf:
+                    continue
+                if self.rate_limiter is not None:
+                    self.rate_limiter.consume(len(buf))
+                sent += len(buf)
+                yield buf
+                if length is not None and sent >= length:
+                    break
+        finally:
+            get_response.close()
+        if length is not None and sent != length:
+            raise IOError("Incomplete download of {0}: {1} of {2} bytes".format(data_object_path, sent, length))
+
+    def download_dataobject(self, data_object_path, destination, offset=0, length=None, blocksize=1048576):
+        """
+            Downloads a data object, or a byte range of it, into an existing local
+            file at the same offset, so several ranges can be fetched concurrently
+            and an interrupted download only fetches what is missing
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the data object on DME
+            destination : string
+                Local file to write to, it must already exist
+            offset : int
+                First byte of the range to download
+            length : int
+                Number of bytes to download, or None for the rest of the object
+            blocksize : int
+                Number of bytes written to the file at a time
+
+            Returns
+            ----------
+            written : int
+                Number of bytes written
+        """
+        written = 0
+        with open(destination, 'r+b') as fh:
+            fh.seek(offset)
+            for buf in self.iter_dataobject(data_object_path, offset, length, blocksize):
+                fh.write(buf)
+                written += len(buf)
+        return written
+
+    def _url(self, endpoint, path):
+        """
+            Returns the request URL of a DME path with the path percent-encoded
+        """
+        return self.dme_url + endpoint + quote('/' + path.lstrip('/'))
+
+    def register_collection(self, collection_path, metadata):
+        """
+            Registers (creates or updates) a collection in DME
+            Parameters
+            ----------
+            collection_path : string
+                The path of the collection on DME
+            metadata : dictionary
+                Collection metadata as written by initialize.py, i.e.
+                {"metadataEntries": [{"attribute": ..., "value": ...}]}
+
+            Returns
+            ----------
+            status_code : int
+                Response code, 201 if created or 200 if updated
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        put_response = self.http.put(self._url("/collection", collection_path), headers=headers, json=metadata, timeout=self.timeout)
+        if put_response.status_code not in (200, 201):
+            raise DMEError(put_response.status_code, put_response.text, collection_path)
+        return put_response.status_code
+
+    def update_collection_metadata(self, collection_path, entries):
+        """
+            Adds or modifies attributes of an existing collection. Attributes
+            that are not listed keep their value in DME.
+            Parameters
+            ----------
+            collection_path : string
+                The path of the collection on DME
+            entries : list(<dict>)
+                Attributes to add or modify, i.e. [{"attribute": ..., "value": ...}]
+
+            Returns
+            ----------
+            status_code : int
+                Response code, 200 if updated
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        put_response = self.http.put(self._url("/collection", collection_path), headers=headers,
+                                     json={"metadataEntries": entries}, timeout=self.timeout)
+        if put_response.status_code not in (200, 201):
+            raise DMEError(put_response.status_code, put_response.text, collection_path)
+        return put_response.status_code
+
+    def update_dataobject_metadata(self, data_object_path, entries):
+        """
+            Adds or modifies attributes of an existing data object, without
+            sending its contents again. Attributes that are not listed keep
+            their value in DME.
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the data object on DME
+            entries : list(<dict>)
+                Attributes to add or modify, i.e. [{"attribute": ..., "value": ...}]
+
+            Returns
+            ----------
+            status_code : int
+                Response code, 200 if updated
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        registration = {"metadataEntries": entries, "createParentCollections": False}
+        put_response = self.http.put(self._url("/v2/dataObject", data_object_path), headers=headers, timeout=self.timeout,
+                                     files={"dataObjectRegistration": (None, json.dumps(registration), "application/json")})
+        if put_response.status_code not in (200, 201):
+            raise DMEError(put_response.status_code, put_response.text, data_object_path)
+        return put_response.status_code
+
+    def register_dataobject(self, data_object_path, source_file, metadata, blocksize=1048576, fileobj=None):
+        """
+            Registers a data object in DME and uploads its contents. The file is
+            streamed from disk as the request body is sent.
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the file on DME
+            source_file : string
+                The path of the file on the local filesystem
+            metadata : dictionary
+                Data object metadata as written by meta, i.e.
+                {"metadataEntries": [{"attribute": ..., "value": ...}]}
+            blocksize : int
+                Number of bytes read from the file at a time
+            fileobj : object
+                Optional reader of the contents of source_file, i.e. one of
+                the readers of a Tee when mirroring into several vaults
+
+            Returns
+            ----------
+            status_code : int
+                Response code, 201 if created or 200 if updated
+        """
+        registration = dict(metadata)
+        registration["createParentCollections"] = False
+        stream = MultipartStream([("dataObjectRegistration", "application/json", json.dumps(registration).encode())],
+                                 source_file, blocksize=blocksize, limiter=self.rate_limiter, fileobj=fileobj)
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        headers["Content-Type"] = stream.content_type
+        try:
+            put_response = self.http.put(self._url("/v2/dataObject", data_object_path), headers=headers, data=stream, timeout=self.timeout)
+        finally:
+            stream.close()
+        if put_response.status_code not in (200, 201):
+            raise DMEError(put_response.status_code, put_response.text, data_object_path)
+        return put_response.status_code
+
+    def register_reference(self, data_object_path, canonical_path, metadata):
+        """
+            Registers a data object that links to a copy of the same contents
+            already stored in DME, so no bytes are transferred. The canonical
+            path is added to its metadata as the 'canonical_path' attribute.
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the new data object on DME
+            canonical_path : string
+                The path of the data object holding the contents
+            metadata : dictionary
+                Data object metadata as written by meta
+
+            Returns
+            ----------
+            status_code : int
+                Response code, 201 if created or 200 if updated
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        entries = [pair for pair in metadata.get("metadataEntries", []) if pair["attribute"] != "canonical_path"]
+        registration = {"metadataEntries": entries + [{"attribute": "canonical_path", "value": canonical_path}],
+                        "linkSourcePath": canonical_path, "createParentCollections": False}
+        put_response = self.http.put(self._url("/v2/dataObject", data_object_path), headers=headers, timeout=self.timeout,
+                                     files={"dataObjectRegistration": (None, json.dumps(registration), "application/json")})
+        if put_response.status_code not in (200, 201):
+            raise DMEError(put_response.status_code, put_response.text, data_object_path)
+        return put_response.status_code
+
+    def register_dataobjects_bulk(self, items, poll_interval=2.0, timeout=3600):
+        """
+            Registers several data objects with a single bulk registration
+            request. DME copies the contents of each file from the file system
+            it shares with the cluster, so the files must be readable by the
+            DME server. The registration runs as a task on the server, whose
+            status is polled until every item completed or failed.
+            Parameters
+            ----------
+            items : list(<tuple>)
+                (data object path on DME, source file, metadata) of each
+                data object, the metadata as written by meta
+            poll_interval : float
+                Seconds between two requests for the status of the task
+            timeout : float
+                Longest time to wait for the task in seconds
+
+            Returns
+            ----------
+            results : dict
+                [key] = data object path, [value] = None when it was
+                registered, or the error DME reported for that item
+        """
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        registration = {"dataObjectRegistrationItems": [{
+            "path": data_object_path,
+            "createParentCollections": False,
+            "dataObjectMetadataEntries": metadata.get("metadataEntries", []),
+            "fileSystemUploadSource": {"sourceLocation": {
+                "fileContainerId": os.path.dirname(os.path.abspath(source_file)),
+                "fileId": os.path.abspath(source_file)}}
+        } for data_object_path, source_file, metadata in items]}
+        put_response = self.http.put(self.dme_url + "/v2/registration", headers=headers, json=registration, timeout=self.timeout)
+        if put_response.status_code not in (200, 201):
+            raise DMEError(put_response.status_code, put_response.text, items[0][0] if items else '')
+        task_id = json.loads(put_response.text)["taskId"]
+
+        deadline = time.time() + timeout
+        while True:
+            get_response = self.http.get(self.dme_url + "/registration/" + quote(task_id), headers=headers, timeout=self.timeout)
+            if get_response.status_code != 200:
+                raise DMEError(get_response.status_code, get_response.text, task_id)
+            status = json.loads(get_response.text)
+            if status.get("completed"):
+                break
+            if time.time() >= deadline:
+                raise DMEError(504, "Bulk registration task {} did not complete in time".format(task_id), task_id)
+            time.sleep(poll_interval)
+
+        # Items the task did not report on are failures, so they are retried on their own
+        results = dict((data_object_path, "Not reported by bulk registration task {}".format(task_id))
+                       for data_object_path, _, _ in items)
+        for item in status.get("completedItems", []):
+            results[item["request"]["path"]] = None
+        for item in status.get("failedItems", []):
+            results[item["request"]["path"]] = item.get("message") or "Bulk registration failed"
+        return results
+
+    def register_dataobject_multipart(self, data_object_path, source_file, metadata, part_size=536870912,
+                                      threads=4, retries=3, blocksize=1048576):
+        """
+            Registers a data object in DME and uploads its contents in parts.
+            DME returns a presigned URL for each part, the parts are uploaded
+            concurrently and each part is retried on its own if it fails. When
+            the vault only offers a single presigned URL, the whole file is
+            streamed to it instead.
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the file on DME
+            source_file : string
+                The path of the file on the local filesystem
+            metadata : dictionary
+                Data object metadata as written by meta, i.e.
+                {"metadataEntries": [{"attribute": ..., "value": ...}]}
+            part_size : int
+                Size of each part in bytes, it is raised if the file would
+                need more than 10000 parts
+            threads : int
+                Number of parts uploaded at the same time
+            retries : int
+                Number of times a failed part is retried
+            blocksize : int
+                Number of bytes read from the file at a time
+
+            Returns
+            ----------
+            status_code : int
+                Response code of the request that completed the upload
+        """
+        size = os.path.getsize(source_file)
+        part_size = max(part_size, -(-size // 10000), 1)
+        nparts = max(-(-size // part_size), 1)
+
+        registration = dict(metadata)
+        registration["createParentCollections"] = False
+        registration["generateUploadRequestURL"] = True
+        registration["uploadParts"] = nparts
+        headers = {}
+        headers["Authorization"] = "Bearer {0}".format(self.dme_token)
+        put_response = self.http.put(self._url("/v2/dataObject", data_object_path), headers=headers, timeout=self.timeout,
+                                     files={"dataObjectRegistration": (None, json.dumps(registration), "application/json")})
+        if put_response.status_code not in (200, 201):
+            raise DMEError(put_response.status_code, put_response.text, data_object_path)
+        upload = json.loads(put_response.text)
+
+        if not upload.get("multipartUpload"):
+            # Vault does not offer multipart uploads, stream the file to one URL
+            self._upload_part(upload["uploadRequestURL"], source_file, 0, size, retries, blocksize)
+            return put_response.status_code
+
+        def send(part):
+            number = int(part["partNumber"])
+            offset = (number - 1) * part_size
+            etag = self._upload_part(part["partUploadRequestURL"], source_file, offset,
+                                     min(part_size, size - offset), retries, blocksize)
+            return {"partNumber": number, "partETag": etag}
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            etags = list(pool.map(send, upload["multipartUpload"]["parts"]))
+
+        completion = {"multipartUploadId": upload["multipartUpload"]["id"], "uploadParts": etags}
+        post_response = self.http.post(self._url("/dataObject", data_object_path) + "/completeMultipartUpload",
+                                       headers=headers, json=completion, timeout=self.timeout)
+        if post_response.status_code not in (200, 201):
+            raise DMEError(post_response.status_code, post_response.text, data_object_path)
+        return post_response.status_code
+
+    def _upload_part(self, url, source_file, offset, length, retries=3, blocksize=1048576):
+        """
+            Streams a byte range of a local file to a presigned URL and returns
+            the ETag of the stored part. Failed attempts are retried after
+            a back-off with decorrelated jitter (see retry.py).
+        """
+        import requests
+        attempt, delay = 0, 0.0
+        while True:
+            part = FilePart(source_file, offset, length, blocksize, limiter=self.rate_limiter)
+            try:
+                put_response = self.http.put(url, data=part, timeout=self.timeout)
+                if put_response.status_code == 200:
+                    return put_response.headers.get("ETag", "").strip('"')
+                error = DMEError(put_response.status_code, put_response.text, url)
+            except requests.exceptions.RequestException as e:
+                error = e
+            finally:
+                part.close()
+            attempt += 1
+            if attempt > retries:
+                raise error
+            logging.warning("Retrying part at offset {0} of {1} ({2}/{3}): {4}".format(offset, source_file, attempt, retries, error))
+            delay = decorrelated_jitter(delay, base=2.0, cap=120.0)
+            time.sleep(delay)
+
+
+class AsyncDMESession():
+    """
+    An asyncio counterpart of DMESession for metadata and listing requests.
+    Thousands of lookups can be issued from a single thread: at most
+    concurrency requests are in flight at any time, and they share the
+    keep-alive connections of one aiohttp session. Requires aiohttp.
+    Example
+    ----------
+        async with AsyncDMESession() as session:
+            metadata = await asyncio.gather(*[session.get_dataObject_dme_meta(p) for p in paths])
+    """
+
+    def __init__(self, dme_url = '', dme_token = '', concurrency=64, timeout=(10, 300), retries=3):
+        """
+        Constructor
+        Parameters
+        ----------
+        dme_url : string
+            URL to perform the requests
+        dme_token : string
+            User token
+        concurrency : int
+            Largest number of requests in flight at the same time
+        timeout : tuple(<float>)
+            Connect and read timeouts of each request in seconds
+        retries : int
+            Number of retries of a request that fails with a connection error,
+            a timeout, or a throttled or unavailable response
+        """
+        self.dme_utils = 'HPC_DM_UTILS'
+        self.dme_url = dme_url if dme_url != '' else DMESession.get_dme_url(self)
+        self.dme_token = dme_token if dme_token != '' else DMESession.get_token_from_file(self)
+        self.concurrency = max(int(concurrency), 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.http = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """
+            Creates the aiohttp session, it must be called from a running event loop
+        """
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("aiohttp is required by AsyncDMESession, please install it!")
+        self._semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency, ssl=False),
+                                          headers={"Authorization": "Bearer {0}".format(self.dme_token)},
+                                          timeout=timeout)
+
+    async def close(self):
+        """
+            Closes the connections kept alive by the session
+        """
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def _url(self, endpoint, path):
+        """
+            Returns the request URL of a DME path with the path percent-encoded
+        """
+        return self.dme_url + endpoint + quote('/' + path.lstrip('/'))
+
+    async def _request(self, method, url, path, **kwargs):
+        """
+            Sends a request once the semaphore allows it and returns the status
+            code and body of the response. Transient failures are retried after
+            a back-off with decorrelated jitter (see retry.py), without holding
+            a slot of the semaphore while waiting.
+        """
+        import aiohttp
+        attempt, delay = 0, 0.0
+        while True:
+            async with self._semaphore:
+                try:
+                    async with self.http.request(method, url, **kwargs) as response:
+                        status, text = response.status, await response.text()
+                    if status not in (429, 502, 503, 504) or attempt >= self.retries:
+                        return status, text
+                    error = DMEError(status, text, path)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt >= self.retries:
+                        raise
+                    error = e
+            attempt += 1
+            logging.warning("Retrying {0} ({1}/{2}): {3}".format(path, attempt, self.retries, error))
+            delay = decorrelated_jitter(delay, base=0.5, cap=30.0)
+            await asyncio.sleep(delay)
+
+    async def get_collection_dme_meta(self, collection_path, in_pairs=True):
+        """
+            Returns the self metadata of a collection, like
+            DMESession.get_collection_dme_meta()
+            Parameters
+            ----------
+            collection_path : string
+                The path of the collection on DME
+            in_pairs : boolean
+                Return a dictionary with key pairs if True, otherwise return
+                {"metadataEntries": [...]} as it comes from DME
+
+            Returns
+            ----------
+            dictionary
+                Metadata of the collection, empty when it does not exist in DME
+        """
+        status, text = await self._request("GET", self._url("/collection", collection_path), collection_path)
+        if status == 404:
+            return {}
+        if status != 200:
+            raise DMEError(status, text, collection_path)
+        self_metadata = json.loads(text)['collections'][0]['metadataEntries']['selfMetadataEntries']
+        if not in_pairs:
+            return {"metadataEntries": self_metadata}
+        return dict((pair['attribute'], pair['value']) for pair in self_metadata)
+
+    async def get_dataObject_dme_meta(self, data_object_path, in_pairs=True):
+        """
+            Returns the user metadata of a data object, like
+            DMESession.get_dataObject_dme_meta()
+            Parameters
+            ----------
+            data_object_path : string
+                The path of the data object on DME
+            in_pairs : boolean
+                Return a dictionary with key pairs if True, otherwise return
+                {"metadataEntries": [...]} as it comes from DME
+
+            Returns
+            ----------
+            dictionary
+                Metadata of the data object, empty when it does not exist in DME
+        """
+        status, text = await self._request("GET", self._url("/v2/dataObject", data_object_path), data_object_path)
+        if status == 404:
+            return {}
+        if status != 200:
+            raise DMEError(status, text, data_object_path)
+        user_metadata = json.loads(text)['metadataEntries']['selfMetadataEntries'][0]['userMetadataEntries']
+        if not in_pairs:
+            return {"metadataEntries": user_metadata}
+        return dict((pair['attribute'], pair['value']) for pair in user_metadata)
+
+    async def get_dataObject_attributes(self, data_object_path):
+        """
+            Returns the user and system metadata of a data object as key pairs,
+            like DMESession.get_dataObject_attributes(), or None when the data
+            object does not exist in DME
+        """
+        status, text = await self._request("GET", self._url("/v2/dataObject", data_object_path), data_object_path)
+        if status == 404:
+            return None
+        if status != 200:
+            raise DMEError(status, text, data_object_path)
+        self_metadata = json.loads(text)['metadataEntries']['selfMetadataEntries'][0]
+        values = {}
+        for pair in self_metadata.get('systemMetadataEntries', []) + self_metadata['userMetadataEntries']:
+            values[pair['attribute']] = pair['value']
+        return values
+
+    async def list_collection(self, collection_path):
+        """
+            Lists the sub-collections and data objects directly under a
+            collection, like DMESession.list_collection()
+        """
+        status, text = await self._request("GET", self._url("/collection", collection_path), collection_path,
+                                           params={"list": "true"})
+        if status != 200:
+            raise DMEError(status, text, collection_path)
+        collection = json.loads(text)['collections'][0]['collection']
+        return ([c['collectionName'] for c in collection.get('subCollections', [])],
+                [d['path'] for d in collection.get('dataObjects', [])])
+
+    async def query_dataobjects(self, collection_path, compound_query, page=1, page_size=100):
+        """
+            Returns one page of the data objects under a collection that match
+            a compound metadata query, like DMESession.query_dataobjects()
+        """
+        body = {"compoundQuery": compound_query, "detailedResponse": True,
+                "page": page, "pageSize": page_size, "totalCount": True}
+        status, text = await self._request("POST", self._url("/v2/dataObject/query", collection_path),
+                                           collection_path, json=body)
+        if status != 200:
+            raise DMEError(status, text, collection_path)
+        return json.loads(text)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""history: local record of the throughput achieved by past uploads
+About:
+      Each upload appends one JSON line with the number of bytes and data objects
+    it transferred, the number of concurrent requests, how long it took and the
+    throughput it achieved. Planning a new upload (see plan.py) uses the recent
+    runs to predict how long it will take, instead of a guessed throughput.
+      The history also sizes the resources of SLURM upload jobs (see plan.py):
+    the memory request comes from the peak memory of recent runs.
+      The history is shared by every project uploaded from the same account, by
+    default in ~/.pyrkit/history.jsonl, and appends are locked like the upload
+    journal so concurrent SLURM jobs can record their runs.
+"""
+
+from __future__ import print_function
+import os, time
+
+# Local imports
+from journal import read_records, append_records
+
+
+def default_history():
+    """Returns the default location of the upload history."""
+    return os.path.join(os.path.expanduser('~'), '.pyrkit', 'history.jsonl')
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class History(object):
+    """Append-only history of upload runs.
+    @param filename <str>:
+        Path to the history file, it is created on the first append
+    @param recent <int>:
+        Number of most recent runs used for predictions
+    """
+    def __init__(self, filename=None, recent=10):
+        self.filename = filename or default_history()
+        self.recent = recent
+        self.runs = []
+        self.load()
+
+    def load(self):
+        """Reads every complete run in the history.
+        @return runs <list[dict]>:
+            Recorded runs, oldest first
+        """
+        self.runs = read_records(self.filename)
+        return self.runs
+
+    def record(self, stats, threads, **fields):
+        """Appends the statistics of an upload to the history.
+        @param stats <dict>:
+            Statistics returned by Uploader.run()
+        @param threads <int>:
+            Number of concurrent requests of the upload
+        @param fields <any>:
+            Additional values to record with the run (i.e. vault)
+        @return run <dict>:
+            Recorded run, or None when nothing was transferred
+        """
+        if stats['bytes'] <= 0 or stats['elapsed'] <= 0:
+            return None
+        run = {'time': int(time.time()), 'bytes': stats['bytes'], 'objects': stats['dataObjects'],
+               'collections': stats['collections'], 'threads': int(threads),
+               'elapsed': round(stats['elapsed'], 3),
+               'mbps': round(stats['bytes'] / 1024.0**2 / stats['elapsed'], 3)}
+        run.update(fields)
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        append_records(self.filename, [run])
+        self.runs.append(run)
+
+        return run
+
+    def throughput(self, default=None):
+        """Estimates the throughput of a single connection to DME from the median
+        of the recent runs.
+        @param default <float>:
+            Value returned when there is no history, in bytes per second
+        @return throughput <float>:
+            Throughput of a single connection in bytes per second
+        """
+        runs = [r for r in self.runs if r.get('threads') and r.get('elapsed')][-self.recent:]
+        if not runs:
+            return default
+        return median([r['bytes'] / float(r['elapsed']) / r['threads'] for r in runs])
+
+    def peak_memory(self, default=None):
+        """Returns the highest peak memory of the recent runs.
+        @param default <float>:
+            Value returned when no run recorded its memory, in MB
+        @return memory <float>:
+            Peak resident memory in MB
+        """
+        peaks = [r['maxrss_mb'] for r in self.runs[-self.recent:] if r.get('maxrss_mb')]
+        return max(peaks) if peaks else default
@@ -322,6 +322,14 @@ def tsv2dict(file, key_index = 0, value_index = 1, header = False):
     return metadata
 
 
+def name_part(value, space=""):
+    """Returns a value usable in the name of a collection. Spaces are replaced and
+    any other character not allowed in DME names (see conform.py) is removed,
+    i.e. 'Homo sapiens' becomes 'Homo-sapiens'.
+    """
+    return re.sub(r'[^A-Za-z0-9._+-]', '', str(value).strip().replace(" ", space))
+
+
 def json2dict(file):
     """Reads in JSON file into memory as a dictionary. Checks to see if
     file exists or is accessible before reading in the file.
@@ -409,6 +417,28 @@ def _pi(parsed_data, template, opath, dme_vault, index=0):
     return {collection_name: outfile}
 
 
+def vault_metadata(metadata, dme_vault, project_scientist=None):
+    """Returns the variant of a collection's metadata required by a DME vault. The
+    DTB vault requires the 'project_scientist' and 'project_completed_date' fields
+    on Project collections, which are removed for every other vault. This allows
+    the same upload hierarchy to be pushed into several vaults.
+    """
+    entries = metadata['metadataEntries']
+    values = dict((pair['attribute'], pair['value']) for pair in entries)
+    if values.get('collection_type') != 'Project':
+        return metadata
+
+    dtb_fields = ['project_scientist', 'project_completed_date']
+    variant = [pair for pair in entries if pair['attribute'] not in dtb_fields]
+    if dme_vault.strip('/') == 'CCR_DTB_Archive':
+        scientist = project_scientist or values.get('project_scientist') or values.get('contact_name', '')
+        completed = values.get('project_completed_date') or datetime.today().strftime('%Y-%m-%d')
+        variant.append({'attribute': 'project_scientist', 'value': scientist})
+        variant.append({'attribute': 'project_completed_date', 'value': completed})
+
+    return dict(metadata, metadataEntries=variant)
+
+
 def _project(parsed_data, template, opath, dme_vault, pid):
     """Private helper function to generate(). Extracts Project metadata from parsed_data,
     adds it to the template, and writes it to a new file. Returns a dictionary containing
@@ -438,13 +468,23 @@ def _project(parsed_data, template, opath, dme_vault, pid):
                             continue
                     temp['metadataEntries'].append({'attribute': field, 'value': val})
             else:
+                # Request templates v15 and later name the organism source_organism
+                for metadict in parsed_data.values():
+                    if 'organism' not in metadict and metadict.get('source_organism'):
+                        metadict['organism'] = metadict['source_organism']
+                        temp['metadataEntries'].append({'attribute': 'organism', 'value': metadict['organism'][i]})
                 # Get dme field names for collection and write output to file
                 #poc, origin, nsamples, method, sdate = dict2list(parsed_data, ["contact_name", "origin", "number_of_cases", "method", "project_start_date"], i=i, override_index=["contact_name", "project_start_date"])
                 poc, origin, method, organism, sdate, nsamples = dict2list(parsed_data, ["contact_name", "origin", "method", "organism", "project_start_date", "number_of_cases"], i=i, override_index=["contact_name", "project_start_date"])
                 project_scientist = poc
-                poc = poc.replace(" ","")
-                origin = origin.replace(" ","-")
-                method = method.replace(" ","-")
+                if ',' in poc:
+                    # LastName, FirstName like the PI, see _pi()
+                    last, first = [n.strip() for n in poc.split(',', 1)]
+                    poc = '{}{}'.format(first, last)
+                poc = name_part(poc)
+                origin = name_part(origin, "-")
+                method = name_part(method, "-")
+                organism = name_part(organism, "-")
                 sdate = sdate.split()[0]
 
                 #collection_name = 'Project_{}_{}_{}{}_{}'.format(poc, origin, nsamples, method, sdate)
@@ -458,8 +498,7 @@ def _project(parsed_data, template, opath, dme_vault, pid):
 
                 if dme_vault == 'CCR_DTB_Archive':
                     # Additional required fields for DTB vault
-                    temp['metadataEntries'].append({'attribute': 'project_scientist', 'value': project_scientist})
-                    temp['metadataEntries'].append({'attribute': 'project_completed_date', 'value': datetime.today().strftime('%Y-%m-%d')})
+                    temp = vault_metadata(temp, dme_vault, project_scientist)
 
                 outfile = os.path.join(opath, '{}.metadata.json'.format(collection_name))
                 path_exists(os.path.join(opath, '{}'.format(collection_name)))
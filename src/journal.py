@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""journal: append-only record of uploads confirmed by HPC DME
+About:
+      Each collection or data object that DME confirms as registered is appended
+    to the journal as one JSON line, along with its size and checksum. A resumed
+    upload reads the journal once and skips every entry whose size and checksum
+    still match, so only unfinished or changed entries are sent again.
+      Appends are serialized with an exclusive lock on the journal file, so the
+    same journal can be shared by a dry-run, a local run and a SLURM job. A line
+    that was only partially written when a job was killed is ignored on reading.
+"""
+
+from __future__ import print_function
+import os, json, time, fcntl, threading
+
+
+def read_records(filename):
+    """Reads every complete JSON record of an append-only file, under a shared
+    lock. The dedup index and the upload history are kept the same way.
+    @param filename <str>:
+        Path to the file, it may not exist yet
+    @return records <list[dict]>:
+        Records in the order they were appended
+    """
+    records = []
+    if not os.path.exists(filename):
+        return records
+    with open(filename, 'r') as fh:
+        fcntl.flock(fh, fcntl.LOCK_SH)
+        try:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue # Partial line left by a job that was killed mid-write
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+    return records
+
+
+def append_records(filename, records):
+    """Appends JSON records to a file, one per line, under an exclusive lock.
+    The records are flushed to disk before returning.
+    @param filename <str>:
+        Path to the file, it is created on the first append
+    @param records <list[dict]>:
+        Records to append
+    """
+    lines = ''.join(json.dumps(r, sort_keys=True) + '\n' for r in records)
+    fd = os.open(filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        end = os.fstat(fd).st_size
+        if end > 0 and os.pread(fd, 1, end - 1) != b'\n':
+            lines = '\n' + lines # Start a fresh line after a partial write
+        os.write(fd, lines.encode())
+        os.fsync(fd)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class Journal(object):
+    """Append-only journal of collections and data objects registered in DME.
+    @param filename <str>:
+        Path to the journal file, it is created on the first append
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Reads every complete record in the journal. When a path was recorded
+        more than once, the last record wins.
+        @return entries <dict>:
+            Journal records where [key] = DME path and [value] = record
+        """
+        for record in read_records(self.filename):
+            self.entries[record['path']] = record
+
+        return self.entries
+
+    def confirmed(self, path, size, checksum):
+        """Checks if an entry was already registered with the same size and checksum.
+        @param path <str>:
+            DME path of the collection or data object
+        @param size <int>:
+            Size of the local file in bytes
+        @param checksum <str>:
+            Checksum of the local file (or of a collection's metadata)
+        @return is_confirmed <bool>:
+            True when the journal holds a matching record
+        """
+        record = self.entries.get(path)
+        return record is not None and record['size'] == size and record['checksum'] == checksum
+
+    def record(self, kind, path, size, checksum):
+        """Appends a confirmed collection or data object to the journal. The record
+        is flushed to disk before returning.
+        @param kind <str>:
+            Type of the entry, 'collection' or 'dataObject'
+        @param path <str>:
+            DME path of the collection or data object
+        @param size <int>:
+            Size of the local file in bytes
+        @param checksum <str>:
+            Checksum of the local file (or of a collection's metadata)
+        """
+        record = {'type': kind, 'path': path, 'size': size, 'checksum': checksum, 'time': int(time.time())}
+
+        with self._lock:
+            append_records(self.filename, [record])
+            self.entries[path] = record
+
+        return record
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""plan: offline plan of an upload into HPC DME
+About:
+      This program computes what an upload of '<dme_base_directory>/upload' would
+    register without contacting DME or starting the DME command line toolkit:
+    the collections to create, the number of data objects, their total size and
+    a predicted duration. The tree is scanned once with os.scandir(), reading
+    only the size of each file, so planning 10,000 data objects takes a fraction
+    of a second.
+      The duration is predicted by scheduling the data objects over the workers
+    (see scheduler.py) with the per-connection throughput achieved by recent
+    uploads (see history.py), or --throughput when there is no history yet.
+      The same scan sizes the resources of the SLURM upload job: --slurm prints
+    the --time, --cpus-per-task and --mem options for sbatch, from the predicted
+    duration of the largest shard and the peak memory of recent uploads, each
+    with a safety margin.
+      The plan is printed as text, or as JSON with --json for other tools.
+USAGE:
+	$ plan.py <dme_base_directory> <dme_vault> [OPTIONS]
+Example:
+    $ plan.py /scratch/ccbr123/RNA_hg38/DME /CCBR_Archive --json
+"""
+
+from __future__ import print_function
+import sys, os, json
+
+# Local imports
+from scheduler import Scheduler, hms, shards
+from history import History
+
+
+def err(*message, **kwargs):
+    """Prints any provided args to standard error.
+    kwargs can be provided to modify print functions
+    behavior.
+    @param message <any>:
+        Values printed to standard error
+    @params kwargs <print()>
+        Key words to modify print function behavior
+    """
+    print(*message, file=sys.stderr, **kwargs)
+
+
+def scan(upload_directory, vault):
+    """Lists the collections and data objects of the local upload hierarchy with
+    a single stat() per file. Metadata files are not read.
+    @param upload_directory <str>:
+        Local mock DME hierarchy (i.e. DME/upload)
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @return collections <list[str]>:
+        DME paths of the collections, parents before children
+    @return objects <list[tuple]>:
+        (DME path, size in bytes) of each data object
+    """
+    collections, objects = [], []
+    stack = [(os.path.abspath(upload_directory), '/' + vault.strip('/'))]
+    while stack:
+        local, remote = stack.pop()
+        subdirectories = []
+        for entry in os.scandir(local):
+            if entry.is_dir():
+                subdirectories.append((entry.path, '{}/{}'.format(remote, entry.name)))
+            elif not entry.name.endswith('.metadata.json'):
+                objects.append(('{}/{}'.format(remote, entry.name), entry.stat().st_size))
+        subdirectories.sort()
+        collections.extend(path for _, path in subdirectories)
+        stack.extend(reversed(subdirectories))
+
+    return collections, objects
+
+
+def plan(upload_directory, vault, workers=4, throughput=None, history=None,
+         multipart_threshold=5368709120, part_threads=4, nshards=1):
+    """Computes the plan of an upload.
+    @param upload_directory <str>:
+        Local mock DME hierarchy (i.e. DME/upload)
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @param workers <int>:
+        Number of concurrent requests of the upload
+    @param throughput <float>:
+        Throughput of a single connection in bytes per second, overrides the history
+    @param history <History>:
+        Throughput history of past uploads
+    @param nshards <int>:
+        Number of shards uploaded by the tasks of a SLURM job array
+    @return plan <dict>:
+        Collections, data objects, bytes and predicted duration of the upload
+    """
+    collections, objects = scan(upload_directory, vault)
+    source = 'option'
+    if throughput is None:
+        throughput = history.throughput() if history is not None else None
+        source = 'history'
+    if throughput is None:
+        throughput, source = 52428800.0, 'default'
+
+    scheduler = Scheduler(workers, throughput=throughput, multipart_threshold=multipart_threshold,
+                          part_threads=part_threads)
+    entries = [{'path': path, 'size': size} for path, size in objects]
+    ordered = scheduler.order(entries)
+    seconds = scheduler.makespan(ordered) + len(collections) * scheduler.overhead / scheduler.workers
+    largest = ordered[0] if ordered else {'path': None, 'size': 0}
+    # Each task of a job array uploads one shard, the slowest one bounds the job
+    shard_seconds = seconds
+    if nshards > 1:
+        shard_seconds = max(scheduler.makespan(scheduler.order(objects)) for objects in shards(entries, nshards))
+        shard_seconds += len(collections) * scheduler.overhead / scheduler.workers
+
+    return {
+        'directory': os.path.abspath(upload_directory),
+        'vault': '/' + vault.strip('/'),
+        'collections': len(collections),
+        'dataObjects': len(objects),
+        'bytes': sum(size for _, size in objects),
+        'largest': largest,
+        'workers': scheduler.workers,
+        'throughput_mbps': round(throughput / 1024.0**2, 3),
+        'throughput_source': source,
+        'predicted_seconds': round(seconds, 1),
+        'predicted': hms(seconds),
+        'shards': max(int(nshards), 1),
+        'shard_predicted_seconds': round(shard_seconds, 1),
+        'collection_paths': collections
+    }
+
+
+def resources(plan, history=None, native=True, margin=1.5, minimum_time=3600, maximum_time=864000):
+    """Sizes the resources of the SLURM job that runs an upload.
+    @param plan <dict>:
+        Plan returned by plan()
+    @param history <History>:
+        History of past uploads, used for the memory request
+    @param native <bool>:
+        True for upload.py, False for dm_register_directory, whose thread
+        count is the number of CPUs of the job
+    @param margin <float>:
+        Safety factor applied to the predicted duration and memory
+    @param minimum_time <int>:
+        Shortest time limit requested in seconds
+    @param maximum_time <int>:
+        Longest time limit requested in seconds (10 days)
+    @return resources <dict>:
+        Values of sbatch's --time, --cpus-per-task and --mem options
+    """
+    seconds = plan['shard_predicted_seconds'] * margin + 900  # Start-up and manifest
+    seconds = min(max(seconds, minimum_time), maximum_time)
+    seconds = int(-(-seconds // 900) * 900)  # Round up to 15 minutes
+    days, rest = divmod(seconds, 86400)
+    walltime = '{}-{}'.format(days, hms(rest)) if days else hms(rest)
+
+    # Upload threads wait on the network, one CPU drives several of them
+    cpus = max(2, -(-plan['workers'] // 4)) if native else max(2, plan['workers'])
+
+    peak = history.peak_memory() if history is not None and native else None
+    if peak is None:
+        peak = 1024.0 * (2 + plan['workers'] * (0.25 if native else 1))
+    mem = max(2, int(-(-(peak * margin) // 1024)))
+
+    return {'time': walltime, 'cpus-per-task': cpus, 'mem': '{}g'.format(mem)}
+
+
+def report(plan):
+    """Returns a human readable summary of a plan.
+    @param plan <dict>:
+        Plan returned by plan()
+    @return summary <str>:
+        Multi-line summary of the plan
+    """
+    lines = ['Would create collection {}'.format(path) for path in plan['collection_paths']]
+    lines.append('Plan: {} collections and {} data objects ({:.2f} GB) into {}'.format(
+        plan['collections'], plan['dataObjects'], plan['bytes'] / 1024.0**3, plan['vault']))
+    if plan['largest']['path']:
+        lines.append('Largest data object: {} ({:.2f} GB)'.format(plan['largest']['path'], plan['largest']['size'] / 1024.0**3))
+    lines.append('Predicted duration {} over {} workers at {:.1f} MB/s per connection ({})'.format(
+        plan['predicted'], plan['workers'], plan['throughput_mbps'], plan['throughput_source']))
+    if 'slurm' in plan:
+        lines.append('Upload job resources: {}'.format(' '.join(
+            '--{}={}'.format(k, v) for k, v in sorted(plan['slurm'].items()))))
+
+    return '\n'.join(lines)
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'plan: \
+                                                    offline plan of an upload into HPC DME.')
+    parser.add_argument('directory',
+                        type = str,
+                        help = 'Required: DME base directory for all intermediate output files. \
+                                It must contain the upload/ hierarchy created by pyrkit. \
+                                Example: /scratch/ccbr123/RNA_hg38/DME')
+    parser.add_argument('vault',
+                        type = str,
+                        help = 'Required: DME vault to push data. \
+                                Example: /CCBR_Archive')
+    parser.add_argument('-t', '--threads',
+                        type = int,
+                        default = 4,
+                        help = 'Optional: Number of concurrent requests of the upload. \
+                                Default: 4')
+    parser.add_argument('--throughput',
+                        type = float,
+                        default = None,
+                        help = 'Optional: Throughput of a single connection to DME in MB/s. \
+                                Default: median of the recent uploads in --history, or 50')
+    parser.add_argument('--history',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Upload history used to predict the duration. \
+                                Default: ~/.pyrkit/history.jsonl')
+    parser.add_argument('--shards',
+                        type = int,
+                        default = 1,
+                        help = 'Optional: Number of shards uploaded by a SLURM job array, \
+                                resources are sized for the largest shard. Default: 1')
+    parser.add_argument('--slurm',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Only print the --time, --cpus-per-task and --mem \
+                                options of sbatch for the upload job.')
+    parser.add_argument('--dm-register-directory',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Size the job for dm_register_directory instead of \
+                                upload.py.')
+    parser.add_argument('--margin',
+                        type = float,
+                        default = 1.5,
+                        help = 'Optional: Safety factor applied to the predicted duration and \
+                                memory of the upload job. Default: 1.5')
+    parser.add_argument('--json',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Print the plan as JSON.')
+    parser.add_argument('-o', '--output',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Also write the plan as JSON to this file.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    # Collect args
+    args = parsed_arguments()
+
+    upload_directory = os.path.join(args.directory, 'upload')
+    if not os.path.isdir(upload_directory):
+        err('Error: {} does not exist!'.format(upload_directory))
+        sys.exit(1)
+
+    throughput = args.throughput * 1024**2 if args.throughput else None
+    history = History(args.history or None)
+    result = plan(upload_directory, args.vault, workers=args.threads, throughput=throughput,
+                  history=history, nshards=args.shards)
+    result['slurm'] = resources(result, history, native=not args.dm_register_directory, margin=args.margin)
+    if args.slurm:
+        print(' '.join('--{}={}'.format(k, v) for k, v in sorted(result['slurm'].items())))
+        return
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(result, fh, indent=2, sort_keys=True)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print(report(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""restore: pulls an archived analysis from HPC DME back to local storage
+About:
+      This program downloads every data object under a DME collection, i.e. a
+    Primary_Analysis or a whole Project, so it can be reanalyzed. The collection
+    is listed level by level and the metadata of its data objects is fetched
+    over a pool of worker threads.
+      Files are restored into the layout they had before they were archived,
+    from the 'alias' attribute that meta records with the original path of each
+    file. Paths are made relative to the deepest directory the aliases share, or
+    to --alias-root. With --dme-layout, or for data objects without an alias,
+    the layout of the DME collection is used instead.
+      Data objects are downloaded largest first. Each one is split into byte
+    ranges of --part-size that are fetched concurrently into '<file>.part', and
+    every completed range is recorded in '<file>.part.ranges', so restoring
+    again after an interruption only downloads the missing ranges. A transient
+    error only retries the range that failed (see retry.py). Once all of its
+    ranges are downloaded, a file is checked against its md5_checksum before it
+    is renamed into place, so every file in the output directory is verified.
+    A file that is already in place is checked against its md5_checksum too,
+    and downloaded again when it does not match, unless --trust-size skips the
+    files whose size matches.
+USAGE:
+	$ restore.py <dme_collection> <output_directory> [OPTIONS]
+Example:
+    $ restore.py /CCBR_Archive/PI_Lab_X/Project_Y /scratch/ccbr123/restore --threads 8
+"""
+
+from __future__ import print_function
+import sys, os, time, fcntl, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Local imports
+import dme_utils as dme
+from retry import Retry, CircuitBreaker
+from upload import transient
+
+
+def err(*message, **kwargs):
+    """Prints any provided args to standard error.
+    kwargs can be provided to modify print functions
+    behavior.
+    @param message <any>:
+        Values printed to standard error
+    @params kwargs <print()>
+        Key words to modify print function behavior
+    """
+    print(*message, file=sys.stderr, **kwargs)
+
+
+def walk(session, collection, threads=8):
+    """Lists every data object under a collection. Each level of the hierarchy
+    is listed concurrently.
+    @param session <DMESession>:
+        Session used to query DME
+    @param collection <str>:
+        DME collection to restore (i.e. /CCBR_Archive/PI_Lab_X/Project_Y)
+    @param threads <int>:
+        Number of concurrent requests
+    @return objects <list[str]>:
+        DME paths of the data objects
+    """
+    objects, level = [], ['/' + collection.strip('/')]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while level:
+            children = []
+            for collections, paths in pool.map(session.list_collection, level):
+                children.extend(collections)
+                objects.extend(paths)
+            level = children
+
+    return sorted(objects)
+
+
+def inventory(session, paths, threads=8):
+    """Fetches the size, checksum and original location of each data object.
+    @param session <DMESession>:
+        Session used to query DME
+    @param paths <list[str]>:
+        DME paths of the data objects
+    @param threads <int>:
+        Number of concurrent requests
+    @return entries <list[dict>]:
+        Data objects to restore, each entry has the keys: path, size, checksum
+        and alias (None when the data object has none)
+    """
+    def attributes(path):
+        values = session.get_dataObject_attributes(path) or {}
+        size = values.get('source_file_size')
+        return {
+            'path': path,
+            'size': int(size) if size is not None else None,
+            'checksum': values.get('md5_checksum', values.get('checksum')),
+            'alias': values.get('alias')
+        }
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(attributes, paths))
+
+
+def layout(entries, collection, output, alias_root=None, use_alias=True):
+    """Decides where each data object is restored. Data objects archived from
+    the same file (i.e. a BAM linked into several collections) are only
+    downloaded once.
+    @param entries <list[dict]>:
+        Data objects listed by inventory()
+    @param collection <str>:
+        DME collection being restored
+    @param output <str>:
+        Local directory to restore into
+    @param alias_root <str>:
+        Original directory the aliases are made relative to, defaults to the
+        deepest directory they share
+    @param use_alias <bool>:
+        Rebuild the original layout from the alias attribute
+    @return entries <list[dict]>:
+        Data objects to download, with their local destination
+    @return duplicates <list[dict]>:
+        Data objects with the same alias and checksum as one that is downloaded
+    """
+    collection = '/' + collection.strip('/')
+    parent = os.path.dirname(collection)
+    aliases = [e['alias'] for e in entries if use_alias and e['alias'] and os.path.isabs(e['alias'])]
+    root = alias_root
+    if root is None and aliases:
+        root = os.path.commonpath([os.path.dirname(a) for a in aliases])
+
+    restored, duplicates, claimed = [], [], {}
+    for entry in entries:
+        relative = None
+        alias = entry['alias'] if use_alias and entry['alias'] and os.path.isabs(entry['alias']) else None
+        if alias and root is not None and os.path.commonpath([alias, root]) == root:
+            relative = os.path.relpath(alias, root)
+        if relative is None or (relative in claimed and claimed[relative]['checksum'] != entry['checksum']):
+            relative = os.path.relpath(entry['path'], parent)
+        if relative in claimed:
+            duplicates.append(dict(entry, local=claimed[relative]['local']))
+            continue
+        entry = dict(entry, local=os.path.join(os.path.abspath(output), relative))
+        claimed[relative] = entry
+        restored.append(entry)
+
+    return restored, duplicates
+
+
+def ranges(size, part_size):
+    """Splits a data object into the byte ranges downloaded concurrently.
+    @return ranges <list[tuple]>:
+        (offset, length) of each range
+    """
+    part_size = max(int(part_size), 1)
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+
+def md5sum(filename, blocksize=1048576):
+    """Returns the MD5 of the contents of a local file."""
+    hasher = hashlib.md5()
+    with open(filename, 'rb') as fh:
+        buf = fh.read(blocksize)
+        while buf:
+            hasher.update(buf)
+            buf = fh.read(blocksize)
+    return hasher.hexdigest()
+
+
+class Restorer(object):
+    """Downloads data objects by byte range over a pool of worker threads.
+    Progress of each file is kept next to it, so an interrupted restore resumes
+    where it stopped.
+    @param session <DMESession>:
+        Session used to download from DME
+    @param threads <int>:
+        Number of concurrent downloads
+    @param part_size <int>:
+        Size of the byte ranges in bytes
+    @param retry <Retry>:
+        Optional retry policy of a single range
+    @param blocksize <int>:
+        Number of bytes written to disk at a time
+    @param trust_size <bool>:
+        Skip a file that is already restored when its size matches, without
+        checking it against its md5_checksum
+    """
+    def __init__(self, session, threads=8, part_size=268435456, retry=None, blocksize=1048576, trust_size=False):
+        self.session = session
+        self.trust_size = trust_size
+        self.threads = threads
+        self.part_size = part_size
+        self.retry = retry
+        self.blocksize = blocksize
+        self.failed = []
+        self.stats = {'dataObjects': 0, 'bytes': 0, 'resumed': 0, 'skipped': 0, 'failed': 0, 'elapsed': 0.0}
+        self._lock = threading.Lock()
+
+    def _done(self, progress):
+        """Reads the offsets of the ranges already downloaded into a .part file."""
+        done = set()
+        if os.path.exists(progress):
+            with open(progress, 'r') as fh:
+                for line in fh:
+                    if line.strip().isdigit():
+                        done.add(int(line))
+        return done
+
+    def _record(self, progress, offset):
+        fd = os.open(progress, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, '{}\n'.format(offset).encode())
+            os.fsync(fd)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _fail(self, entry, reason):
+        with self._lock:
+            if entry.get('failed'):
+                return
+            entry['failed'] = True
+            self.failed.append((entry, reason))
+            self.stats['failed'] += 1
+        err('Error: failed to restore {}: {}'.format(entry['path'], reason))
+
+    def _prepare(self, entry):
+        """Lists the ranges of a data object that still need to be downloaded.
+        @return tasks <list[tuple]>:
+            (offset, length) of each missing range, or None when the file is
+            already restored
+        """
+        if os.path.exists(entry['local']) and entry['size'] in (None, os.path.getsize(entry['local'])):
+            checksum = None
+            if entry['checksum'] and not self.trust_size:
+                checksum = md5sum(entry['local'], self.blocksize)
+            if checksum in (None, entry['checksum']):
+                with self._lock:
+                    self.stats['skipped'] += 1
+                return None
+            print('Restoring {} again, md5 {} of {} does not match md5_checksum {}'.format(
+                entry['path'], checksum, entry['local'], entry['checksum']))
+        directory = os.path.dirname(entry['local'])
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        partial, progress = entry['local'] + '.part', entry['local'] + '.part.ranges'
+        if entry['size'] is None:
+            # Size unknown, the data object is downloaded in one request
+            open(partial, 'wb').close()
+            entry['remaining'] = 1
+            return [(0, None)]
+        done = set()
+        if os.path.exists(partial) and os.path.getsize(partial) == entry['size']:
+            done = self._done(progress)
+        else:
+            with open(partial, 'wb') as fh:
+                fh.truncate(entry['size'])
+            if os.path.exists(progress):
+                os.remove(progress)
+        if done:
+            with self._lock:
+                self.stats['resumed'] += 1
+        tasks = [r for r in ranges(entry['size'], self.part_size) if r[0] not in done]
+        entry['remaining'] = len(tasks)
+        return tasks
+
+    def _finish(self, entry):
+        """Verifies a fully downloaded file and moves it into place."""
+        partial, progress = entry['local'] + '.part', entry['local'] + '.part.ranges'
+        if entry['checksum']:
+            checksum = md5sum(partial, self.blocksize)
+            if checksum != entry['checksum']:
+                # Start over on the next restore
+                os.remove(partial)
+                if os.path.exists(progress):
+                    os.remove(progress)
+                return self._fail(entry, 'md5 {} does not match md5_checksum {}'.format(checksum, entry['checksum']))
+        os.rename(partial, entry['local'])
+        if os.path.exists(progress):
+            os.remove(progress)
+        with self._lock:
+            self.stats['dataObjects'] += 1
+        print('Restored {} to {}{}'.format(entry['path'], entry['local'],
+                                           '' if entry['checksum'] else ' (no checksum to verify)'))
+
+    def _download(self, entry, offset, length):
+        if entry.get('failed'):
+            return
+        try:
+            partial = entry['local'] + '.part'
+            if self.retry is not None:
+                written = self.retry(self.session.download_dataobject, entry['path'], partial,
+                                     offset, length, self.blocksize)
+            else:
+                written = self.session.download_dataobject(entry['path'], partial, offset, length, self.blocksize)
+            self._record(entry['local'] + '.part.ranges', offset)
+        except (dme.DMEError, IOError, OSError) as e:
+            return self._fail(entry, e)
+
+        with self._lock:
+            self.stats['bytes'] += written
+            entry['remaining'] -= 1
+            last = entry['remaining'] == 0
+        if last:
+            try:
+                self._finish(entry)
+            except (IOError, OSError) as e:
+                self._fail(entry, e)
+
+    def run(self, entries):
+        """Restores data objects, largest first.
+        @param entries <list[dict]>:
+            Data objects returned by layout()
+        @return stats <dict>:
+            Counts of restored, resumed, skipped and failed data objects and bytes
+        """
+        start = time.time()
+
+        def prepare(entry):
+            try:
+                return self._prepare(entry)
+            except (IOError, OSError) as e:
+                self._fail(entry, e)
+                return None
+
+        # Files that are already restored are checked concurrently
+        ordered = sorted(entries, key=lambda e: (-(e['size'] or 0), e['path']))
+        with ThreadPoolExecutor(max_workers=max(int(self.threads), 1)) as pool:
+            prepared = list(pool.map(prepare, ordered))
+
+        tasks = []
+        for entry, missing in zip(ordered, prepared):
+            if missing is None:
+                continue
+            if not missing:
+                # Empty file, or every range was downloaded before an interruption
+                try:
+                    self._finish(entry)
+                except (IOError, OSError) as e:
+                    self._fail(entry, e)
+                continue
+            tasks.extend((entry, offset, length) for offset, length in missing)
+
+        with ThreadPoolExecutor(max_workers=max(int(self.threads), 1)) as pool:
+            for _ in pool.map(lambda task: self._download(*task), tasks):
+                pass
+        if self.retry is not None:
+            self.stats['retries'] = self.retry.retries
+        self.stats['elapsed'] = time.time() - start
+        return self.stats
+
+
+def summarize(stats, duplicates=0):
+    """Returns a human readable summary of a restore.
+    @param stats <dict>:
+        Statistics returned by Restorer.run()
+    @return summary <str>:
+        One line summary of the restore
+    """
+    elapsed = max(stats['elapsed'], 1e-6)
+    summary = 'Restored {} data objects ({:.2f} GB downloaded) in {:.1f} seconds ({:.2f} MB/s), {} resumed, {} already restored, {} failed'.format(
+        stats['dataObjects'], stats['bytes'] / 1024.0**3, stats['elapsed'],
+        stats['bytes'] / 1024.0**2 / elapsed, stats['resumed'], stats['skipped'], stats['failed'])
+    if duplicates:
+        summary += ', {} duplicates of a restored file'.format(duplicates)
+    return summary
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'restore: \
+                                                    pulls an archived analysis from HPC DME back to local storage.')
+    parser.add_argument('collection',
+                        type = str,
+                        help = 'Required: DME collection to restore, i.e. a Project or a \
+                                Primary_Analysis collection. \
+                                Example: /CCBR_Archive/PI_Lab_X/Project_Y')
+    parser.add_argument('output',
+                        type = str,
+                        help = 'Required: Local directory to restore into. \
+                                Example: /scratch/ccbr123/restore')
+    parser.add_argument('-t', '--threads',
+                        type = int,
+                        default = 8,
+                        help = 'Optional: Number of concurrent requests to DME. \
+                                Default: 8')
+    parser.add_argument('--part-size',
+                        type = int,
+                        default = 256,
+                        help = 'Optional: Size in MB of the byte ranges downloaded concurrently \
+                                and recorded to resume an interrupted restore. Default: 256')
+    parser.add_argument('--alias-root',
+                        type = str,
+                        default = None,
+                        help = 'Optional: Original directory of the archived files, their \
+                                paths below it are recreated in the output directory. \
+                                Default: the deepest directory shared by every alias')
+    parser.add_argument('--dme-layout',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Restore files into the layout of the DME collection \
+                                instead of their original location from the alias attribute.')
+    parser.add_argument('--retries',
+                        type = int,
+                        default = 5,
+                        help = 'Optional: Maximum number of attempts of a range that fails with \
+                                a transient error. Default: 5')
+    parser.add_argument('--max-backoff',
+                        type = float,
+                        default = 60,
+                        help = 'Optional: Longest delay in seconds between two attempts. Default: 60')
+    parser.add_argument('--trust-size',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Skip a file that is already restored when its size \
+                                matches, without checking it against its md5_checksum.')
+    parser.add_argument('-n', '--dry-run',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: List where each data object would be restored without \
+                                downloading anything.')
+    # Overrides for the DME server
+    parser.add_argument('--dme-url',
+                        type = str,
+                        default = '',
+                        help = 'Optional: URL of the DME server, overrides the URL in \
+                                $HPC_DM_UTILS/hpcdme.properties.')
+    parser.add_argument('--dme-token',
+                        type = str,
+                        default = '',
+                        help = 'Optional: DME token, overrides the token in \
+                                $HPC_DM_UTILS/tokens/curl-conf.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    # Collect args
+    args = parsed_arguments()
+
+    session = dme.DMESession(args.dme_url, args.dme_token, pool_size=args.threads)
+    try:
+        paths = walk(session, args.collection, threads=args.threads)
+        entries = inventory(session, paths, threads=args.threads)
+    except dme.DMEError as e:
+        err('Error: failed to list {}: {}'.format(args.collection, e))
+        sys.exit(1)
+    entries, duplicates = layout(entries, args.collection, args.output,
+                                 alias_root=args.alias_root, use_alias=not args.dme_layout)
+    print('Found {} data objects ({:.2f} GB) under {}'.format(
+        len(entries), sum(e['size'] or 0 for e in entries) / 1024.0**3, args.collection))
+    for entry in duplicates:
+        print('Skipping {} (same file as {})'.format(entry['path'], entry['local']))
+    if args.dry_run:
+        for entry in sorted(entries, key=lambda e: (-(e['size'] or 0), e['path'])):
+            print('Would restore {} to {}'.format(entry['path'], entry['local']))
+        return
+
+    breaker = CircuitBreaker()
+    retry = Retry(attempts=args.retries, cap=args.max_backoff, breaker=breaker, transient=transient)
+    restorer = Restorer(session, threads=args.threads, part_size=args.part_size * 1024**2, retry=retry,
+                        trust_size=args.trust_size)
+    stats = restorer.run(entries)
+    print(summarize(stats, len(duplicates)))
+    print('Retries: {}'.format(retry))
+
+    if restorer.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""retry: per-request retries and a circuit breaker for requests to HPC DME
+About:
+      A transient error only retries the request that failed, never the whole
+    upload, so entries that were already registered are not sent again. Retries
+    are spaced with decorrelated jitter: each delay is drawn at random between
+    the base delay and three times the previous delay, capped at a maximum, so
+    many threads that failed at the same moment do not retry in lockstep.
+      When many requests fail in a row, DME is most likely down or overloaded
+    rather than rejecting one file. The circuit breaker then opens and every
+    thread waits before starting new work. After the cooldown, a single probe
+    request is let through: if it succeeds the breaker closes, otherwise it
+    opens again with a longer cooldown.
+"""
+
+from __future__ import print_function
+import time, random, threading
+
+
+def decorrelated_jitter(previous, base=1.0, cap=60.0):
+    """Returns the next delay of a decorrelated jitter backoff.
+    @param previous <float>:
+        Previous delay in seconds, or 0 before the first retry
+    @param base <float>:
+        Shortest delay in seconds
+    @param cap <float>:
+        Longest delay in seconds
+    @return delay <float>:
+        Delay before the next attempt in seconds
+    """
+    return min(cap, random.uniform(base, max(base, previous * 3)))
+
+
+class CircuitBreaker(object):
+    """Pauses new requests while DME keeps failing. Shared by every thread.
+    @param threshold <int>:
+        Number of consecutive failures that opens the breaker
+    @param cooldown <float>:
+        Seconds the breaker stays open before a probe request is let through,
+        doubled every time a probe fails, up to max_cooldown
+    @param max_cooldown <float>:
+        Longest time in seconds the breaker stays open
+    """
+    def __init__(self, threshold=5, cooldown=30.0, max_cooldown=600.0):
+        self.threshold = max(int(threshold), 1)
+        self.cooldown = float(cooldown)
+        self.max_cooldown = float(max_cooldown)
+        self.failures = 0
+        self.trips = 0
+        self.state = 'closed'
+        self._wait = self.cooldown
+        self._opened = 0.0
+        self._probing = False
+        self._condition = threading.Condition()
+
+    def wait(self):
+        """Blocks while the breaker is open, or while a probe request is running.
+        @return waited <float>:
+            Seconds spent waiting
+        """
+        start = time.time()
+        with self._condition:
+            while True:
+                if self.state == 'closed':
+                    break
+                remaining = self._opened + self._wait - time.time()
+                if self.state == 'open' and remaining <= 0:
+                    self.state = 'half-open'
+                if self.state == 'half-open' and not self._probing:
+                    self._probing = True # This thread sends the probe
+                    break
+                self._condition.wait(remaining if remaining > 0 else None)
+
+        return time.time() - start
+
+    def success(self):
+        """Records a successful request, closes the breaker after a probe."""
+        with self._condition:
+            self.failures = 0
+            if self.state != 'closed':
+                self.state = 'closed'
+                self._wait = self.cooldown
+                self._probing = False
+                self._condition.notify_all()
+
+    def failure(self):
+        """Records a failed request, opens the breaker after too many in a row
+        or when a probe fails."""
+        with self._condition:
+            self.failures += 1
+            if self.state == 'half-open':
+                self._wait = min(self._wait * 2, self.max_cooldown)
+            elif self.state == 'open' or self.failures < self.threshold:
+                return
+            self.state = 'open'
+            self._opened = time.time()
+            self._probing = False
+            self.trips += 1
+            self._condition.notify_all()
+
+    def release(self):
+        """Lets another thread probe when a probe ended without a verdict,
+        i.e. the request failed for a reason unrelated to DME."""
+        with self._condition:
+            if self._probing:
+                self._probing = False
+                self._condition.notify_all()
+
+
+class Retry(object):
+    """Runs a request, retrying transient failures with decorrelated jitter.
+    Keeps count of the retries and of the time spent waiting.
+    @param attempts <int>:
+        Maximum number of attempts of a single request
+    @param base <float>:
+        Shortest delay between attempts in seconds
+    @param cap <float>:
+        Longest delay between attempts in seconds
+    @param breaker <CircuitBreaker>:
+        Optional circuit breaker shared by every thread
+    @param transient <callable>:
+        Returns True when an exception is worth retrying
+    """
+    def __init__(self, attempts=5, base=1.0, cap=60.0, breaker=None, transient=None):
+        self.attempts = max(int(attempts), 1)
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker
+        self.transient = transient or (lambda e: True)
+        self.retries = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _waited(self, seconds, retry=False):
+        with self._lock:
+            self.waited += seconds
+            if retry:
+                self.retries += 1
+
+    def __call__(self, request, *args, **kwargs):
+        """Calls request(*args, **kwargs) until it succeeds or the attempts run out.
+        @return result:
+            Value returned by the request
+        """
+        delay = 0.0
+        for attempt in range(1, self.attempts + 1):
+            if self.breaker is not None:
+                self._waited(self.breaker.wait())
+            try:
+                result = request(*args, **kwargs)
+            except Exception as e:
+                if not self.transient(e):
+                    if self.breaker is not None:
+                        self.breaker.release()
+                    raise
+                if self.breaker is not None:
+                    self.breaker.failure()
+                if attempt == self.attempts:
+                    raise
+                delay = decorrelated_jitter(delay, self.base, self.cap)
+                time.sleep(delay)
+                self._waited(delay, retry=True)
+                continue
+            if self.breaker is not None:
+                self.breaker.success()
+            return result
+
+    def __str__(self):
+        trips = self.breaker.trips if self.breaker is not None else 0
+        return '{} retries, {:.1f} seconds waiting, circuit breaker opened {} times'.format(
+            self.retries, self.waited, trips)
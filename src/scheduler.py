@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""scheduler: size-aware ordering of data object uploads
+About:
+      Uploading files in directory order often leaves one worker pushing a very
+    large BAM file long after every other worker has gone idle. The scheduler
+    estimates how long each data object will take from its size, a per-connection
+    throughput and a fixed per-request overhead, then orders the uploads longest
+    processing time (LPT) first. Workers pull from that shared queue, so each
+    free worker always takes the longest remaining transfer.
+      Small files are interleaved between the large transfers, so requests keep
+    flowing while large files occupy the link, and the leftover small files fill
+    the gaps at the end of the run. The same order is simulated over the workers
+    to predict the makespan of the upload before it starts.
+      shards() splits the data objects into byte-balanced shards, one for each
+    task of a SLURM job array.
+"""
+
+from __future__ import print_function
+import heapq
+
+
+def hms(seconds):
+    """Formats a number of seconds as HH:MM:SS.
+    @param seconds <float>:
+        Duration in seconds
+    @return duration <str>:
+        Duration formatted as HH:MM:SS
+    """
+    seconds = int(round(seconds))
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+class Scheduler(object):
+    """Orders data objects for upload and predicts how long the upload will take.
+    @param workers <int>:
+        Number of concurrent uploads
+    @param throughput <float>:
+        Expected throughput of a single connection in bytes per second
+    @param overhead <float>:
+        Expected fixed cost of a single request in seconds
+    @param small <int>:
+        Data objects below this size in bytes are interleaved between large ones
+    @param multipart_threshold <int>:
+        Data objects of at least this size are uploaded in parts
+    @param part_threads <int>:
+        Number of parts of a multipart upload sent at the same time
+    """
+    def __init__(self, workers, throughput=52428800, overhead=0.2, small=67108864,
+                 multipart_threshold=5368709120, part_threads=4):
+        self.workers = max(int(workers), 1)
+        self.throughput = float(throughput)
+        self.overhead = float(overhead)
+        self.small = small
+        self.multipart_threshold = multipart_threshold
+        self.part_threads = max(int(part_threads), 1)
+
+    def cost(self, entry):
+        """Estimates the time it takes to upload a data object.
+        @param entry <dict>:
+            Data object listed by upload.manifest()
+        @return seconds <float>:
+            Estimated upload time in seconds
+        """
+        streams = self.part_threads if entry['size'] >= self.multipart_threshold else 1
+        return self.overhead + entry['size'] / (self.throughput * streams)
+
+    def order(self, entries):
+        """Orders data objects longest processing time first, with one small data
+        object interleaved after each large one.
+        @param entries <list[dict]>:
+            Data objects listed by upload.manifest()
+        @return ordered <list[dict]>:
+            Data objects in the order they should be handed to the workers
+        """
+        ranked = sorted(entries, key=lambda e: (-self.cost(e), e['path']))
+        large = [e for e in ranked if e['size'] >= self.small]
+        small = [e for e in ranked if e['size'] < self.small]
+
+        ordered = []
+        for i, entry in enumerate(large):
+            ordered.append(entry)
+            if i < len(small):
+                ordered.append(small[i])
+        ordered.extend(small[len(large):])
+
+        return ordered
+
+    def makespan(self, ordered):
+        """Simulates the workers pulling data objects from a shared queue.
+        @param ordered <list[dict]>:
+            Data objects in the order returned by order()
+        @return makespan <float>:
+            Predicted time until the last upload finishes in seconds
+        """
+        finish = [0.0] * self.workers
+        for entry in ordered:
+            start = heapq.heappop(finish)
+            heapq.heappush(finish, start + self.cost(entry))
+
+        return max(finish)
+
+    def lower_bound(self, entries):
+        """Returns the makespan no schedule can beat: the longest single transfer
+        or the total work spread perfectly evenly over the workers.
+        @param entries <list[dict]>:
+            Data objects listed by upload.manifest()
+        @return lower_bound <float>:
+            Lower bound of the makespan in seconds
+        """
+        costs = [self.cost(e) for e in entries] or [0.0]
+        return max(max(costs), sum(costs) / self.workers)
+
+    def report(self, ordered):
+        """Returns a one line summary of the predicted upload time.
+        @param ordered <list[dict]>:
+            Data objects in the order returned by order()
+        @return summary <str>:
+            Predicted makespan of the upload
+        """
+        size = sum(e['size'] for e in ordered)
+        return 'Scheduled {} data objects ({:.2f} GB) over {} workers, predicted makespan {} (lower bound {})'.format(
+            len(ordered), size / 1024.0**3, self.workers, hms(self.makespan(ordered)), hms(self.lower_bound(ordered)))
+
+
+def shards(entries, n):
+    """Splits data objects into n shards of nearly equal total size. Objects are
+    assigned largest first to the shard with the fewest bytes so far. The split
+    only depends on the paths and sizes of the objects, so every task of a job
+    array computes the same shards from the same upload hierarchy.
+    @param entries <list[dict]>:
+        Data objects listed by upload.manifest()
+    @param n <int>:
+        Number of shards
+    @return shards <list[list[dict]]>:
+        Data objects of each shard
+    """
+    n = max(int(n), 1)
+    split = [[] for _ in range(n)]
+    loads = [(0, i) for i in range(n)]
+    for entry in sorted(entries, key=lambda e: (-e['size'], e['path'])):
+        size, i = heapq.heappop(loads)
+        split[i].append(entry)
+        heapq.heappush(loads, (size + entry['size'], i))
+
+    return split
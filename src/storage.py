@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""storage: storage backends that upload.py can push an upload hierarchy into
+About:
+      The upload stage only needs three operations from the storage it pushes
+    into: register a collection with its metadata, store a data object with its
+    metadata in a single request, and store a large data object in concurrent
+    parts. dme_utils.StorageBackend lists them. HPC DME is one backend (dme_utils.DMESession),
+    and an S3-compatible object store (i.e. an on-prem object store, or MinIO)
+    is another (S3Session), so a project can be staged at full link speed
+    before it is archived.
+      S3 has no collections: the hierarchy maps to object keys, where the DME
+    path '/CCBR_Archive/PI_Lab_X/Project_Y/file.bam' becomes the key
+    'CCBR_Archive/PI_Lab_X/Project_Y/file.bam' of the bucket (under an optional
+    prefix). The metadata of each collection and data object is written as a
+    '<key>.metadata.json' sidecar object, with the same contents as in the local
+    upload hierarchy. meta writes up to 13 attributes per data object and S3
+    allows 10 tags per object, so in tags mode the data objects are also tagged
+    with a fixed subset of their attributes (TAGGED), i.e. for the lifecycle
+    rules and access policies of the bucket. Requests are signed with AWS
+    Signature Version 4, and large data objects are sent with concurrent
+    multipart uploads, each part retried on its own.
+"""
+
+from __future__ import print_function
+import os, re, json, time, hmac, hashlib, logging
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode, urlparse, parse_qsl
+
+# Local imports
+from dme_utils import DMEError, FilePart, StorageBackend, http_session
+from retry import decorrelated_jitter
+
+# Backends upload.py can push into
+BACKENDS = ('dme', 's3')
+
+# Payload hash of requests whose body is streamed from a file
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+# Limits of S3 object tags
+MAX_TAGS, MAX_TAG_KEY, MAX_TAG_VALUE = 10, 128, 256
+TAG_CHARACTERS = re.compile(r'^[\w\s+\-=.:/@]*$')
+
+# Attributes of a data object that are also written as its tags, at most MAX_TAGS:
+# its checksum, what it is and the analysis it comes from, and how it is handled
+TAGGED = ('md5_checksum', 'file_type', 'sample_name', 'md5_all_inputs_serial', 'phi_content', 'pii_content',
+          'data_encryption_status', 'data_compression_status', 'analysis_team')
+
+# Smallest part of an S3 multipart upload, except for the last one
+MIN_PART_SIZE = 5242880
+
+
+class S3Error(DMEError):
+    """Raised when an S3 request does not return a successful response code. It is
+    a DMEError, so the retry policy of upload.py treats both backends the same."""
+
+
+def signing_key(secret_key, date, region, service='s3'):
+    """Derives the AWS Signature Version 4 key of a day, region and service."""
+    key = ('AWS4' + secret_key).encode()
+    for value in (date, region, service, 'aws4_request'):
+        key = hmac.new(key, value.encode(), hashlib.sha256).digest()
+    return key
+
+
+def sign(method, url, headers, access_key, secret_key, region, payload_hash, timestamp=None, service='s3'):
+    """Signs a request with AWS Signature Version 4.
+    @param method <str>:
+        HTTP method of the request
+    @param url <str>:
+        URL of the request, with its path already percent-encoded
+    @param headers <dict>:
+        Headers to sign along with host, x-amz-date and x-amz-content-sha256
+    @param payload_hash <str>:
+        SHA256 of the body in hex, or UNSIGNED-PAYLOAD for a streamed body
+    @param timestamp <float>:
+        Time of the request in seconds since the epoch, defaults to now
+    @return headers <dict>:
+        Headers of the request, including the Authorization header
+    """
+    parsed = urlparse(url)
+    amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(timestamp))
+    signed = dict((k.lower(), str(v).strip()) for k, v in headers.items())
+    signed['host'] = parsed.netloc
+    signed['x-amz-date'] = amz_date
+    signed['x-amz-content-sha256'] = payload_hash
+
+    query = sorted((quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+                   for k, v in parse_qsl(parsed.query, keep_blank_values=True))
+    names = sorted(signed)
+    canonical = '\n'.join([
+        method,
+        parsed.path or '/',
+        '&'.join('{}={}'.format(k, v) for k, v in query),
+        ''.join('{}:{}\n'.format(name, signed[name]) for name in names),
+        ';'.join(names),
+        payload_hash
+    ])
+    scope = '{}/{}/{}/aws4_request'.format(amz_date[:8], region, service)
+    to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+    signature = hmac.new(signing_key(secret_key, amz_date[:8], region, service), to_sign.encode(),
+                         hashlib.sha256).hexdigest()
+
+    signed['authorization'] = 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+        access_key, scope, ';'.join(names), signature)
+    return signed
+
+
+def tags(metadata):
+    """Converts the attributes of TAGGED found in metadata into S3 object tags.
+    A value S3 does not allow in a tag (too long, or with other characters than
+    letters, digits, spaces and + - = . _ : / @) is left out, the sidecar has it.
+    @param metadata <dict>:
+        Metadata as written by meta, i.e. {"metadataEntries": [...]}
+    @return tagging <str>:
+        URL-encoded tag set for the x-amz-tagging header, empty when none of
+        the attributes can be tagged
+    """
+    values = dict((p['attribute'], str(p['value'])) for p in metadata.get('metadataEntries', []))
+    pairs = [(key, values[key]) for key in TAGGED if key in values]
+    pairs = [(key, value) for key, value in pairs if len(key) <= MAX_TAG_KEY and len(value) <= MAX_TAG_VALUE
+             and TAG_CHARACTERS.match(value)]
+    return urlencode(pairs[:MAX_TAGS], quote_via=quote)
+
+
+class S3Session(StorageBackend):
+    """Pushes collections and data objects into a bucket of an S3-compatible
+    object store. Credentials default to $AWS_ACCESS_KEY_ID and
+    $AWS_SECRET_ACCESS_KEY, so they are not given on the command line.
+    @param endpoint <str>:
+        URL of the object store (i.e. https://s3.example.org)
+    @param bucket <str>:
+        Bucket to push the data into, it must exist
+    @param region <str>:
+        Region the requests are signed for
+    @param prefix <str>:
+        Optional key prefix of every object
+    @param metadata <str>:
+        'sidecar' to write metadata as '<key>.metadata.json' objects, or 'tags'
+        to also tag data objects with the attributes of TAGGED (the sidecar is
+        always written)
+    @param pool_size <int>:
+        Number of connections kept alive, see dme_utils.http_session()
+    @param timeout <tuple>:
+        Connect and read timeouts of each request in seconds
+    @param retries <int>:
+        Number of transport-level retries of a request
+    """
+    def __init__(self, endpoint, bucket, region='us-east-1', prefix='', metadata='sidecar',
+                 access_key=None, secret_key=None, pool_size=16, timeout=(10, 300), retries=3):
+        if metadata not in ('sidecar', 'tags'):
+            raise ValueError('Unknown S3 metadata mode: {}'.format(metadata))
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.region = region
+        self.prefix = prefix.strip('/')
+        self.metadata = metadata
+        self.access_key = access_key if access_key is not None else os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secret_key = secret_key if secret_key is not None else os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        if not self.access_key or not self.secret_key:
+            raise ValueError('S3 credentials not found, set AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY')
+        self.rate_limiter = None
+        self.timeout = timeout
+        self.http = http_session(pool_size, retries)
+
+    def close(self):
+        """Closes the connections kept alive by the session."""
+        self.http.close()
+
+    def key(self, path):
+        """Returns the object key of a DME path."""
+        key = path.strip('/')
+        return '{}/{}'.format(self.prefix, key) if self.prefix else key
+
+    def _url(self, key, query=None):
+        url = '{}/{}/{}'.format(self.endpoint, quote(self.bucket, safe=''), quote(key, safe='/-_.~'))
+        if query:
+            url += '?' + urlencode(query, quote_via=quote)
+        return url
+
+    def _request(self, method, key, path, query=None, headers=None, body=b'', payload_hash=None):
+        """Sends a signed request and raises an S3Error unless it succeeded."""
+        url = self._url(key, query)
+        if payload_hash is None:
+            payload_hash = hashlib.sha256(body).hexdigest()
+        signed = sign(method, url, headers or {}, self.access_key, self.secret_key, self.region, payload_hash)
+        response = self.http.request(method, url, headers=signed, data=body, timeout=self.timeout)
+        if response.status_code not in (200, 204):
+            raise S3Error(response.status_code, response.text, path)
+        return response
+
+    def _sidecar(self, path, metadata):
+        body = json.dumps(metadata, indent=4).encode()
+        self._request('PUT', self.key(path) + '.metadata.json', path, body=body,
+                      headers={'Content-Type': 'application/json'})
+
+    def _tagging(self, metadata):
+        """Returns the x-amz-tagging header of a data object, None in sidecar
+        mode or when none of its attributes can be tagged."""
+        if self.metadata != 'tags':
+            return None
+        tagging = tags(metadata)
+        return {'x-amz-tagging': tagging} if tagging else None
+
+    def register_collection(self, collection_path, metadata):
+        """
+            Writes the metadata of a collection as a sidecar object, S3 has no
+            collections to create
+        """
+        self._sidecar(collection_path, metadata)
+        return 200
+
+    def register_dataobject(self, data_object_path, source_file, metadata, blocksize=1048576, fileobj=None):
+        """
+            Stores a data object with a single request, streaming it from disk
+            or from fileobj, then writes its metadata as a sidecar
+        """
+        tagging = self._tagging(metadata)
+        body = fileobj
+        if body is None:
+            body = FilePart(source_file, 0, os.path.getsize(source_file), blocksize, limiter=self.rate_limiter)
+        try:
+            self._request('PUT', self.key(data_object_path), data_object_path, headers=tagging or {}, body=body,
+                          payload_hash=UNSIGNED_PAYLOAD)
+        finally:
+            # Readers of a Tee are closed by their owner
+            if fileobj is None:
+                body.close()
+        self._sidecar(data_object_path, metadata)
+        return 200
+
+    def register_dataobject_multipart(self, data_object_path, source_file, metadata, part_size=536870912,
+                                      threads=4, retries=3, blocksize=1048576):
+        """
+            Stores a data object with an S3 multipart upload: the parts are
+            uploaded concurrently and each part is retried on its own. The
+            upload is aborted if it cannot be completed, so no orphaned parts
+            are left in the bucket.
+        """
+        size = os.path.getsize(source_file)
+        part_size = max(part_size, -(-size // 10000), MIN_PART_SIZE)
+        nparts = max(-(-size // part_size), 1)
+        key = self.key(data_object_path)
+        tagging = self._tagging(metadata)
+
+        created = self._request('POST', key, data_object_path, query=[('uploads', '')],
+                                headers=tagging or {})
+        upload_id = _find(created.text, 'UploadId')
+        if not upload_id:
+            raise S3Error(created.status_code, 'No UploadId in response: {}'.format(created.text), data_object_path)
+
+        def send(number):
+            offset = (number - 1) * part_size
+            etag = self._upload_part(key, data_object_path, upload_id, number, source_file, offset,
+                                     min(part_size, size - offset), retries, blocksize)
+            return number, etag
+
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                etags = list(pool.map(send, range(1, nparts + 1)))
+            completion = ''.join('<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag></Part>'.format(n, e)
+                                 for n, e in etags)
+            completed = self._request('POST', key, data_object_path, query=[('uploadId', upload_id)],
+                                      body='<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(
+                                          completion).encode())
+            # S3 can report a failed completion in the body of a 200 response
+            if _find(completed.text, 'Code'):
+                raise S3Error(500, completed.text, data_object_path)
+        except Exception:
+            try:
+                self._request('DELETE', key, data_object_path, query=[('uploadId', upload_id)])
+            except Exception as e:
+                logging.warning("Failed to abort multipart upload of {0}: {1}".format(data_object_path, e))
+            raise
+        self._sidecar(data_object_path, metadata)
+        return 200
+
+    def _upload_part(self, key, path, upload_id, number, source_file, offset, length, retries=3, blocksize=1048576):
+        """
+            Streams a byte range of a local file as one part of a multipart
+            upload and returns its ETag. Failed attempts are retried after a
+            back-off with decorrelated jitter (see retry.py).
+        """
+        import requests
+        attempt, delay = 0, 0.0
+        while True:
+            part = FilePart(source_file, offset, length, blocksize, limiter=self.rate_limiter)
+            try:
+                response = self._request('PUT', key, path, query=[('partNumber', str(number)), ('uploadId', upload_id)],
+                                         body=part, payload_hash=UNSIGNED_PAYLOAD)
+                return response.headers.get('ETag', '').strip('"')
+            except (S3Error, requests.exceptions.RequestException) as e:
+                error = e
+            finally:
+                part.close()
+            attempt += 1
+            if attempt > retries:
+                raise error
+            logging.warning("Retrying part {0} of {1} ({2}/{3}): {4}".format(number, source_file, attempt, retries, error))
+            delay = decorrelated_jitter(delay, base=2.0, cap=120.0)
+            time.sleep(delay)
+
+
+def _find(document, tag):
+    """Returns the text of the first element of an S3 XML response with this tag."""
+    try:
+        root = ElementTree.fromstring(document)
+    except ElementTree.ParseError:
+        return None
+    for element in root.iter():
+        if element.tag == tag or element.tag.endswith('}' + tag):
+            return element.text
+    return None
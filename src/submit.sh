@@ -7,6 +7,13 @@ set -eu
 # @INPUT $1 = DME base directory for all intermediate output files (i.e. ${INPUT_DIRECTORY)/DME)
 # @INPUT $2 = Path to local git installation of DME CLU toolkit
 # @INPUT $3 = DME Vault to push data (i.e. /CCBR_Archive or /CCBR_EXT_Archive)
+# @INPUT $4 = PATH to pyrkit/src/upload.py program (Optional, uses dm_register_directory if not provided)
+# @INPUT $5+ = Options passed to upload.py (Optional, i.e. --threads 8 --shards 4 --adaptive).
+#              When submitted as a job array (sbatch --array=0-N), each array task uploads
+#              shard $SLURM_ARRAY_TASK_ID
+# upload.py stops starting new data objects before the time limit of the job and exits
+# with code 3 when work is left. The job then submits itself again, with the same
+# resources, to upload the remainder (at most $PYRKIT_MAX_REQUEUES times, default 10).
 
 # Goto upload/ location which contains files and metadata to upload
 cd "${1}"
@@ -17,6 +24,27 @@ source "$HPC_DM_UTILS/functions"
 
 # Reformat Vault Name
 VAULT="/${3#/}"
-dm_register_directory -s -t ${SLURM_CPUS_PER_TASK:-4} -e <(echo '**.metadata.json') upload "${VAULT}"
+if [[ -n "${4:-}" ]]; then
+  status=0
+  python "${4}" "${1}" "${VAULT}" "${@:5}" --shard-index "${SLURM_ARRAY_TASK_ID:-0}" || status=$?
+  requeues="${PYRKIT_REQUEUES:-0}"
+  if [ "${status}" -eq 3 ] && [ "${requeues}" -lt "${PYRKIT_MAX_REQUEUES:-10}" ]; then
+    # Resubmit this script with the resources of the current job, the upload
+    # journal tells the next job what is left
+    script=$(scontrol show job "${SLURM_JOB_ID}" | grep -oP 'Command=\K\S+' || echo "${0}")
+    limit=$(squeue -h -j "${SLURM_JOB_ID}" -o %l)
+    array_option=""
+    if [ -n "${SLURM_ARRAY_TASK_ID:-}" ]; then array_option="--array=${SLURM_ARRAY_TASK_ID}"; fi
+    jobid=$(sbatch --parsable -J "${SLURM_JOB_NAME:-pyrkit}" --time="${limit}" \
+      --mem="${SLURM_MEM_PER_NODE:-24576}M" --cpus-per-task="${SLURM_CPUS_PER_TASK:-4}" ${array_option} \
+      --export=ALL,PYRKIT_REQUEUES=$(( requeues + 1 )) "${script}" "$@")
+    echo "Time limit reached, submitted job ${jobid} to upload the remainder"
+    status=0
+  fi
+  echo "Exit status of upload: ${status}"
+  exit "${status}"
+else
+  dm_register_directory -s -t ${SLURM_CPUS_PER_TASK:-4} -e <(echo '**.metadata.json') upload "${VAULT}"
+fi
 
 echo "Exit status of upload: $?"
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""throttle: adaptive concurrency and bandwidth limits for uploads into HPC DME
+About:
+      A fixed number of upload threads either underuses DME when it is quiet or
+    gets requests throttled and timed out when it is busy. AIMDController adapts
+    the number of requests in flight the way TCP adapts its congestion window:
+    every successful request raises the limit additively (by about one request
+    per round of requests), while a 429 or 5xx response, a connection error or
+    a latency spike cuts it multiplicatively. Latency is normalized per MB, and
+    a spike is a request that took several times longer than the running
+    average. At most one cut is made per round of requests, so a burst of
+    errors from one overloaded moment does not collapse the limit to 1.
+      RateLimiter is a token bucket that caps the bytes per second read from
+    disk by upload request bodies, so an archive job can share a node's link
+    with running pipelines.
+"""
+
+from __future__ import print_function
+import time, threading
+
+
+class AIMDController(object):
+    """Additive-increase/multiplicative-decrease limit on concurrent requests.
+    Workers call acquire() before a request and release() after it.
+    @param initial <int>:
+        Starting number of concurrent requests
+    @param minimum <int>:
+        Lowest number of concurrent requests
+    @param maximum <int>:
+        Highest number of concurrent requests
+    @param decrease <float>:
+        Factor applied to the limit when congestion is detected
+    @param spike <float>:
+        A request slower than spike times the average latency per MB is
+        treated as congestion
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease=0.5, spike=3.0):
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease = decrease
+        self.spike = spike
+        self.active = 0
+        self.average = None
+        self.increases = 0
+        self.decreases = 0
+        self._last_cut = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Blocks until a request may start.
+        @return started <float>:
+            Start time of the request, to be passed back to release()
+        """
+        with self._condition:
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+            return time.time()
+
+    def release(self, started, size=0, status_code=None, failed=False):
+        """Records the outcome of a request and adjusts the limit.
+        @param started <float>:
+            Start time returned by acquire()
+        @param size <int>:
+            Number of bytes sent by the request
+        @param status_code <int>:
+            Response code of a failed request, None if it succeeded
+        @param failed <bool>:
+            True when the request failed without a response (i.e. timeout)
+        """
+        elapsed = time.time() - started
+        per_mb = elapsed / max(size / 1048576.0, 1.0)
+        with self._condition:
+            self.active -= 1
+            congested = failed or status_code == 429 or (status_code is not None and status_code >= 500)
+            if status_code is None and not failed:
+                if self.average is not None and per_mb > self.spike * self.average:
+                    congested = True
+                self.average = per_mb if self.average is None else 0.9 * self.average + 0.1 * per_mb
+            if congested:
+                # Only cut once per round, i.e. ignore requests started before the last cut
+                if started >= self._last_cut:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_cut = time.time()
+                    self.decreases += 1
+            elif status_code is None:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self.increases += 1
+            self._condition.notify_all()
+
+    def __str__(self):
+        return 'concurrency {:.1f} (range {}-{}), {} increases, {} decreases'.format(
+            self.limit, self.minimum, self.maximum, self.increases, self.decreases)
+
+
+class RateLimiter(object):
+    """Token bucket limiting the number of bytes per second read by request bodies.
+    Shared by every thread of an upload.
+    @param rate <float>:
+        Maximum bytes per second
+    @param burst <float>:
+        Maximum number of bytes that can be read at once, defaults to one second
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Blocks until nbytes may be sent.
+        @param nbytes <int>:
+            Number of bytes about to be sent
+        """
+        while nbytes > 0:
+            amount = min(nbytes, self.burst)
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    nbytes -= amount
+                    continue
+                wait = (amount - self._tokens) / self.rate
+            time.sleep(wait)
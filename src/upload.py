@@ -0,0 +1,1190 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""upload: pushes a local upload hierarchy into object storage in HPC DME
+About:
+      This program registers the collections and data objects of the mock DME
+    hierarchy that pyrkit builds in '<dme_base_directory>/upload'. Each directory
+    is registered as a collection and each file as a data object, using the
+    '<name>.metadata.json' file that sits next to it as its metadata. Requests
+    are sent directly to the HPC DME REST API from a pool of worker threads, so
+    the number of concurrent transfers does not depend on the DME command line
+    toolkit. File contents are streamed from disk while they are uploaded. Each
+    collection or data object is sent as soon as its parent collection exists,
+    without waiting for the rest of its level of the hierarchy.
+      Data objects larger than --multipart-threshold are split into parts that
+    are uploaded concurrently to presigned URLs provided by DME, so a single
+    large BAM or FastQ file does not hold up one worker for hours.
+      Data objects are handed to the workers largest first, with small files
+    interleaved, and the predicted makespan is reported before the upload starts
+    (see scheduler.py). The throughput achieved by each upload is recorded in a
+    history (see history.py) that later predictions are based on.
+      With --adaptive, the number of concurrent requests follows how DME responds
+    instead of staying at --threads (see throttle.py), and --max-rate caps the
+    total bandwidth of the upload.
+      A request that fails with a transient error (a timeout, a throttled or a
+    server error response) is retried on its own with jittered backoff, and a
+    circuit breaker pauses new requests while DME keeps failing (see retry.py).
+      With --shards, the data objects are split into byte-balanced shards and
+    only the shard given by --shard-index (or $SLURM_ARRAY_TASK_ID) is uploaded,
+    along with the collections that contain it. Each task of a SLURM job array
+    uploads one shard, and all of them share the upload journal, which --status
+    summarizes per shard.
+      With --sync, the checksums of the data objects already in DME are fetched
+    in bulk, with paged metadata queries of the project, and compared with the md5_checksum generated by meta, so re-archiving
+    a project only uploads new or changed data objects.
+      With --bulk, small data objects are registered in batches with a single
+    bulk registration request each, sized by --bulk (objects) and --bulk-size
+    (bytes). DME reads their contents from the file system it shares with the
+    cluster, and the items it reports as failed are registered again one at a
+    time.
+      With --dedup, a data object whose contents are already stored anywhere in
+    the vault is registered as a reference to that copy (see dedup.py).
+      Inside a SLURM job, data objects that would not finish before the job's
+    time limit are not started (see budget.py). The transfers in flight are
+    drained and the program exits with code 3, so submit.sh can submit the job
+    again for the remainder.
+      With --mirror, the same hierarchy is also pushed into other vaults. Each
+    file is read once and streamed to every vault at the same time, with the
+    metadata each vault requires, and progress is reported per vault.
+      With --backend s3, the hierarchy is pushed into a bucket of an S3-compatible
+    object store instead of DME, i.e. to stage a project on an on-prem object
+    store (see storage.py). Large files are sent with concurrent multipart
+    uploads and the metadata is written as sidecar objects, some of it also as
+    object tags.
+      Every confirmed registration is recorded in an upload journal (see
+    journal.py). When an upload is run again, for example after a SLURM job hit
+    its time limit, entries already in the journal are skipped.
+USAGE:
+	$ upload.py <dme_base_directory> <dme_vault> [OPTIONS]
+Example:
+    $ upload.py /scratch/ccbr123/RNA_hg38/DME /CCBR_Archive --threads 8
+"""
+
+from __future__ import print_function
+import sys, os, json, time, heapq, hashlib, resource, threading
+
+# Local imports
+import dme_utils as dme
+from journal import Journal
+from scheduler import Scheduler, shards
+from throttle import AIMDController, RateLimiter
+from retry import Retry, CircuitBreaker
+from dedup import DedupIndex, content_checksum
+from history import History
+from budget import TimeBudget, job_end_time, EXIT_REQUEUE
+from initialize import vault_metadata
+from storage import BACKENDS, S3Session
+
+
+def err(*message, **kwargs):
+    """Prints any provided args to standard error.
+    kwargs can be provided to modify print functions
+    behavior.
+    @param message <any>:
+        Values printed to standard error
+    @params kwargs <print()>
+        Key words to modify print function behavior
+    """
+    print(*message, file=sys.stderr, **kwargs)
+
+
+def load_metadata(filename):
+    """Reads the metadata JSON file of a collection or data object.
+    @param filename <str>:
+        Metadata JSON file generated by initialize.py or meta
+    @return metadata <dict>:
+        Metadata in the format expected by DME, i.e. {"metadataEntries": [...]}
+    """
+    if not filename or not os.path.exists(filename):
+        return {"metadataEntries": []}
+    with open(filename, 'r') as fh:
+        metadata = json.load(fh)
+
+    return metadata
+
+
+def entry_metadata(entry):
+    """Reads the metadata of an entry, in the variant required by its vault when
+    the entry was copied into another vault by mirror().
+    @param entry <dict>:
+        Collection or data object listed by manifest()
+    @return metadata <dict>:
+        Metadata in the format expected by DME, i.e. {"metadataEntries": [...]}
+    """
+    metadata = load_metadata(entry['metadata'])
+    if 'vault' in entry:
+        metadata = vault_metadata(metadata, entry['vault'])
+    return metadata
+
+
+def fingerprint(entry, metadata):
+    """Returns the checksum recorded in the upload journal for an entry. For data
+    objects this is the md5_checksum attribute generated by meta, for collections
+    it is the MD5 of their metadata, so changed metadata is registered again.
+    @param entry <dict>:
+        Collection or data object listed by manifest()
+    @param metadata <dict>:
+        Metadata of the entry, see load_metadata()
+    @return checksum <str>:
+        Checksum of the entry
+    """
+    if entry['type'] == 'dataObject':
+        for pair in metadata['metadataEntries']:
+            if pair['attribute'] == 'md5_checksum':
+                return pair['value']
+    return hashlib.md5(json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+
+
+def transient(error):
+    """Checks if a failed request is worth retrying: timeouts, connection errors,
+    throttled requests and server errors are, while rejected requests and local
+    files that cannot be read are not.
+    @param error <Exception>:
+        Exception raised by the request
+    @return is_transient <bool>:
+        True when the request should be retried
+    """
+    if isinstance(error, dme.DMEError):
+        return error.status_code in (408, 429) or error.status_code >= 500
+    if isinstance(error, (FileNotFoundError, PermissionError, IsADirectoryError)):
+        return False
+    return isinstance(error, IOError)
+
+
+def manifest(upload_directory, vault):
+    """Walks the local upload hierarchy and lists the collections and data objects
+    to register in DME. A collection is always listed before anything it contains.
+    @param upload_directory <str>:
+        Local mock DME hierarchy (i.e. DME/upload)
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @return entries <list[dict]>:
+        Collections and data objects to register, each entry has the keys:
+        type ('collection' or 'dataObject'), local, path, metadata and size
+    """
+    vault = '/' + vault.strip('/')
+    upload_directory = os.path.abspath(upload_directory)
+    entries = []
+
+    for root, dirs, files in os.walk(upload_directory):
+        dirs.sort()
+        relative = os.path.relpath(root, upload_directory)
+        dme_root = vault if relative == os.curdir else '{}/{}'.format(vault, relative.replace(os.sep, '/'))
+        for d in dirs:
+            entries.append({
+                'type': 'collection',
+                'local': os.path.join(root, d),
+                'path': '{}/{}'.format(dme_root, d),
+                'metadata': os.path.join(root, '{}.metadata.json'.format(d)),
+                'size': 0
+            })
+        for f in sorted(files):
+            if f.endswith('.metadata.json'):
+                continue
+            local = os.path.join(root, f)
+            entries.append({
+                'type': 'dataObject',
+                'local': local,
+                'path': '{}/{}'.format(dme_root, f),
+                'metadata': '{}.metadata.json'.format(local),
+                'size': os.stat(local).st_size
+            })
+
+    return entries
+
+
+class Batch(list):
+    """Small data objects registered together with one bulk registration request."""
+
+
+class Uploader(object):
+    """Registers collections and data objects in DME over a pool of worker threads.
+    DME requires a parent collection to exist before anything can be added to it,
+    so each entry is started as soon as its parent collection is confirmed. A
+    failed entry does not stop the run, but anything inside a failed collection
+    is skipped. When a journal is provided, entries it already confirms are
+    skipped and new ones are recorded.
+    Data objects of at least multipart_threshold bytes are uploaded in parts of
+    part_size bytes, with up to part_threads parts in flight per object. When a
+    scheduler is provided, it decides the order data objects are uploaded in.
+    When a controller is provided (see throttle.AIMDController), the pool holds
+    controller.maximum threads and the controller decides how many of them may
+    send a request at any time. When a retry policy is provided (see retry.Retry),
+    each registration request is retried on its own. When a dedup index is
+    provided (see dedup.DedupIndex), data objects whose contents are already in
+    the vault are registered as references. When a time budget is provided (see
+    budget.TimeBudget), entries that would not finish before the end of the
+    job are deferred instead of started.
+    The session is the storage backend the entries are pushed into (see
+    dme_utils.StorageBackend): a dme_utils.DMESession, or a storage.S3Session.
+    Entries copied into several vaults by mirror() keep separate statistics for
+    each vault, and the copies of a data object are sent together from a single
+    read of the file (see dme_utils.Tee).
+    Entries of several projects uploaded together by batch.py carry a project
+    key: each project keeps its own statistics and, when journals are provided,
+    its own upload journal.
+    When bulk_count is above 1, data objects of at most bulk_max_size bytes are
+    registered in batches of up to bulk_count objects and bulk_bytes bytes, one
+    bulk registration request per batch (see Batch). Items of a batch that DME
+    reports as failed are registered again on their own.
+    """
+    def __init__(self, session, threads=4, blocksize=1048576, journal=None,
+                 multipart_threshold=5368709120, part_size=536870912, part_threads=4, scheduler=None,
+                 controller=None, retry=None, index=None, budget=None, journals=None,
+                 bulk_count=0, bulk_bytes=268435456, bulk_max_size=16777216):
+        self.session = session
+        self.bulk_count = bulk_count
+        self.bulk_bytes = bulk_bytes
+        self.bulk_max_size = bulk_max_size
+        self.budget = budget
+        self.index = index
+        self.retry = retry
+        self.scheduler = scheduler
+        self.controller = controller
+        self.threads = controller.maximum if controller is not None else threads
+        self.blocksize = blocksize
+        self.journal = journal
+        self.journals = journals or {}
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_threads = part_threads
+        self.failed = []
+        self.deferred = []
+        self.stats = {'collections': 0, 'dataObjects': 0, 'bytes': 0, 'skipped': 0, 'failed': 0, 'references': 0,
+                      'deferred': 0, 'bulk': 0,
+                      'retries': 0, 'waited': 0.0, 'elapsed': 0.0}
+        self.vault_stats = {}
+        self.project_stats = {}
+        self._lock = threading.Lock()
+        self._failed_collections = set()
+        self._deferred_collections = set()
+
+    def snapshot(self):
+        """Returns a copy of the statistics while the upload is running, i.e. to
+        report its progress from another thread.
+        @return stats <dict>:
+            Copies of stats, vault_stats and project_stats, under those keys
+        """
+        with self._lock:
+            return {'stats': dict(self.stats),
+                    'vault_stats': dict((k, dict(v)) for k, v in self.vault_stats.items()),
+                    'project_stats': dict((k, dict(v)) for k, v in self.project_stats.items())}
+
+    def register(self, entry, metadata, fileobj=None):
+        """Registers a single collection or data object in DME. When a dedup index
+        is provided and the contents of a data object are already in the vault,
+        it is registered as a reference to the canonical copy instead.
+        @param entry <dict>:
+            Collection or data object listed by manifest()
+        @param metadata <dict>:
+            Metadata of the entry, see load_metadata()
+        @param fileobj <TeeReader>:
+            Optional reader of the contents of the data object, only used if
+            nothing was read from it yet (i.e. not on a retry)
+        @return is_reference <bool>:
+            True when the data object was registered as a reference
+        """
+        checksum = None
+        if self.index is not None and entry['type'] == 'dataObject':
+            checksum = content_checksum(metadata)
+            canonical = self.index.lookup(checksum, entry['size'])
+            # References cannot point into another vault
+            if canonical is not None and canonical != entry['path'] \
+                    and canonical.startswith(entry.get('vault', '') + '/'):
+                try:
+                    self.session.register_reference(entry['path'], canonical, metadata)
+                    return True
+                except dme.DMEError as e:
+                    if e.status_code != 404:
+                        raise
+                    # The canonical copy was removed from DME, upload the contents again
+                    self.index.discard(checksum, entry['size'])
+        self._transfer(entry, metadata, fileobj)
+        if checksum is not None:
+            self.index.add(checksum, entry['size'], entry['path'])
+        return False
+
+    def _transfer(self, entry, metadata, fileobj=None):
+        return self._throttled(entry['size'], self._send, entry, metadata, fileobj)
+
+    def _throttled(self, size, request, *args):
+        """Sends a request of size bytes once the controller allows it."""
+        if self.controller is None:
+            return request(*args)
+        started = self.controller.acquire()
+        try:
+            result = request(*args)
+        except dme.DMEError as e:
+            self.controller.release(started, size, status_code=e.status_code)
+            raise
+        except IOError:
+            self.controller.release(started, size, failed=True)
+            raise
+        except Exception:
+            self.controller.release(started, size, status_code=0)
+            raise
+        self.controller.release(started, size)
+        return result
+
+    def _send(self, entry, metadata, fileobj=None):
+        if entry['type'] == 'collection':
+            self.session.register_collection(entry['path'], metadata)
+        elif entry['size'] >= self.multipart_threshold:
+            self.session.register_dataobject_multipart(entry['path'], entry['local'], metadata,
+                part_size=self.part_size, threads=self.part_threads, blocksize=self.blocksize)
+        elif fileobj is not None and not fileobj.consumed:
+            self.session.register_dataobject(entry['path'], entry['local'], metadata, blocksize=self.blocksize,
+                                             fileobj=fileobj)
+        else:
+            self.session.register_dataobject(entry['path'], entry['local'], metadata, blocksize=self.blocksize)
+
+    def _blocked(self, entry, collections=None):
+        """Checks if an entry lives inside a collection that failed to register."""
+        collections = self._failed_collections if collections is None else collections
+        parent = os.path.dirname(entry['path'])
+        while parent not in ('/', ''):
+            if parent in collections:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    def _out_of_time(self, entry):
+        """Checks if an entry would not finish before the end of the job."""
+        if self.budget is None:
+            return False
+        if self._blocked(entry, self._deferred_collections):
+            return True
+        if entry['type'] == 'collection':
+            return self.budget.remaining() <= 0
+        if self.scheduler is not None:
+            seconds = self.scheduler.cost(entry)
+        else:
+            seconds = 1.0 + entry['size'] / 10485760.0
+        return not self.budget.allows(seconds)
+
+    def _count(self, entry, key, amount=1):
+        """Adds to a statistic of the upload, and of the vault of a mirrored entry
+        or the project of a batch entry. Must be called with the lock held."""
+        self.stats[key] += amount
+        for field, groups in (('vault', self.vault_stats), ('project', self.project_stats)):
+            if field in entry:
+                if entry[field] not in groups:
+                    groups[entry[field]] = dict((k, 0) for k in self.stats)
+                groups[entry[field]][key] += amount
+
+    def _journal(self, entry):
+        """Returns the upload journal of an entry."""
+        return self.journals.get(entry.get('project'), self.journal)
+
+    def _defer(self, entry):
+        with self._lock:
+            self.deferred.append(entry)
+            self._count(entry, 'deferred')
+            if entry['type'] == 'collection':
+                self._deferred_collections.add(entry['path'])
+        print('Deferring {} {} (not enough time left in the job)'.format(entry['type'], entry['path']))
+
+    def _fail(self, entry, reason):
+        with self._lock:
+            self.failed.append((entry, reason))
+            self._count(entry, 'failed')
+            if entry['type'] == 'collection':
+                self._failed_collections.add(entry['path'])
+        err('Failed to register {}: {}'.format(entry['path'], reason))
+
+    def _prepare(self, entry):
+        """Loads the metadata of an entry and checks if it needs to be sent.
+        @return prepared <tuple>:
+            (metadata, checksum) of the entry, or None when it was skipped,
+            deferred or failed
+        """
+        if self._blocked(entry):
+            self._fail(entry, 'parent collection was not registered')
+            return None
+        try:
+            metadata = entry_metadata(entry)
+            checksum = fingerprint(entry, metadata)
+            journal = self._journal(entry)
+            if journal is not None and journal.confirmed(entry['path'], entry['size'], checksum):
+                with self._lock:
+                    self._count(entry, 'skipped')
+                return None
+        except (IOError, ValueError) as e:
+            self._fail(entry, e)
+            return None
+        if self._out_of_time(entry):
+            self._defer(entry)
+            return None
+        return metadata, checksum
+
+    def _complete(self, entry, metadata, checksum, fileobj=None):
+        """Sends an entry prepared by _prepare() and records it in the journal."""
+        try:
+            if self.retry is not None:
+                reference = self.retry(self.register, entry, metadata, fileobj)
+            else:
+                reference = self.register(entry, metadata, fileobj)
+        except (dme.DMEError, IOError, ValueError) as e:
+            self._fail(entry, e)
+            return False
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+        return self._confirm(entry, checksum, reference)
+
+    def _confirm(self, entry, checksum, reference=False, bulk=False):
+        """Records an entry DME confirmed in the journal and counts it."""
+        try:
+            journal = self._journal(entry)
+            if journal is not None:
+                journal.record(entry['type'], entry['path'], entry['size'], checksum)
+        except (IOError, ValueError) as e:
+            self._fail(entry, e)
+            return False
+
+        with self._lock:
+            if bulk:
+                self._count(entry, 'bulk')
+            self._count(entry, '{}s'.format(entry['type']))
+            if reference:
+                self._count(entry, 'references')
+            else:
+                self._count(entry, 'bytes', entry['size'])
+        if reference:
+            print('Registered dataObject {} (reference to an identical copy)'.format(entry['path']))
+        else:
+            print('Registered {} {}'.format(entry['type'], entry['path']))
+        return True
+
+    def _register(self, entry):
+        prepared = self._prepare(entry)
+        if prepared is None:
+            return False
+        return self._complete(entry, *prepared)
+
+    def _register_copies(self, copies):
+        """Registers the copies of one data object into several vaults at the same
+        time. Copies streamed in a single request share one read of the file."""
+        prepared = []
+        for entry in copies:
+            values = self._prepare(entry)
+            if values is not None:
+                prepared.append((entry,) + values)
+        streamed = [p for p in prepared if p[0]['size'] < self.multipart_threshold]
+        readers = {}
+        if len(streamed) > 1:
+            try:
+                tee = dme.Tee(streamed[0][0]['local'], len(streamed), blocksize=self.blocksize)
+                readers = dict((p[0]['path'], reader) for p, reader in zip(streamed, tee.readers))
+            except IOError:
+                pass # Every copy opens the file on its own and reports the error
+
+        def send(entry, metadata, checksum):
+            try:
+                self._complete(entry, metadata, checksum, readers.get(entry['path']))
+            except Exception as e:
+                self._fail(entry, e)
+
+        threads = [threading.Thread(target=send, args=p) for p in prepared]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _register_batch(self, batch):
+        """Registers a batch of small data objects with a single bulk registration
+        request. Items DME reports as failed, and every item of a request that
+        fails as a whole, are registered again one at a time."""
+        prepared = []
+        for entry in batch:
+            values = self._prepare(entry)
+            if values is not None:
+                prepared.append((entry,) + values)
+        if not prepared:
+            return
+        items = [(entry['path'], entry['local'], metadata) for entry, metadata, _ in prepared]
+        size = sum(entry['size'] for entry, _, _ in prepared)
+        try:
+            if self.retry is not None:
+                results = self.retry(self._throttled, size, self.session.register_dataobjects_bulk, items)
+            else:
+                results = self._throttled(size, self.session.register_dataobjects_bulk, items)
+        except (dme.DMEError, IOError, ValueError) as e:
+            err('Bulk registration of {} data objects failed, registering them one at a time: {}'.format(
+                len(items), e))
+            results = dict((path, e) for path, _, _ in items)
+
+        for entry, metadata, checksum in prepared:
+            reason = results.get(entry['path'], 'not reported by the bulk registration task')
+            if reason is None:
+                self._confirm(entry, checksum, bulk=True)
+            else:
+                print('Retrying dataObject {} on its own ({})'.format(entry['path'], reason))
+                self._complete(entry, metadata, checksum)
+
+    def batches(self, groups):
+        """Groups small data objects into batches for bulk registration. Siblings
+        are kept together, in path order, so a batch mostly waits on a single
+        parent collection.
+        @param groups <list[list]>:
+            Entries registered together, see run()
+        @return groups <list[list]>:
+            Groups where the small data objects are replaced by Batch groups
+        """
+        if self.bulk_count < 2 or self.index is not None:
+            return groups
+        small = [g for g in groups if len(g) == 1 and g[0]['type'] == 'dataObject' and 'vault' not in g[0]
+                 and g[0]['size'] <= self.bulk_max_size]
+        if len(small) < 2:
+            return groups
+        chosen = set(id(g) for g in small)
+        regrouped = [g for g in groups if id(g) not in chosen]
+        batch, size = Batch(), 0
+        for group in sorted(small, key=lambda g: g[0]['path']):
+            entry = group[0]
+            if batch and (len(batch) >= self.bulk_count or size + entry['size'] > self.bulk_bytes):
+                regrouped.append(batch)
+                batch, size = Batch(), 0
+            batch.append(entry)
+            size += entry['size']
+        regrouped.append(batch)
+        # A batch of one is sent like any other data object
+        return [list(g) if isinstance(g, Batch) and len(g) == 1 else g for g in regrouped]
+
+    def run(self, entries):
+        """Registers a list of collections and data objects listed by manifest().
+        There are no phases: every entry is handed to the workers as soon as its
+        parent collection is confirmed, so sibling collections are registered in
+        parallel and data objects start while other collections are still being
+        created. Ready collections go first, since they unblock more work, then
+        data objects in the order chosen by the scheduler.
+        @param entries <list[dict]>:
+            Collections and data objects to register
+        @return stats <dict>:
+            Number of registered collections, data objects, bytes and failures,
+            along with the elapsed time in seconds, added up over every call
+        """
+        start = time.time()
+        # Copies of the same data object in several vaults are sent together
+        groups, keys = [], {}
+        for entry in entries:
+            key = entry['path']
+            if entry['type'] == 'dataObject' and 'vault' in entry:
+                key = ('dataObject', entry['local'])
+            if key not in keys:
+                keys[key] = len(groups)
+                groups.append([])
+            groups[keys[key]].append(entry)
+
+        objects = [g[0] for g in groups if g[0]['type'] == 'dataObject']
+        if self.scheduler is not None:
+            objects = self.scheduler.order(objects)
+        rank = dict((e['path'], i) for i, e in enumerate(objects))
+        # Every copy of a mirrored data object takes the rank of the first one
+        for group in groups:
+            for entry in group[1:]:
+                rank[entry['path']] = rank[group[0]['path']]
+        collections = set(e['path'] for e in entries if e['type'] == 'collection')
+        groups = self.batches(groups)
+
+        # Entries wait on their parent collections, unless they are not part of
+        # the upload (i.e. the vault or a collection that already exists)
+        ready, waiting, parents = [], {}, []
+        for i, group in enumerate(groups):
+            first = group[0]
+            if first['type'] == 'collection':
+                item = ((0, first['path'].count('/'), i), group)
+            else:
+                item = ((1, min(rank[e['path']] for e in group), i), group)
+            pending = set(os.path.dirname(e['path']) for e in group) & collections
+            parents.append([len(pending), item])
+            for parent in pending:
+                waiting.setdefault(parent, []).append(i)
+            if not pending:
+                heapq.heappush(ready, item)
+
+        condition = threading.Condition()
+        outstanding = [len(groups)]
+
+        def worker():
+            while True:
+                with condition:
+                    while not ready and outstanding[0] > 0:
+                        condition.wait()
+                    if not ready:
+                        return
+                    _, group = heapq.heappop(ready)
+                try:
+                    if isinstance(group, Batch):
+                        self._register_batch(group)
+                    elif len(group) > 1:
+                        self._register_copies(group)
+                    else:
+                        self._register(group[0])
+                except Exception as e:
+                    for entry in group:
+                        self._fail(entry, e)
+                finally:
+                    # Children of a failed collection are released too, they fail fast in _prepare()
+                    with condition:
+                        for entry in group:
+                            for i in waiting.pop(entry['path'], []):
+                                parents[i][0] -= 1
+                                if parents[i][0] == 0:
+                                    heapq.heappush(ready, parents[i][1])
+                        outstanding[0] -= 1
+                        condition.notify_all()
+
+        workers = [threading.Thread(target=worker) for _ in range(max(int(self.threads), 1))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        if self.retry is not None:
+            self.stats['retries'] = self.retry.retries
+            self.stats['waited'] = self.retry.waited
+        # Added up over every call, i.e. the batches of a watched pipeline
+        self.stats['elapsed'] += time.time() - start
+        for stats in list(self.vault_stats.values()) + list(self.project_stats.values()):
+            stats['elapsed'] = self.stats['elapsed']
+        return self.stats
+
+
+def summarize(stats):
+    """Returns a human readable summary of an upload.
+    @param stats <dict>:
+        Statistics returned by Uploader.run()
+    @return summary <str>:
+        One line summary of the upload
+    """
+    elapsed = max(stats['elapsed'], 1e-6)
+    summary = 'Registered {} collections and {} data objects ({:.2f} GB) in {:.1f} seconds ({:.2f} MB/s), {} skipped, {} failed'.format(
+        stats['collections'], stats['dataObjects'], stats['bytes'] / 1024.0**3,
+        stats['elapsed'], stats['bytes'] / 1024.0**2 / elapsed, stats['skipped'], stats['failed'])
+    if stats.get('references'):
+        summary += ', {} registered as references'.format(stats['references'])
+    if stats.get('deferred'):
+        summary += ', {} deferred to the next job'.format(stats['deferred'])
+    if stats.get('bulk'):
+        summary += ', {} registered in bulk requests'.format(stats['bulk'])
+    return summary
+
+
+def mirror(entries, vault, vaults):
+    """Copies the entries of an upload into several vaults. Every copy records its
+    vault, so it is registered with the metadata variant of that vault.
+    @param entries <list[dict]>:
+        Collections and data objects listed by manifest() for the first vault
+    @param vault <str>:
+        DME vault the entries were listed for (i.e. /CCBR_Archive)
+    @param vaults <list[str]>:
+        Additional DME vaults to push the same data (i.e. /CCR_DTB_Archive)
+    @return entries <list[dict]>:
+        Collections and data objects of every vault
+    """
+    vault = '/' + vault.strip('/')
+    copies = []
+    for target in [vault] + ['/' + v.strip('/') for v in vaults]:
+        for entry in entries:
+            copies.append(dict(entry, path=target + entry['path'][len(vault):], vault=target))
+
+    return copies
+
+
+def shard(entries, index, n):
+    """Selects one byte-balanced shard of the data objects, along with every
+    collection that contains one of them.
+    @param entries <list[dict]>:
+        Collections and data objects listed by manifest()
+    @param index <int>:
+        Index of the shard to select, starting at 0
+    @param n <int>:
+        Total number of shards
+    @return entries <list[dict]>:
+        Collections and data objects of the shard, in manifest order
+    """
+    objects = shards([e for e in entries if e['type'] == 'dataObject'], n)[index]
+    keep = set(e['path'] for e in objects)
+    for path in list(keep):
+        parent = os.path.dirname(path)
+        while parent.count('/') > 1:
+            keep.add(parent)
+            parent = os.path.dirname(parent)
+
+    return [e for e in entries if e['path'] in keep]
+
+
+def status(entries, journal, n):
+    """Prints how much of each shard is confirmed in the shared upload journal.
+    @param entries <list[dict]>:
+        Collections and data objects listed by manifest()
+    @param journal <Journal>:
+        Upload journal shared by every shard
+    @param n <int>:
+        Total number of shards
+    """
+    remaining = set(e['path'] for e in pending(entries, journal))
+    for i, objects in enumerate(shards([e for e in entries if e['type'] == 'dataObject'], n)):
+        done = [e for e in objects if e['path'] not in remaining]
+        print('Shard {}/{}: {}/{} data objects, {:.2f}/{:.2f} GB confirmed'.format(
+            i, n, len(done), len(objects), sum(e['size'] for e in done) / 1024.0**3,
+            sum(e['size'] for e in objects) / 1024.0**3))
+
+
+def pending(entries, journal):
+    """Lists the entries that are not yet confirmed in the upload journal.
+    @param entries <list[dict]>:
+        Collections and data objects listed by manifest()
+    @param journal <Journal>:
+        Upload journal
+    @return pending <list[dict]>:
+        Collections and data objects that still need to be registered
+    """
+    remaining = []
+    for entry in entries:
+        checksum = fingerprint(entry, entry_metadata(entry))
+        if not journal.confirmed(entry['path'], entry['size'], checksum):
+            remaining.append(entry)
+
+    return remaining
+
+
+def differential(session, entries, journal, threads=8):
+    """Compares the checksums of pending data objects with the checksums of the
+    data objects already in DME, see DMESession.get_remote_checksums().
+    @param session <DMESession>:
+        Session used to query DME
+    @param entries <list[dict]>:
+        Collections and data objects listed by manifest()
+    @param journal <Journal>:
+        Upload journal, data objects it confirms are not queried
+    @param threads <int>:
+        Number of concurrent requests
+    @return changed <list[dict]>:
+        Collections, and data objects that are new or changed, in manifest order
+    @return unchanged <list[tuple]>:
+        (entry, checksum) of every data object whose remote checksum matches
+    """
+    local = {}
+    for entry in pending(entries, journal):
+        if entry['type'] == 'dataObject':
+            local[entry['path']] = fingerprint(entry, entry_metadata(entry))
+    remote = session.get_remote_checksums(sorted(local), threads=threads)
+
+    changed, unchanged = [], []
+    for entry in entries:
+        if entry['path'] in local and remote[entry['path']] == local[entry['path']]:
+            unchanged.append((entry, local[entry['path']]))
+        else:
+            changed.append(entry)
+
+    return changed, unchanged
+
+
+def dryrun(entries, journal, scheduler):
+    """Prints what an upload would register without sending any requests to DME.
+    Entries already confirmed in the journal are listed as skipped.
+    @param entries <list[dict]>:
+        Collections and data objects listed by manifest()
+    @param journal <Journal>:
+        Upload journal shared with the real upload
+    @param scheduler <Scheduler>:
+        Scheduler used to predict the makespan of the upload
+    """
+    remaining = pending(entries, journal)
+    todo = set(e['path'] for e in remaining)
+    for entry in entries:
+        if entry['path'] in todo:
+            print('Would register {} {}'.format(entry['type'], entry['path']))
+        else:
+            print('Skipping {} {} (already registered)'.format(entry['type'], entry['path']))
+    objects = [e for e in remaining if e['type'] == 'dataObject']
+    print(scheduler.report(scheduler.order(objects)))
+    print('Dry-run: {} entries ({:.2f} GB) to register, {} already registered'.format(
+        len(remaining), sum(e['size'] for e in remaining) / 1024.0**3, len(entries) - len(remaining)))
+
+
+def backend(args):
+    """Returns the storage backend selected on the command line.
+    @param args <parser.parse_args() object>:
+        Parsed arguments of upload.py
+    @return session <DMESession or S3Session>:
+        Storage backend to push the upload hierarchy into
+    """
+    # Every thread, and every part of a multipart upload, keeps its own connection alive
+    threads = max(args.threads, args.max_threads) if args.adaptive else args.threads
+    options = dict(pool_size=threads * max(args.part_threads, 1), retries=args.retries,
+                   timeout=(args.connect_timeout, args.read_timeout))
+    if args.backend == 's3':
+        return S3Session(args.s3_endpoint, args.s3_bucket, region=args.s3_region, prefix=args.s3_prefix,
+                         metadata=args.s3_metadata, **options)
+    return dme.DMESession(args.dme_url, args.dme_token, **options)
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'upload: \
+                                                    pushes a local upload hierarchy \
+                                                    into object storage in HPC DME.')
+
+    # DME base directory containing upload/
+    parser.add_argument('directory',
+                        type = str,
+                        help = 'Required: DME base directory for all intermediate output files. \
+                                It must contain the upload/ hierarchy created by pyrkit. \
+                                Example: /scratch/ccbr123/RNA_hg38/DME')
+    # Output vault
+    parser.add_argument('vault',
+                        type = str,
+                        help = 'Required: DME vault to push data. \
+                                Example: /CCBR_Archive')
+    # Number of worker threads
+    parser.add_argument('-t', '--threads',
+                        type = int,
+                        default = 4,
+                        help = 'Optional: Number of concurrent requests to DME. \
+                                Default: 4')
+    # Adaptive concurrency and bandwidth ceiling
+    parser.add_argument('--adaptive',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Adapt the number of concurrent requests to how DME \
+                                responds, starting at --threads. Throttled requests (429), \
+                                server errors, timeouts and latency spikes halve it, while \
+                                successful requests slowly raise it up to --max-threads.')
+    parser.add_argument('--max-threads',
+                        type = int,
+                        default = 32,
+                        help = 'Optional: Highest number of concurrent requests reached with \
+                                --adaptive. Default: 32')
+    parser.add_argument('--max-rate',
+                        type = float,
+                        default = 0,
+                        help = 'Optional: Ceiling on the total upload bandwidth in MB/s, \
+                                shared by every thread. Default: 0 (no limit)')
+    # Per-request retries and circuit breaker
+    parser.add_argument('--retries',
+                        type = int,
+                        default = 5,
+                        help = 'Optional: Maximum number of attempts of a single request that \
+                                fails with a transient error. Default: 5')
+    parser.add_argument('--connect-timeout',
+                        type = float,
+                        default = 10,
+                        help = 'Optional: Seconds to wait for a connection to the server. \
+                                Default: 10')
+    parser.add_argument('--read-timeout',
+                        type = float,
+                        default = 300,
+                        help = 'Optional: Seconds to wait for the server while a request is sent \
+                                or its response is received. Default: 300')
+    parser.add_argument('--max-backoff',
+                        type = float,
+                        default = 60,
+                        help = 'Optional: Longest delay in seconds between two attempts of a \
+                                request. Default: 60')
+    parser.add_argument('--breaker-threshold',
+                        type = int,
+                        default = 5,
+                        help = 'Optional: Number of consecutive failed requests after which new \
+                                requests are paused. Default: 5')
+    parser.add_argument('--breaker-cooldown',
+                        type = float,
+                        default = 30,
+                        help = 'Optional: Seconds new requests are paused once the circuit breaker \
+                                opens, doubled while DME keeps failing. Default: 30')
+    # Expected throughput used to schedule uploads
+    parser.add_argument('--throughput',
+                        type = float,
+                        default = None,
+                        help = 'Optional: Expected throughput of a single connection to DME \
+                                in MB/s. It is used to order uploads and predict how long \
+                                the upload will take. Default: median of the recent uploads \
+                                in --history, or 50')
+    parser.add_argument('--history',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Upload history where the throughput of each run is \
+                                recorded (see history.py). Default: ~/.pyrkit/history.jsonl')
+    # Multipart uploads of large data objects
+    parser.add_argument('--multipart-threshold',
+                        type = float,
+                        default = 5,
+                        help = 'Optional: Size in GB above which a data object is uploaded \
+                                in parts to presigned URLs. Default: 5')
+    parser.add_argument('--part-size',
+                        type = int,
+                        default = 512,
+                        help = 'Optional: Size in MB of each part of a multipart upload. \
+                                Default: 512')
+    parser.add_argument('--part-threads',
+                        type = int,
+                        default = 4,
+                        help = 'Optional: Number of parts of one data object uploaded at the \
+                                same time. Default: 4')
+    # Bulk registration of small data objects
+    parser.add_argument('--bulk',
+                        type = int,
+                        default = 0,
+                        help = 'Optional: Register small data objects in batches of up to this \
+                                many objects, one bulk registration request per batch. DME reads \
+                                the files of a batch from the file system it shares with the \
+                                cluster, so they must be readable by the DME server. Not used \
+                                with --dedup or --mirror. Default: 0 (one request per object)')
+    parser.add_argument('--bulk-size',
+                        type = float,
+                        default = 256,
+                        help = 'Optional: Largest total size in MB of the data objects of one \
+                                bulk registration request. Default: 256')
+    parser.add_argument('--bulk-max-object',
+                        type = float,
+                        default = 16,
+                        help = 'Optional: Size in MB above which a data object is never registered \
+                                in bulk. Default: 16')
+    # Sharded uploads, i.e. SLURM job arrays
+    parser.add_argument('--shards',
+                        type = int,
+                        default = 1,
+                        help = 'Optional: Split the data objects into this many byte-balanced \
+                                shards and only upload one of them. Default: 1')
+    parser.add_argument('--shard-index',
+                        type = int,
+                        default = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)),
+                        help = 'Optional: Index of the shard to upload, starting at 0. \
+                                Default: $SLURM_ARRAY_TASK_ID or 0')
+    parser.add_argument('--status',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Report how much of each shard is confirmed in the \
+                                upload journal and exit.')
+    # Differential sync
+    parser.add_argument('--sync',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Only upload data objects that are new or whose \
+                                md5_checksum differs from the copy already in DME. Unchanged \
+                                data objects are reported as skipped.')
+    # Content-addressed dedup
+    parser.add_argument('--dedup',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Register data objects whose contents are already stored \
+                                in the vault as references to the existing copy instead of \
+                                uploading them again.')
+    parser.add_argument('--dedup-index',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Dedup index shared by every project archived into the \
+                                vault. It is rebuilt from DME when it does not exist. \
+                                Default: ~/.pyrkit/dedup/<vault>.index')
+    parser.add_argument('--rebuild-index',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Rebuild the dedup index from a metadata query of every \
+                                data object in the vault before uploading.')
+    # Time budget of SLURM jobs
+    parser.add_argument('--deadline',
+                        type = str,
+                        default = 'auto',
+                        help = 'Optional: Time the upload must stop by, in seconds since the \
+                                epoch. With auto, it is the time limit of the SLURM job from \
+                                $SLURM_JOB_END_TIME or squeue. With none, there is no deadline. \
+                                Default: auto')
+    parser.add_argument('--reserve',
+                        type = float,
+                        default = 600,
+                        help = 'Optional: Seconds kept free before the deadline to drain the \
+                                transfers in flight. Default: 600')
+    # Fan-out to several vaults
+    parser.add_argument('--mirror',
+                        type = str,
+                        action = 'append',
+                        default = [],
+                        help = 'Optional: Additional DME vault to push the same data, can be \
+                                provided more than once. Each file is read once for every \
+                                vault. Example: --mirror /CCR_DTB_Archive')
+    # Upload journal
+    parser.add_argument('-j', '--journal',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Upload journal used to resume an interrupted upload. \
+                                Default: <directory>/upload.journal')
+    # Dry-run
+    parser.add_argument('-n', '--dry-run',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: List what would be registered without pushing anything \
+                                into DME. Entries already in the journal are listed as skipped.')
+    # Storage backend
+    parser.add_argument('--backend',
+                        type = str,
+                        choices = BACKENDS,
+                        default = 'dme',
+                        help = 'Optional: Storage to push the hierarchy into: HPC DME, or a bucket \
+                                of an S3-compatible object store. The S3 credentials are read from \
+                                $AWS_ACCESS_KEY_ID and $AWS_SECRET_ACCESS_KEY. --sync, --dedup and \
+                                --bulk are only supported by DME. Default: dme')
+    parser.add_argument('--s3-endpoint',
+                        type = str,
+                        default = os.environ.get('AWS_ENDPOINT_URL', ''),
+                        help = 'Optional: URL of the S3-compatible object store, required with \
+                                --backend s3. Default: $AWS_ENDPOINT_URL')
+    parser.add_argument('--s3-bucket',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Bucket to push the hierarchy into, required with \
+                                --backend s3. DME paths become keys of the bucket.')
+    parser.add_argument('--s3-region',
+                        type = str,
+                        default = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+                        help = 'Optional: Region the S3 requests are signed for. \
+                                Default: $AWS_DEFAULT_REGION or us-east-1')
+    parser.add_argument('--s3-prefix',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Key prefix of every object pushed into the bucket. \
+                                Example: --s3-prefix staging/ccbr123')
+    parser.add_argument('--s3-metadata',
+                        type = str,
+                        choices = ('sidecar', 'tags'),
+                        default = 'sidecar',
+                        help = 'Optional: Store the metadata of each data object as a \
+                                <key>.metadata.json sidecar object, or also tag the data object \
+                                with its checksum, file type, sample name, analysis ID and \
+                                handling attributes (see storage.TAGGED). Collections always get \
+                                a sidecar. Default: sidecar')
+    # Overrides for the DME server
+    parser.add_argument('--dme-url',
+                        type = str,
+                        default = '',
+                        help = 'Optional: URL of the DME server, overrides the URL in \
+                                $HPC_DM_UTILS/hpcdme.properties. Useful to test against a \
+                                local stand-in server (see tests/dme_server.py).')
+    parser.add_argument('--dme-token',
+                        type = str,
+                        default = '',
+                        help = 'Optional: DME token, overrides the token in \
+                                $HPC_DM_UTILS/tokens/curl-conf.')
+
+    args = parser.parse_args()
+    if args.backend == 's3':
+        if not args.s3_endpoint or not args.s3_bucket:
+            parser.error('--s3-endpoint and --s3-bucket are required with --backend s3')
+        if args.sync or args.dedup or args.rebuild_index or args.bulk:
+            parser.error('--sync, --dedup, --rebuild-index and --bulk require --backend dme')
+    return args
+
+
+def main():
+
+    # Collect args
+    args = parsed_arguments()
+
+    upload_directory = os.path.join(args.directory, 'upload')
+    if not os.path.isdir(upload_directory):
+        err('Error: {} does not exist!'.format(upload_directory))
+        sys.exit(1)
+
+    entries = manifest(upload_directory, args.vault)
+    journal = Journal(args.journal or os.path.join(args.directory, 'upload.journal'))
+    if args.status:
+        status(entries, journal, args.shards)
+        return
+    if args.shards > 1:
+        if not 0 <= args.shard_index < args.shards:
+            err('Error: --shard-index must be between 0 and {}!'.format(args.shards - 1))
+            sys.exit(1)
+        entries = shard(entries, args.shard_index, args.shards)
+        print('Uploading shard {}/{}'.format(args.shard_index, args.shards))
+    if args.mirror:
+        entries = mirror(entries, args.vault, args.mirror)
+        print('Mirroring into {}'.format(', '.join('/' + v.strip('/') for v in [args.vault] + args.mirror)))
+    multipart_threshold = int(args.multipart_threshold * 1024**3)
+    history = History(args.history or None)
+    throughput = args.throughput * 1024**2 if args.throughput else history.throughput(default=52428800.0)
+    scheduler = Scheduler(args.threads, throughput=throughput,
+                          multipart_threshold=multipart_threshold, part_threads=args.part_threads)
+    session = None
+    unchanged = []
+    if args.sync:
+        session = backend(args)
+        entries, unchanged = differential(session, entries, journal, threads=args.threads)
+        for entry, checksum in unchanged:
+            print('Skipping dataObject {} (remote checksum matches)'.format(entry['path']))
+            if not args.dry_run:
+                journal.record(entry['type'], entry['path'], entry['size'], checksum)
+        print('Differential sync: {} unchanged data objects ({:.2f} GB) skipped'.format(
+            len(unchanged), sum(e['size'] for e, _ in unchanged) / 1024.0**3))
+    if args.dry_run:
+        dryrun(entries, journal, scheduler)
+        return
+
+    objects = [e for e in pending(entries, journal) if e['type'] == 'dataObject']
+    print(scheduler.report(scheduler.order(objects)))
+    try:
+        session = session or backend(args)
+    except ValueError as e:
+        err('Error: {}'.format(e))
+        sys.exit(1)
+    index = None
+    if args.dedup or args.rebuild_index:
+        filename = args.dedup_index or os.path.join(os.path.expanduser('~'), '.pyrkit', 'dedup',
+                                                    '{}.index'.format(args.vault.strip('/').replace('/', '_')))
+        if not os.path.isdir(os.path.dirname(os.path.abspath(filename))):
+            os.makedirs(os.path.dirname(os.path.abspath(filename)))
+        index = DedupIndex(filename)
+        if args.rebuild_index or not os.path.exists(filename):
+            index.rebuild(session, args.vault)
+            print('Rebuilt dedup index {} with {} unique data objects'.format(filename, len(index.entries)))
+    if args.max_rate > 0:
+        session.rate_limiter = RateLimiter(args.max_rate * 1024**2)
+    controller = None
+    if args.adaptive:
+        controller = AIMDController(initial=args.threads, maximum=max(args.max_threads, args.threads))
+    breaker = CircuitBreaker(threshold=args.breaker_threshold, cooldown=args.breaker_cooldown)
+    retry = Retry(attempts=args.retries, cap=args.max_backoff, breaker=breaker, transient=transient)
+    budget = None
+    deadline = job_end_time() if args.deadline == 'auto' else None
+    if args.deadline not in ('auto', 'none'):
+        deadline = float(args.deadline)
+    if deadline is not None:
+        budget = TimeBudget(deadline, reserve=args.reserve)
+        print('Time budget: {}'.format(budget))
+    uploader = Uploader(session, threads=args.threads, journal=journal, scheduler=scheduler,
+                        controller=controller, retry=retry, index=index, budget=budget,
+                        multipart_threshold=multipart_threshold,
+                        part_size=args.part_size * 1024**2, part_threads=args.part_threads,
+                        bulk_count=args.bulk, bulk_bytes=int(args.bulk_size * 1024**2),
+                        bulk_max_size=int(args.bulk_max_object * 1024**2))
+    stats = uploader.run(entries)
+    stats['skipped'] += len(unchanged)
+    print(summarize(stats))
+    for vault in sorted(uploader.vault_stats):
+        print('{}: {}'.format(vault, summarize(uploader.vault_stats[vault])))
+    try:
+        history.record(stats, uploader.threads if controller is None else controller.limit,
+                       vault='/' + args.vault.strip('/'),
+                       maxrss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1))
+    except (IOError, OSError) as e:
+        err('Warning: failed to record the upload in {}: {}'.format(history.filename, e))
+    print('Retries: {}'.format(retry))
+    if controller is not None:
+        print('Adaptive {}'.format(controller))
+
+    if uploader.failed:
+        sys.exit(1)
+    if uploader.deferred:
+        if stats['collections'] + stats['dataObjects'] == 0:
+            err('Error: no entry fits in the time left in the job, request a longer time limit!')
+            sys.exit(1)
+        print('Stopped before the time limit of the job, {} entries left to upload'.format(len(uploader.deferred)))
+        sys.exit(EXIT_REQUEUE)
+
+
+if __name__ == '__main__':
+    main()
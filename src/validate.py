@@ -3,7 +3,8 @@
 
 from __future__ import print_function, division
 from datetime import datetime
-import sys, os, json, re
+from concurrent.futures import ThreadPoolExecutor
+import sys, os, json, re, asyncio
 import dme_utils as dme
 
 # Configuration for defining valid sheets and other default values
@@ -18,12 +19,15 @@ def help():
 validate.py: Validates the entries to be uploaded to DME
 
 USAGE:
-    python validate.py <input_directory> <dme_vault> [-h]
+    python validate.py <input_directory> <dme_vault> [--update] [--threads THREADS]
+                       [--concurrency CONCURRENCY] [-h]
 
 SYNOPSIS:
     Validate the parsed data from previous steps to check if the project is not already
 at DME. If it is, check all of the metadata that is already on DME to cross check with
-the used if they really want to apply those modifications.
+the used if they really want to apply those modifications. With --update, only the
+attributes that would be appended or modified are pushed into the collections and data
+objects that already exist on DME, without uploading any data.
 
 Required Positional Arguments:
     [1] input_directory           Type [Path]: The output directory PATH provided in
@@ -37,10 +41,22 @@ Required Positional Arguments:
                                     @ 'CCBR_Archive' is data from outside vendors.
 
 Options:
+    [--update]                    Push the attributes that would be appended or
+                                  modified into DME. Collections and data objects
+                                  whose metadata did not change are not updated.
+
+    [--threads THREADS]           Type [Int]: Number of concurrent metadata updates.
+                                  Default: 8
+
+    [--concurrency CONCURRENCY]   Type [Int]: Number of concurrent metadata lookups.
+                                  They are sent from a single thread with asyncio.
+                                  Default: 64
+
     [-h, --help]                  Displays usage and help information for the script.
 
 Example:
     $ python validate.py /scratch/DME/ CCBR_EXT_Archive
+    $ python validate.py /scratch/DME/ CCBR_EXT_Archive --update --threads 8
 
 Requirements:
     python >= 3.5
@@ -48,18 +64,29 @@ Requirements:
 
 
 def args(argslist):
-    """Parses command-line args from "sys.argv". Returns a list of args to parse."""
+    """Parses command-line args from "sys.argv". Returns a list of args to parse,
+    and a dictionary of the options."""
     # Input list of filenames to parse
     user_args = argslist[1:]
-    convert = False
-    project_id = ''
-    metafile = ''
-    analysisfile = ''
+    options = {'update': False, 'threads': 8, 'concurrency': 64}
 
     # Check for optional args
     if '-h' in user_args or '--help' in user_args:
         print(help())
         sys.exit(0)
+    if '--update' in user_args:
+        options['update'] = True
+        user_args.remove('--update')
+    for option in ('--threads', '--concurrency'):
+        if option not in user_args:
+            continue
+        i = user_args.index(option)
+        try:
+            options[option.lstrip('-')] = int(user_args[i + 1])
+        except (IndexError, ValueError):
+            print("\n{}Error: {} requires an integer{}".format(config['.error'][0], option, config['.error'][1]), file=sys.stderr)
+            sys.exit(1)
+        del user_args[i:i + 2]
 
     # Check to see if user provided input files to parse
     if len(user_args) != 2:
@@ -67,7 +94,7 @@ def args(argslist):
         print(help())
         sys.exit(1)
 
-    return user_args
+    return user_args, options
 
 
 def path_exists(path):
@@ -223,7 +250,9 @@ def get_different_fields(meta_dme,meta_local):
     return items_only_dme, items_only_local, items_both
 
 def evaluate_differences(meta_dme,meta_local):
-    """Print the differences between existing metadata and the ones that will replace."""
+    """Print the differences between existing metadata and the ones that will replace.
+    Returns the attributes that will be appended or modified."""
+    delta = []
     items_only_dme, items_only_local, items_both = get_different_fields(meta_dme,meta_local)
     print(f"   There are:\n   > {len(items_only_dme)} attributes only on DME\n   > {len(items_only_local)} attributes to be appended\n   > {len(items_both)} attributes in both lists.")
     for att_i in items_only_local:
@@ -231,6 +260,7 @@ def evaluate_differences(meta_dme,meta_local):
             att = meta_local[i]['attribute']
             if (att == att_i):
                 print(f"   ! The attribute \'{att}\' will be appended with value as \'{meta_local[i]['value']}\'")
+                delta.append(meta_local[i])
     for att in items_both:
         for i in range(len(meta_local)):
             att_i = meta_local[i]['attribute']
@@ -245,30 +275,78 @@ def evaluate_differences(meta_dme,meta_local):
                     try:
                         if float(meta_local[i]['value']) != float(meta_dme[j]['value']):
                             print(f"   ! The attribute \'{att}\' will be modified from \'{meta_dme[j]['value']}\' to \'{meta_local[i]['value']}\'")
+                            delta.append(meta_local[i])
                     except:
                         print(f"   ! The attribute \'{att}\' will be modified from \'{meta_dme[j]['value']}\' to \'{meta_local[i]['value']}\'")
-
-def evaluate_metadata_differences(session,meta_dir,meta,level="",is_collection=False):
-    """Evaluate the differences between existing metadata and the ones that will replace."""
-    if is_collection:
-        meta_dme = session.get_collection_dme_meta(meta_dir,in_pairs=False)
-    else:
-        meta_dme = session.get_dataObject_dme_meta(meta_dir,in_pairs=False)
+                        delta.append(meta_local[i])
+    return delta
+
+def fetch_metadata(session,lookups,concurrency=64):
+    """Fetches the DME metadata of many collections and data objects at once, from a
+    single thread with asyncio (see dme_utils.AsyncDMESession). Each lookup is a tuple
+    (DME path, is_collection). Returns a dictionary where [key] = DME path and
+    [value] = its metadata as it comes from DME, empty when it does not exist."""
+    async def fetch():
+        async with dme.AsyncDMESession(session.dme_url, session.dme_token, concurrency=concurrency) as client:
+            return await asyncio.gather(*[
+                client.get_collection_dme_meta(path, in_pairs=False) if is_collection
+                else client.get_dataObject_dme_meta(path, in_pairs=False) for path, is_collection in lookups])
+    return dict(zip([path for path, _ in lookups], asyncio.run(fetch())))
+
+def evaluate_metadata_differences(remote,meta_dir,meta,level="",is_collection=False,updates=None):
+    """Evaluate the differences between existing metadata and the ones that will replace.
+    The metadata already on DME is looked up in remote, see fetch_metadata() and
+    DMESession.query_metadata(). When a list of updates is provided, the attributes
+    to append or modify are added to it."""
+    meta_dme = remote.get(meta_dir, {})
 
     if len(meta_dme) == 0:
         print(f"{level} does not exist on DME!")
         return False
 
     print("{}Warning:{} {} already exists on DME!".format(*config['.warning'], level), file=sys.stderr)
-    evaluate_differences(meta_dme['metadataEntries'],meta['metadataEntries'])
+    delta = evaluate_differences(meta_dme['metadataEntries'],meta['metadataEntries'])
+    if updates is not None and delta:
+        updates.append((meta_dir, is_collection, delta))
     return True
 
+def push_updates(session,updates,threads=8):
+    """Pushes the attributes to append or modify into DME concurrently, one request
+    per collection or data object whose metadata changed. No data is uploaded.
+    Returns the number of collections and data objects updated, and the failures."""
+    def update(item):
+        path, is_collection, delta = item
+        try:
+            if is_collection:
+                session.update_collection_metadata(path, delta)
+            else:
+                session.update_dataobject_metadata(path, delta)
+        except dme.DMEError as e:
+            return item, e
+        return item, None
+
+    collections, objects, failed = 0, 0, []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for (path, is_collection, delta), error in pool.map(update, updates):
+            if error is not None:
+                print("{}Error:{} Failed to update the metadata of {}: {}".format(*config['.error'], path, error), file=sys.stderr)
+                failed.append((path, error))
+                continue
+            print(f"Updated {len(delta)} attributes of {path}")
+            if is_collection:
+                collections += 1
+            else:
+                objects += 1
+    return collections, objects, failed
+
 def main():
 
     print("\n\n###### VALIDATION STEP #####\n")
     # @args(): Parses positional command-line args
     # @validate_args(): Checks if user inputs are vaild
-    ipath, vault = validate_args(args(sys.argv))
+    user_args, options = args(sys.argv)
+    ipath, vault = validate_args(user_args)
+    updates = [] if options['update'] else None
 
     # Read in JSON files as dictionary
     pi_meta, pi_dir = get_pi_lab(ipath)
@@ -280,45 +358,70 @@ def main():
     dme_session = dme.DMESession()
     print(f"DME session URL: {dme_session.dme_url}")
 
+    # Look up the PI_Lab and the Project, then query everything below the Project if it exists.
+    # Anything the query did not return (i.e. a data object without object_name) is looked up on its own
+    pi_dir_dme = get_dme_directory(pi_dir,ipath,vault)
+    proj_dir_dme = get_dme_directory(proj_dir,ipath,vault)
+    try:
+        remote = fetch_metadata(dme_session, [(pi_dir_dme, True), (proj_dir_dme, True)], options['concurrency'])
+        if remote[proj_dir_dme]:
+            for page in dme_session.query_metadata(proj_dir_dme, in_pairs=False):
+                remote.update(page)
+            lookups = [(get_dme_directory(analysis_dir,ipath,vault), True)]
+            lookups += [(get_dme_directory(d,ipath,vault), False) for d in analysis_objs_dir]
+            lookups += [(get_dme_directory(d,ipath,vault), True) for d in samples_dir]
+            lookups += [(get_dme_directory(d,ipath,vault), False) for dirs in sample_objs_dir for d in dirs]
+            lookups = [(path, is_collection) for path, is_collection in lookups if path not in remote]
+            if lookups:
+                remote.update(fetch_metadata(dme_session, lookups, options['concurrency']))
+    except (dme.DMEError, IOError) as e:
+        print("{}Error:{} Failed to look up the metadata on DME: {}".format(*config['.error'], e), file=sys.stderr)
+        sys.exit(1)
+
     # Evaluate the existence of the project at the DME and the differences between meta to be added and already in DME
     ci, cf = config['.important']
     # PI_Lab level
     print(f"\n{ci} - PI_Lab level: {pi_dir.split('/')[-1]}{cf}")
-    pi_dir_dme = get_dme_directory(pi_dir,ipath,vault)
-    pi_exists = evaluate_metadata_differences(dme_session,pi_dir_dme,pi_meta,"PI_Lab",True)
+    pi_exists = evaluate_metadata_differences(remote,pi_dir_dme,pi_meta,"PI_Lab",True,updates)
     
     if (pi_exists):
         # Project level
         print(f"\n{ci} - Project level: {proj_dir.split('/')[-1]}{cf}")
-        proj_dir_dme = get_dme_directory(proj_dir,ipath,vault)
-        proj_exists = evaluate_metadata_differences(dme_session,proj_dir_dme,proj_meta,"Project",True)
+        proj_exists = evaluate_metadata_differences(remote,proj_dir_dme,proj_meta,"Project",True,updates)
 
         if (proj_exists):
             # Primary Analysis level
             print(f"\n{ci} - Primary Analysis level: {analysis_dir.split('/')[-1]}{cf}")
             analysis_dir_dme = get_dme_directory(analysis_dir,ipath,vault)
-            analysis_exists = evaluate_metadata_differences(dme_session,analysis_dir_dme,analysis_meta,"Primary Analysis",True)
+            analysis_exists = evaluate_metadata_differences(remote,analysis_dir_dme,analysis_meta,"Primary Analysis",True,updates)
 
             if (analysis_exists):
                 # Data Objects
                 for i in range(len(analysis_objs)):
                     print(f" * Data Object {analysis_objs_dir[i].split('/')[-1]}:")
                     obj_dir_dme = get_dme_directory(analysis_objs_dir[i],ipath,vault)
-                    sample_exists = evaluate_metadata_differences(dme_session,obj_dir_dme,analysis_objs[i],"DataObject",False)
+                    sample_exists = evaluate_metadata_differences(remote,obj_dir_dme,analysis_objs[i],"DataObject",False,updates)
             
             # Sample level
             for i in range(len(samples_meta)):
                 print(f"\n{ci} - Sample level: {samples_dir[i].split('/')[-1]}{cf}")
                 sample_dir_dme = get_dme_directory(samples_dir[i],ipath,vault)
-                sample_exists = evaluate_metadata_differences(dme_session,sample_dir_dme,samples_meta[i],"Sample",True)
+                sample_exists = evaluate_metadata_differences(remote,sample_dir_dme,samples_meta[i],"Sample",True,updates)
 
                 if (sample_exists):
                     # Data Objects
                     for j in range(len(sample_objs[i])):
                         print(f" * Data Object {sample_objs_dir[i][j].split('/')[-1]}:")
                         obj_dir_dme = get_dme_directory(sample_objs_dir[i][j],ipath,vault)
-                        obj_exists = evaluate_metadata_differences(dme_session,obj_dir_dme,sample_objs[i][j],"DataObject",False)
-    
+                        obj_exists = evaluate_metadata_differences(remote,obj_dir_dme,sample_objs[i][j],"DataObject",False,updates)
+
+    # Metadata-only update of what already exists on DME
+    if updates is not None:
+        print(f"\n{ci} - Metadata update: {len(updates)} collections and data objects changed{cf}")
+        collections, objects, failed = push_updates(dme_session, updates, options['threads'])
+        print(f"Updated the metadata of {collections} collections and {objects} data objects, {len(failed)} failed")
+        if failed:
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""verify: checks that what HPC DME stores matches what was uploaded
+About:
+      This program compares every data object of the local upload hierarchy in
+    '<dme_base_directory>/upload' with its copy in DME. The metadata of the data
+    objects is fetched in bulk, one page of a metadata query at a time, and the
+    checksum and size DME computed from the stored bytes are compared with the
+    md5_checksum that meta generated from the local file and its size on disk.
+    Data objects uploaded in parts have a checksum that is not an MD5 of their
+    contents, so they are reported as unverifiable unless they are downloaded.
+      The stored contents can also be downloaded and hashed: a random --sample of
+    the data objects, and every data object larger than --larger-than or smaller
+    than --smaller-than. Downloads run concurrently and are hashed as they are
+    received, without writing anything to disk.
+      An integrity report with the outcome of each data object is written as
+    JSON, by default to '<dme_base_directory>/verify.report.json'.
+USAGE:
+	$ verify.py <dme_base_directory> <dme_vault> [OPTIONS]
+Example:
+    $ verify.py /scratch/ccbr123/RNA_hg38/DME /CCBR_Archive --sample 20 --larger-than 10
+"""
+
+from __future__ import print_function
+import sys, os, json, time, random, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Local imports
+import dme_utils as dme
+from retry import Retry, CircuitBreaker
+from upload import manifest, load_metadata, transient
+
+# Outcomes that mean DME does not hold what was uploaded
+FAILURES = ('missing', 'size_mismatch', 'mismatch', 'download_mismatch', 'download_failed')
+
+
+def err(*message, **kwargs):
+    """Prints any provided args to standard error.
+    kwargs can be provided to modify print functions
+    behavior.
+    @param message <any>:
+        Values printed to standard error
+    @params kwargs <print()>
+        Key words to modify print function behavior
+    """
+    print(*message, file=sys.stderr, **kwargs)
+
+
+def stored(session, collection, page_size=1000):
+    """Fetches the metadata of every data object under a collection in bulk.
+    @param session <DMESession>:
+        Session used to query DME
+    @param collection <str>:
+        DME collection to verify (i.e. /CCBR_Archive/PI_Lab_X/Project_Y)
+    @param page_size <int>:
+        Number of data objects returned by each query
+    @return attributes <dict>:
+        [key] = DME path, [value] = user and system metadata of the data object
+    """
+    query = {'operator': 'AND', 'queries': [{'attribute': 'md5_checksum', 'operator': 'LIKE', 'value': '%'}]}
+    attributes = {}
+    for page in session.query_metadata(collection, dataobject_query=query, system=True, kinds=('dataObject',),
+                                       page_size=page_size):
+        attributes.update(page)
+
+    return attributes
+
+
+def compare(entry, values):
+    """Compares a local data object with the metadata of its copy in DME.
+    @param entry <dict>:
+        Data object listed by upload.manifest(), with its local md5_checksum
+    @param values <dict>:
+        User and system metadata of the copy in DME, None when it is missing
+    @return status <str>:
+        ok, missing, size_mismatch, mismatch, unverifiable or no_local_checksum
+    """
+    if values is None:
+        return 'missing'
+    size = values.get('source_file_size')
+    if size is not None and int(size) != entry['size']:
+        return 'size_mismatch'
+    if not entry['md5']:
+        return 'no_local_checksum'
+    checksum = values.get('checksum')
+    if not checksum or '-' in checksum:
+        # Multipart uploads get a checksum of their parts, i.e. <md5>-<nparts>
+        return 'unverifiable'
+    return 'ok' if checksum == entry['md5'] else 'mismatch'
+
+
+def sample(results, n=0, larger_than=None, smaller_than=None, seed=None):
+    """Selects the data objects whose stored contents are downloaded and hashed.
+    @param results <list[dict]>:
+        Outcome of each data object, see verify()
+    @param n <int>:
+        Number of data objects picked at random
+    @param larger_than <int>:
+        Every data object larger than this many bytes is picked
+    @param smaller_than <int>:
+        Every data object smaller than this many bytes is picked
+    @param seed <int>:
+        Seed of the random sample, to pick the same data objects again
+    @return picked <list[dict]>:
+        Data objects to download
+    """
+    candidates = [r for r in results if r['status'] != 'missing']
+    picked = set()
+    if n > 0:
+        picked.update(r['path'] for r in random.Random(seed).sample(candidates, min(n, len(candidates))))
+    for r in candidates:
+        if larger_than is not None and r['size'] > larger_than:
+            picked.add(r['path'])
+        if smaller_than is not None and r['size'] < smaller_than:
+            picked.add(r['path'])
+
+    return [r for r in candidates if r['path'] in picked]
+
+
+def download_md5(session, path, blocksize=1048576):
+    """Returns the MD5 of the contents stored in DME for a data object."""
+    hasher = hashlib.md5()
+    for buf in session.iter_dataobject(path, blocksize=blocksize):
+        hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def verify(session, entries, collection, threads=8, picked=None, retry=None):
+    """Verifies data objects against DME.
+    @param session <DMESession>:
+        Session used to query DME
+    @param entries <list[dict]>:
+        Data objects listed by upload.manifest()
+    @param collection <str>:
+        DME collection holding every entry
+    @param threads <int>:
+        Number of concurrent requests
+    @param picked <callable>:
+        Selects the outcomes whose data objects are downloaded, see sample()
+    @param retry <Retry>:
+        Optional retry policy of a single request
+    @return results <list[dict]>:
+        Outcome of each data object
+    """
+    def call(request, *args):
+        return retry(request, *args) if retry is not None else request(*args)
+
+    remote = stored(session, collection)
+    # Data objects without an md5_checksum attribute are not returned by the query
+    unlisted = [e['path'] for e in entries if e['path'] not in remote]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for path, values in zip(unlisted, pool.map(lambda p: call(session.get_dataObject_attributes, p), unlisted)):
+            remote[path] = values
+
+    results = []
+    for entry in entries:
+        values = remote.get(entry['path'])
+        results.append({
+            'path': entry['path'],
+            'local': entry['local'],
+            'size': entry['size'],
+            'local_md5': entry['md5'],
+            'stored_md5': values.get('checksum') if values else None,
+            'status': compare(entry, values)
+        })
+
+    def download(result):
+        try:
+            result['downloaded_md5'] = call(download_md5, session, result['path'])
+        except (dme.DMEError, IOError) as e:
+            result['download'] = 'download_failed'
+            result['error'] = str(e)
+            return result
+        matches = result['local_md5'] in (None, result['downloaded_md5'])
+        result['download'] = 'download_ok' if matches else 'download_mismatch'
+        return result
+
+    if picked is not None:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for _ in pool.map(download, picked(results)):
+                pass
+
+    return results
+
+
+def summarize(results):
+    """Counts the outcomes of a verification.
+    @return counts <dict>:
+        [key] = outcome, [value] = number of data objects
+    """
+    counts = {}
+    for result in results:
+        for status in (result['status'], result.get('download')):
+            if status:
+                counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'verify: \
+                                                    checks that what HPC DME stores matches what was uploaded.')
+    parser.add_argument('directory',
+                        type = str,
+                        help = 'Required: DME base directory for all intermediate output files. \
+                                It must contain the upload/ hierarchy created by pyrkit. \
+                                Example: /scratch/ccbr123/RNA_hg38/DME')
+    parser.add_argument('vault',
+                        type = str,
+                        help = 'Required: DME vault the data was pushed to. \
+                                Example: /CCBR_Archive')
+    parser.add_argument('--collection',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Only verify the data objects under this DME collection, \
+                                i.e. one Primary_Analysis. Default: every data object of the upload')
+    parser.add_argument('-t', '--threads',
+                        type = int,
+                        default = 8,
+                        help = 'Optional: Number of concurrent requests to DME. Default: 8')
+    parser.add_argument('--sample',
+                        type = int,
+                        default = 0,
+                        help = 'Optional: Number of data objects picked at random to download \
+                                and hash. Default: 0')
+    parser.add_argument('--seed',
+                        type = int,
+                        default = None,
+                        help = 'Optional: Seed of the random sample, to download the same data \
+                                objects again.')
+    parser.add_argument('--larger-than',
+                        type = float,
+                        default = None,
+                        help = 'Optional: Download and hash every data object larger than this \
+                                many GB. Example: --larger-than 10')
+    parser.add_argument('--smaller-than',
+                        type = float,
+                        default = None,
+                        help = 'Optional: Download and hash every data object smaller than this \
+                                many GB. Example: --smaller-than 0.1')
+    parser.add_argument('--retries',
+                        type = int,
+                        default = 5,
+                        help = 'Optional: Maximum number of attempts of a request that fails with \
+                                a transient error. Default: 5')
+    parser.add_argument('-o', '--report',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Integrity report written as JSON. \
+                                Default: <directory>/verify.report.json')
+    # Overrides for the DME server
+    parser.add_argument('--dme-url',
+                        type = str,
+                        default = '',
+                        help = 'Optional: URL of the DME server, overrides the URL in \
+                                $HPC_DM_UTILS/hpcdme.properties.')
+    parser.add_argument('--dme-token',
+                        type = str,
+                        default = '',
+                        help = 'Optional: DME token, overrides the token in \
+                                $HPC_DM_UTILS/tokens/curl-conf.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    # Collect args
+    args = parsed_arguments()
+
+    upload_directory = os.path.join(args.directory, 'upload')
+    if not os.path.isdir(upload_directory):
+        err('Error: {} does not exist!'.format(upload_directory))
+        sys.exit(1)
+
+    vault = '/' + args.vault.strip('/')
+    collection = '/' + (args.collection or vault).strip('/')
+    entries = []
+    for entry in manifest(upload_directory, vault):
+        if entry['type'] != 'dataObject' or not entry['path'].startswith(collection + '/'):
+            continue
+        values = dict((p['attribute'], p['value']) for p in load_metadata(entry['metadata'])['metadataEntries'])
+        entries.append(dict(entry, md5=values.get('md5_checksum')))
+    print('Verifying {} data objects ({:.2f} GB) under {}'.format(
+        len(entries), sum(e['size'] for e in entries) / 1024.0**3, collection))
+
+    def picked(results):
+        return sample(results, args.sample, seed=args.seed,
+                      larger_than=args.larger_than * 1024**3 if args.larger_than is not None else None,
+                      smaller_than=args.smaller_than * 1024**3 if args.smaller_than is not None else None)
+
+    session = dme.DMESession(args.dme_url, args.dme_token, pool_size=args.threads)
+    retry = Retry(attempts=args.retries, breaker=CircuitBreaker(), transient=transient)
+    start = time.time()
+    try:
+        results = verify(session, entries, collection, threads=args.threads, picked=picked, retry=retry)
+    except dme.DMEError as e:
+        err('Error: failed to query {}: {}'.format(collection, e))
+        sys.exit(1)
+    counts = summarize(results)
+
+    for result in results:
+        for status in (result['status'], result.get('download')):
+            if status in FAILURES:
+                err('{}: {}'.format(status, result['path']))
+    report = args.report or os.path.join(args.directory, 'verify.report.json')
+    with open(report + '.tmp', 'w') as fh:
+        json.dump({'time': int(time.time()), 'vault': vault, 'collection': collection,
+                   'elapsed': round(time.time() - start, 3), 'summary': counts, 'dataObjects': results},
+                  fh, indent=2, sort_keys=True)
+    os.rename(report + '.tmp', report)
+    print('Verified {} data objects in {:.1f} seconds: {}'.format(len(results), time.time() - start,
+          ', '.join('{} {}'.format(v, k) for k, v in sorted(counts.items())) or 'nothing to verify'))
+    print('Integrity report: {}'.format(report))
+
+    if any(counts.get(status) for status in FAILURES):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,707 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""watch: archives the outputs of a running pipeline as they appear
+About:
+      This program watches the working directory of a pipeline that is still
+    running and uploads its outputs into HPC DME as soon as they are complete,
+    instead of waiting for the whole pipeline to finish. Files are found with the
+    search patterns of the modules in the pyrkit config (dev/config/rnaseq.yaml).
+    A file is considered complete once its size and modification time have not
+    changed for --stable seconds.
+      Each complete per-sample file (FastQ, BAM, fusions) is linked into its
+    Sample collection of the local upload hierarchy, renamed as configured, its
+    metadata is generated with meta (which hashes the file) and it is uploaded
+    right away, along with any collection it needs. The multi-sample files go to
+    the Primary_Analysis collection once every file of DEG_ALL/ and Reports/ is
+    complete, and the ones that become complete later (i.e. multiqc_matrix.tsv)
+    follow as they do; counts matrices are reformatted like pyrkit does.
+      The watch is over once, in addition, every sample of a Sample collection has
+    a file of each per-sample module that produced files, so the outputs of a
+    sample that lags behind the others are not left out.
+      The collections must already exist in '<dme_base_directory>/upload', see
+    pyrkit --watch or initialize.py. Uploads share the upload journal, so the
+    watch can be stopped and started again, and a later upload.py run only sends
+    what the watch did not.
+      Changes are noticed with inotify. On GPFS, NFS and Lustre, files written by
+    jobs on other nodes do not produce inotify events, so the directory is polled
+    every --interval seconds instead (or always with --poll).
+USAGE:
+	$ watch.py <input_directory> <dme_base_directory> <dme_vault> [OPTIONS]
+Example:
+    $ watch.py /scratch/ccbr123/RNA_hg38 /scratch/ccbr123/RNA_hg38/DME /CCBR_Archive --threads 8
+"""
+
+from __future__ import print_function
+import sys, os, re, glob, json, time, errno, select, subprocess
+
+# Local imports
+import dme_utils as dme
+from journal import Journal
+from retry import Retry, CircuitBreaker
+from upload import Uploader, manifest, summarize, transient
+
+# Filesystems where inotify misses changes made from other nodes
+POLLED = ('gpfs', 'nfs', 'nfs4', 'lustre', 'cifs', 'smb3', 'beegfs', 'panfs', 'fuse')
+
+# Multi-sample files that are complete once all of these directories are
+COMBINED = ('DEG_ALL', 'Reports')
+
+
+def err(*message, **kwargs):
+    """Prints any provided args to standard error.
+    kwargs can be provided to modify print functions
+    behavior.
+    @param message <any>:
+        Values printed to standard error
+    @params kwargs <print()>
+        Key words to modify print function behavior
+    """
+    print(*message, file=sys.stderr, **kwargs)
+
+
+def translate(pattern):
+    """Converts a search pattern of the config into a regular expression. Search
+    patterns are regular expressions where an unescaped '*' or '?' is a shell
+    wildcard, i.e. 'bams/*\\.dmark\\.bam$' matches what bams/*.dmark.bam does.
+    @param pattern <str>:
+        Search pattern of a module
+    @return directory <str>:
+        Directory the files are in, relative to the searched directory
+    @return regex <re.Pattern>:
+        Matches a file name, the sample name is everything before the match
+    """
+    directory, _, name = pattern.strip().rpartition('/')
+    name = name.lstrip('*')
+    regex, i = '', 0
+    while i < len(name):
+        if name[i] == '\\':
+            regex += name[i:i+2]
+            i += 2
+            continue
+        regex += {'*': '[^/]*', '?': '[^/]'}.get(name[i], name[i])
+        i += 1
+
+    return directory, re.compile(regex)
+
+
+def load_modules(config):
+    """Reads the modules of a pyrkit config. Requires PyYAML.
+    @param config <str>:
+        pyrkit config (i.e. dev/config/rnaseq.yaml)
+    @return modules <list[dict]>:
+        Name, type, directory, regex and rename rules of each module
+    """
+    try:
+        import yaml
+    except ImportError:
+        err('Error: PyYAML is required to read {}, please install it!'.format(config))
+        sys.exit(1)
+    with open(config, 'r') as fh:
+        content = yaml.safe_load(fh)
+
+    modules = []
+    for name, module in content['module'].items():
+        rename = (content.get('rename') or {}).get(name) or {}
+        directory, regex = translate(module['search_pattern'])
+        modules.append({
+            'name': name,
+            'type': module['type'],
+            'directory': directory,
+            'regex': regex,
+            'add_uuid': bool(rename.get('add_uuid')),
+            'find_replace': list((rename.get('find_replace') or {}).items())
+        })
+
+    return modules
+
+
+def renamed(module, filename, sample, analysis):
+    """Returns the name of a file in the upload hierarchy. Per-sample files get
+    the assembly, annotation and short analysis ID, like pyrkit's links() does,
+    i.e. WT1.mm10_M21.Aligned.toGenome.sorted.dmark.f63-93-b750.bam
+    @param module <dict>:
+        Module of the file, see load_modules()
+    @param filename <str>:
+        Name of the file in the pipeline's directory
+    @param sample <str>:
+        Sample name of the file, None for multi-sample files
+    @param analysis <dict>:
+        Run metadata of the analysis, see run_metadata()
+    @return name <str>:
+        Name of the file in its collection
+    """
+    for find, replace in module['find_replace']:
+        if not re.search(find, filename):
+            continue
+        if not module['add_uuid'] or sample is None:
+            return re.sub(find, replace, filename)
+        stem, _, extension = replace.rpartition('.')
+        return '{}.{}_{}{}.{}.{}'.format(sample, analysis['assembly_name'], analysis['gtf_ver'],
+                                         stem, analysis['md5_all_inputs_serial'], extension)
+    return filename
+
+
+def reformat(source, destination):
+    """Copies a counts matrix of DEG_ALL/ in the format expected downstream, like
+    pyrkit's fix(): the gene ID and name columns are joined with '|' and the
+    _expected_count suffix is removed from the sample names.
+    """
+    with open(source, 'r') as ifh, open(destination + '.tmp', 'w') as ofh:
+        for i, line in enumerate(ifh):
+            fields = line.rstrip('\n').split('\t')
+            fields = ['|'.join(fields[:2])] + fields[2:]
+            if i == 0:
+                fields[0] = fields[0].replace('gene_id|GeneName', 'symbol', 1)
+                fields = [re.sub('_expected_count$', '', f) for f in fields]
+            ofh.write('\t'.join(fields) + '\n')
+    os.rename(destination + '.tmp', destination)
+
+
+def run_metadata(filename):
+    """Reads the run metadata written by pyrkit's fingerprint().
+    @return analysis <dict>:
+        [key] = field (i.e. md5_all_inputs), [value] = value of the field
+    """
+    analysis = {'assembly_name': 'custom', 'gtf_ver': 'custom'}
+    with open(filename, 'r') as fh:
+        for line in fh:
+            field, _, value = line.rstrip('\n').partition('\t')
+            if field != 'file':
+                analysis[field] = value
+    return analysis
+
+
+def expected_samples(upload_directory):
+    """Reads the names of the samples of the Sample collections, which
+    initialize.py creates for each sample of the project request.
+    @param upload_directory <str>:
+        Local upload hierarchy (i.e. <dme_base_directory>/upload)
+    @return samples <set[str]>:
+        Sample names, as in the names of their FastQ files
+    """
+    samples = set()
+    for collection in glob.glob(os.path.join(upload_directory, 'PI_Lab_*', 'Project_*', 'Sample_*')):
+        if not os.path.isdir(collection):
+            continue
+        # Sample_<sample id>_<sample name>, the ID can contain underscores too
+        name = os.path.basename(collection).split('_', 2)[-1]
+        try:
+            with open(collection + '.metadata.json', 'r') as fh:
+                entries = json.load(fh).get('metadataEntries', [])
+            name = [e['value'] for e in entries if e.get('attribute') == 'sample_name'][0]
+        except (IOError, ValueError, IndexError):
+            pass
+        samples.add(name)
+    return samples
+
+
+def polled(path):
+    """Checks if a directory is on a filesystem where inotify misses changes.
+    @param path <str>:
+        Directory to watch
+    @return polled <bool>:
+        True for GPFS, NFS, Lustre and the like, as listed in /proc/mounts
+    """
+    path = os.path.realpath(path)
+    best, fstype = '', ''
+    try:
+        with open('/proc/mounts', 'r') as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(best):
+                    best, fstype = mount, fields[2]
+    except IOError:
+        return True
+    return fstype.split('.')[0] in POLLED
+
+
+class Inotify(object):
+    """Wakes up when a file is created, written or moved into a watched directory.
+    Only the Linux inotify calls of the C library are used, through ctypes.
+    """
+    MASK = 0x2 | 0x4 | 0x8 | 0x80 | 0x100  # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._errno = ctypes.get_errno
+        self.watched = set()
+
+    def add(self, directory):
+        """Watches a directory, once it exists."""
+        if directory in self.watched or not os.path.isdir(directory):
+            return
+        if self._libc.inotify_add_watch(self.fd, directory.encode(), self.MASK) < 0:
+            raise OSError(self._errno(), 'inotify_add_watch failed for {}'.format(directory))
+        self.watched.add(directory)
+
+    def wait(self, timeout):
+        """Waits for changes in the watched directories.
+        @param timeout <float>:
+            Longest time to wait in seconds
+        @return changed <bool>:
+            True when something changed before the timeout
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Stability(object):
+    """Tracks files until their size and modification time stop changing.
+    @param seconds <float>:
+        Time a file must stay unchanged to be considered complete
+    """
+    def __init__(self, seconds):
+        self.seconds = float(seconds)
+        self.files = {}
+
+    def update(self, path, now=None):
+        """Records the current state of a file.
+        @return stable <bool>:
+            True when the file has not changed for long enough
+        """
+        now = time.time() if now is None else now
+        try:
+            info = os.stat(path)
+        except OSError:
+            self.files.pop(path, None)
+            return False
+        state = (info.st_size, info.st_mtime)
+        if path not in self.files or self.files[path][0] != state:
+            self.files[path] = (state, now)
+        return now - self.files[path][1] >= self.seconds
+
+    def forget(self, path):
+        self.files.pop(path, None)
+
+    def next_check(self, now=None):
+        """Returns the seconds until the next tracked file could become stable."""
+        now = time.time() if now is None else now
+        if not self.files:
+            return None
+        return max(min(since for _, since in self.files.values()) + self.seconds - now, 0)
+
+
+class Watch(object):
+    """Archives the outputs of a pipeline while it runs.
+    @param input_directory <str>:
+        Working directory of the pipeline
+    @param dme_directory <str>:
+        DME base directory with the upload/ hierarchy and run_metadata.txt
+    @param vault <str>:
+        DME vault to push data (i.e. /CCBR_Archive)
+    @param modules <list[dict]>:
+        Modules of the pyrkit config, see load_modules()
+    @param meta <str>:
+        Path to pyrkit/src/meta
+    @param uploader <Uploader>:
+        Uploads the collections and data objects, None to only prepare them
+    @param stable <float>:
+        Seconds a file must stay unchanged to be considered complete
+    @param multiqc_directory <str>:
+        Also searched for multi-sample files (i.e. multiqc_matrix.tsv)
+    @param request_template <str>:
+        Project request template added to the Primary_Analysis collection
+    """
+    def __init__(self, input_directory, dme_directory, vault, modules, meta, uploader=None, stable=300,
+                 multiqc_directory=None, request_template=None):
+        self.input_directory = os.path.abspath(input_directory)
+        self.dme_directory = os.path.abspath(dme_directory)
+        self.upload_directory = os.path.join(self.dme_directory, 'upload')
+        self.vault = '/' + vault.strip('/')
+        self.modules = modules
+        self.meta = meta
+        self.uploader = uploader
+        self.stability = Stability(stable)
+        self.multiqc_directory = os.path.abspath(multiqc_directory) if multiqc_directory else None
+        self.request_template = os.path.abspath(request_template) if request_template else None
+        self.analysis = run_metadata(os.path.join(self.dme_directory, 'run_metadata.txt'))
+        homes = [d for d in glob.glob(os.path.join(self.upload_directory, 'PI_Lab_*', 'Project_*', 'Primary_Analysis_*'))
+                 if os.path.isdir(d)]
+        if len(homes) != 1:
+            raise ValueError('Expected one Primary_Analysis collection in {}, found {}'.format(
+                self.upload_directory, len(homes)))
+        self.analysis_home = homes[0]
+        self.done = set()       # Files of the pipeline that were archived
+        self.failed = set()     # Files meta could not generate metadata for
+        self.unknown = set()    # Samples without a Sample collection
+        self.analysis_ready = False     # DEG_ALL/ and Reports/ are complete
+        self.samples = expected_samples(self.upload_directory)
+        self.archived = {}      # [key] = sample, [value] = names of its archived modules
+        self.template_added = False
+
+    def dme_path(self, local):
+        """Returns the DME path of a directory of the upload hierarchy."""
+        return self.vault + local[len(self.upload_directory):]
+
+    def directories(self):
+        """Lists the directories searched for files, i.e. to watch with inotify."""
+        found = set()
+        for module in self.modules:
+            found.add(os.path.join(self.input_directory, module['directory']).rstrip('/'))
+            if module['type'] == 'combined' and self.multiqc_directory:
+                found.add(os.path.join(self.multiqc_directory, module['directory']).rstrip('/'))
+        return sorted(found)
+
+    def discover(self):
+        """Finds the files of every module.
+        @return found <list[tuple]>:
+            (module, path, sample name) of each file, the sample name is None for
+            multi-sample files
+        """
+        found = []
+        for module in self.modules:
+            bases = [self.input_directory]
+            if module['type'] == 'combined' and self.multiqc_directory:
+                bases.append(self.multiqc_directory)
+            for base in bases:
+                directory = os.path.join(base, module['directory'])
+                try:
+                    names = sorted(os.listdir(directory))
+                except OSError:
+                    continue
+                for name in names:
+                    match = module['regex'].search(name)
+                    if not match:
+                        continue
+                    sample = name[:match.start()] if module['type'] == 'sample' else None
+                    if sample == '':
+                        continue
+                    found.append((module, os.path.join(directory, name), sample))
+        return found
+
+    def sample_collection(self, sample):
+        """Returns the local Sample collection of a sample, like pyrkit's links()."""
+        collections = [d for d in glob.glob(os.path.join(self.upload_directory, 'PI_Lab_*', 'Project_*',
+                                                         'Sample_*_{}'.format(glob.escape(sample))))
+                       if os.path.isdir(d)]
+        if len(collections) == 1:
+            return collections[0]
+        if sample not in self.unknown:
+            self.unknown.add(sample)
+            err('Warning: found {} Sample collections for sample {}, skipping its files'.format(
+                len(collections), sample))
+        return None
+
+    def generate(self, kind, files, collection, sample=None, analysis=True):
+        """Generates the metadata of files with meta, which also hashes them.
+        @param analysis <bool>:
+            Adds the analysis ID, and the Primary_Analysis collection of
+            per-sample files (not for the FastQ files, which are inputs)
+        @return generated <list[str]>:
+            Files with metadata
+        """
+        todo = [f for f in files if not os.path.exists(f + '.metadata.json')]
+        if todo:
+            command = [sys.executable, self.meta, kind, '-i'] + todo + ['-o', self.dme_path(collection)]
+            if sample is not None:
+                command += ['-s', sample]
+            if analysis:
+                command += ['-a', self.analysis['md5_all_inputs']]
+            if analysis and kind == 'sample':
+                command += ['-d', self.dme_path(self.analysis_home)]
+            try:
+                subprocess.check_call(command)
+            except (OSError, subprocess.CalledProcessError) as e:
+                err('Error: meta failed for {}: {}'.format(', '.join(todo), e))
+        return [f for f in files if os.path.exists(f + '.metadata.json')]
+
+    def link(self, source, target):
+        if not os.path.lexists(target):
+            os.symlink(source, target)
+
+    def archive_samples(self, found):
+        """Links, hashes and uploads the complete files of each sample.
+        @param found <list[tuple]>:
+            Complete per-sample files, see discover()
+        @return objects <list[str]>:
+            Files added to the upload hierarchy
+        """
+        samples = {}
+        for module, path, sample in found:
+            samples.setdefault(sample, []).append((module, path))
+
+        objects = []
+        for sample in sorted(samples):
+            collection = self.sample_collection(sample)
+            if collection is None:
+                continue
+            fastqs, others, sources = [], [], {}
+            for module, path in samples[sample]:
+                target = os.path.join(collection, renamed(module, os.path.basename(path), sample, self.analysis))
+                self.link(path, target)
+                sources[target] = path
+                self.archived.setdefault(sample, set()).add(module['name'])
+                (fastqs if module['name'] == 'fastq' else others).append(target)
+            for group in (fastqs, others):
+                if not group:
+                    continue
+                generated = self.generate('sample', group, collection, sample, analysis=group is others)
+                for target in group:
+                    if target in generated:
+                        objects.append(target)
+                    else:
+                        self.failed.add(sources[target])
+                print('Sample {}: {} file(s) complete'.format(sample, len(group)))
+            self.done.update(sources.values())
+
+        return objects
+
+    def archive_combined(self, found):
+        """Copies or links the multi-sample files into the Primary_Analysis
+        collection, once every file of DEG_ALL/ and Reports/ is complete. The
+        project request template is added along with the first of them.
+        @return objects <list[str]>:
+            Files added to the upload hierarchy
+        """
+        files = []
+        for module, path, _ in found:
+            target = os.path.join(self.analysis_home, renamed(module, os.path.basename(path), None, self.analysis))
+            if module['directory'] == 'DEG_ALL':
+                if not os.path.exists(target):
+                    reformat(path, target)
+            else:
+                self.link(path, target)
+            files.append(target)
+            self.done.add(path)
+        if self.request_template and not self.template_added:
+            target = os.path.join(self.analysis_home, os.path.basename(self.request_template))
+            self.link(self.request_template, target)
+            files.append(target)
+            self.template_added = True
+
+        generated = self.generate('combined', files, self.analysis_home)
+        print('Primary Analysis: {} file(s) complete'.format(len(generated)))
+        return generated
+
+    def upload(self, objects):
+        """Uploads data objects of the upload hierarchy with the collections they need."""
+        if not objects or self.uploader is None:
+            return
+        objects = set(objects)
+        ancestors = set()
+        for local in objects:
+            parent = os.path.dirname(local)
+            while parent.startswith(self.upload_directory + os.sep):
+                ancestors.add(parent)
+                parent = os.path.dirname(parent)
+        entries = [e for e in manifest(self.upload_directory, self.vault)
+                   if e['local'] in (objects if e['type'] == 'dataObject' else ancestors)]
+        self.uploader.run(entries)
+
+    def waiting(self):
+        """Lists the samples still missing files. A module that produced files
+        for a sample is expected to produce them for every sample.
+        @return waiting <list[str]>:
+            Samples of a Sample collection without a file of one of the
+            per-sample modules, or without any file yet
+        """
+        produced = set()
+        for modules in self.archived.values():
+            produced.update(modules)
+        return sorted(s for s in self.samples if not self.archived.get(s) or produced - self.archived[s])
+
+    def step(self, now=None):
+        """Looks for complete files once, archives them and uploads them.
+        @return finished <bool>:
+            True once DEG_ALL/ and Reports/ are archived, every expected sample
+            is, see waiting(), and no file, per-sample or multi-sample, is left
+            waiting to become complete
+        """
+        now = time.time() if now is None else now
+        found = [f for f in self.discover() if f[1] not in self.done and f[1] not in self.failed]
+        complete = [f for f in found if self.stability.update(f[1], now)]
+
+        samples = [f for f in complete if f[0]['type'] == 'sample']
+        objects = self.archive_samples(samples)
+        combined = [f for f in complete if f[0]['type'] == 'combined']
+        if not self.analysis_ready:
+            # Multi-sample files stay tracked until DEG_ALL/ and Reports/ are complete as a set
+            required = [m for m in self.modules if m['type'] == 'combined' and m['directory'] in COMBINED]
+            ready = set(f[0]['name'] for f in combined)
+            self.analysis_ready = all(m['name'] in ready for m in required)
+        if self.analysis_ready and combined:
+            objects += self.archive_combined(combined)
+            samples += combined
+        for _, path, _ in samples:
+            self.stability.forget(path)
+        self.upload(objects)
+
+        pending = [f for f in found if f not in complete]
+        return self.analysis_ready and not pending and not self.waiting()
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'watch: \
+                                                    archives the outputs of a running pipeline as they appear.')
+    parser.add_argument('input_directory',
+                        type = str,
+                        help = 'Required: Working directory of the pipeline. \
+                                Example: /scratch/ccbr123/RNA_hg38')
+    parser.add_argument('directory',
+                        type = str,
+                        help = 'Required: DME base directory for all intermediate output files. \
+                                It must contain the upload/ hierarchy and run_metadata.txt created by pyrkit. \
+                                Example: /scratch/ccbr123/RNA_hg38/DME')
+    parser.add_argument('vault',
+                        type = str,
+                        help = 'Required: DME vault to push data. \
+                                Example: /CCBR_Archive')
+    parser.add_argument('-c', '--config',
+                        type = str,
+                        default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                               'dev', 'config', 'rnaseq.yaml'),
+                        help = 'Optional: pyrkit config with the search patterns of each module. \
+                                Default: dev/config/rnaseq.yaml')
+    parser.add_argument('-m', '--multiqc-directory',
+                        type = str,
+                        default = '',
+                        help = 'Optional: MultiQC directory, also searched for multi-sample files \
+                                such as multiqc_matrix.tsv.')
+    parser.add_argument('-r', '--request-template',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Project request template added to the Primary_Analysis \
+                                collection.')
+    parser.add_argument('--stable',
+                        type = float,
+                        default = 300,
+                        help = 'Optional: Seconds the size and modification time of a file must stay \
+                                unchanged before it is archived. Default: 300')
+    parser.add_argument('--interval',
+                        type = float,
+                        default = 60,
+                        help = 'Optional: Seconds between two looks at the input directory when it \
+                                is polled. Default: 60')
+    parser.add_argument('--poll',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Always poll the input directory instead of using inotify.')
+    parser.add_argument('--timeout',
+                        type = float,
+                        default = 0,
+                        help = 'Optional: Stop watching after this many hours, 0 to watch until the \
+                                pipeline is archived. Default: 0')
+    parser.add_argument('-t', '--threads',
+                        type = int,
+                        default = 4,
+                        help = 'Optional: Number of concurrent requests of each upload. Default: 4')
+    parser.add_argument('--retries',
+                        type = int,
+                        default = 5,
+                        help = 'Optional: Maximum number of attempts of a request that fails with \
+                                a transient error. Default: 5')
+    parser.add_argument('--journal',
+                        type = str,
+                        default = '',
+                        help = 'Optional: Upload journal. Default: <directory>/upload.journal')
+    parser.add_argument('-n', '--dry-run',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Optional: Only add the files to the upload hierarchy, do not upload.')
+    # Overrides for the DME server
+    parser.add_argument('--dme-url',
+                        type = str,
+                        default = '',
+                        help = 'Optional: URL of the DME server, overrides the URL in \
+                                $HPC_DM_UTILS/hpcdme.properties.')
+    parser.add_argument('--dme-token',
+                        type = str,
+                        default = '',
+                        help = 'Optional: DME token, overrides the token in \
+                                $HPC_DM_UTILS/tokens/curl-conf.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    # Collect args
+    args = parsed_arguments()
+
+    for path in (args.input_directory, os.path.join(args.directory, 'upload')):
+        if not os.path.isdir(path):
+            err('Error: {} does not exist!'.format(path))
+            sys.exit(1)
+
+    uploader = None
+    if not args.dry_run:
+        session = dme.DMESession(args.dme_url, args.dme_token, pool_size=args.threads * 4)
+        retry = Retry(attempts=args.retries, breaker=CircuitBreaker(), transient=transient)
+        journal = Journal(args.journal or os.path.join(args.directory, 'upload.journal'))
+        uploader = Uploader(session, threads=args.threads, journal=journal, retry=retry)
+    meta = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meta')
+    try:
+        watch = Watch(args.input_directory, args.directory, args.vault, load_modules(args.config), meta,
+                      uploader=uploader, stable=args.stable, multiqc_directory=args.multiqc_directory,
+                      request_template=args.request_template)
+    except (IOError, ValueError) as e:
+        err('Error: {}'.format(e))
+        sys.exit(1)
+
+    inotify = None
+    if not args.poll and not polled(args.input_directory):
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            err('Warning: inotify is not available ({}), polling instead'.format(e))
+    print('Watching {} with {}'.format(watch.input_directory,
+          'inotify' if inotify is not None else 'polling every {:.0f} seconds'.format(args.interval)))
+
+    deadline = time.time() + args.timeout * 3600 if args.timeout > 0 else None
+    while True:
+        if inotify is not None:
+            for directory in watch.directories():
+                inotify.add(directory)
+        if watch.step():
+            break
+        if deadline is not None and time.time() >= deadline:
+            err('Error: stopped watching after {} hours before the pipeline was archived!'.format(args.timeout))
+            if watch.waiting():
+                err('Samples still missing files: {}'.format(', '.join(watch.waiting())))
+            sys.exit(1)
+        wait = watch.stability.next_check()
+        wait = args.interval if wait is None else min(wait + 1, args.interval)
+        if deadline is not None:
+            wait = min(wait, max(deadline - time.time(), 0))
+        if inotify is not None:
+            # Files being written wake the watch up continuously, look at most once a second
+            if inotify.wait(wait):
+                time.sleep(1)
+        else:
+            time.sleep(wait)
+
+    print('Archived {} files of {}'.format(len(watch.done) - len(watch.failed), watch.input_directory))
+    if uploader is not None:
+        print(summarize(uploader.stats))
+    if watch.failed or (uploader is not None and uploader.failed):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
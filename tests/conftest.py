@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""conftest: fixtures shared by the tests of the upload tools
+About:
+      The tests run the upload tools against the local stand-ins of HPC DME
+    (dme_server.py) and of an S3-compatible object store (s3_server.py). Each
+    test gets its own server, started on a free port with its own --root, and a
+    small upload hierarchy like the one initialize.py and meta write.
+USAGE:
+	$ python -m pytest tests
+"""
+
+from __future__ import print_function
+import os, sys, json, time, socket, hashlib, subprocess
+import pytest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'src'))
+
+# Credentials the stand-in object store expects by default
+S3_ACCESS_KEY, S3_SECRET_KEY, S3_BUCKET = 'test', 'testsecret', 'pyrkit'
+
+# Analysis ID of the outputs of the hierarchy, see pyrkit's fingerprint()
+ANALYSIS_ID = 'f63ab9966e22f548934c31172388b750'
+
+
+def free_port():
+    """Returns a TCP port nothing listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(script, root, *options):
+    """Starts a stand-in server and waits until it accepts connections.
+    @return process, url <tuple>:
+        Server process and its base URL
+    """
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(TESTS, script), '--port', str(port),
+                                '--root', str(root)] + list(options), stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError('{} did not start'.format(script))
+            time.sleep(0.05)
+
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+@pytest.fixture
+def dme_server(request, tmp_path):
+    """URL of a stand-in DME server. Tests can pass options to the server with
+    @pytest.mark.parametrize('dme_server', [[options]], indirect=True)."""
+    process, url = serve('dme_server.py', tmp_path / 'dme', *getattr(request, 'param', ()))
+    yield url
+    process.terminate()
+    process.wait()
+
+
+@pytest.fixture
+def hpc_dm_utils(dme_server, tmp_path, monkeypatch):
+    """$HPC_DM_UTILS of a DME toolkit set up for the stand-in DME server, for the
+    tools that read the URL and token of DME from it (i.e. validate.py)."""
+    utils = tmp_path / 'HPC_DM_UTILS'
+    os.makedirs(str(utils / 'tokens'))
+    with open(str(utils / 'hpcdme.properties'), 'w') as fh:
+        fh.write('hpc.server.url={}\n'.format(dme_server))
+    with open(str(utils / 'tokens' / 'curl-conf'), 'w') as fh:
+        fh.write('header = "Content-Type: application/json"\nheader = "Authorization: Bearer test"\n')
+    monkeypatch.setenv('HPC_DM_UTILS', str(utils))
+    return str(utils)
+
+
+@pytest.fixture
+def s3_server(tmp_path):
+    """URL of a stand-in object store with the bucket S3_BUCKET, and its --root."""
+    root = tmp_path / 's3'
+    process, url = serve('s3_server.py', root, '--bucket', S3_BUCKET,
+                         '--access-key', S3_ACCESS_KEY, '--secret-key', S3_SECRET_KEY)
+    yield url, root
+    process.terminate()
+    process.wait()
+
+
+def write_collection(directory, collection_type):
+    os.makedirs(directory)
+    with open(directory + '.metadata.json', 'w') as fh:
+        json.dump({'metadataEntries': [{'attribute': 'collection_type', 'value': collection_type}]}, fh)
+
+
+def write_object(filename, size, sample=None, analysis_id=None):
+    """Writes a data object of size bytes and its metadata, with the attributes
+    meta writes: the 9 common ones, sample_name for a per-sample file (-s) and
+    md5_all_inputs and md5_all_inputs_serial for the output of an analysis (-a)."""
+    contents = os.urandom(size)
+    with open(filename, 'wb') as fh:
+        fh.write(contents)
+    name = os.path.basename(filename)
+    path = filename.partition(os.sep + 'upload' + os.sep)[2]
+    entries = [('phi_content', 'Unspecified'), ('pii_content', 'Unspecified'),
+               ('data_encryption_status', 'Unspecified'), ('analysis_team', 'CCBR'),
+               ('object_name', '/CCBR_Archive/' + path if path else name), ('alias', os.path.realpath(filename)),
+               ('file_type', 'fastq' if '.fastq' in name else name.split('.')[-1]),
+               ('data_compression_status', 'Compressed' if name.endswith(('.gz', '.bam')) else 'Not Compressed'),
+               ('md5_checksum', hashlib.md5(contents).hexdigest())]
+    if sample:
+        entries.append(('sample_name', sample))
+    if analysis_id:
+        serial = '{}-{}-{}'.format(analysis_id[:3], analysis_id[16:18], analysis_id[-4:])
+        entries += [('md5_all_inputs', analysis_id), ('md5_all_inputs_serial', serial)]
+    with open(filename + '.metadata.json', 'w') as fh:
+        json.dump({'metadataEntries': [{'attribute': k, 'value': v} for k, v in entries]}, fh)
+
+
+@pytest.fixture
+def hierarchy(tmp_path):
+    """Local upload hierarchy with a PI_Lab, a Project, two Samples and a
+    Primary_Analysis collection. big.bam is large enough to be sent in parts
+    and to fill the window of a Tee with small blocks.
+    @return upload <str>:
+        Path of the upload/ directory
+    """
+    upload = tmp_path / 'DME' / 'upload'
+    project = os.path.join(str(upload), 'PI_Lab_A', 'Project_B')
+    write_collection(os.path.join(str(upload), 'PI_Lab_A'), 'PI_Lab')
+    write_collection(project, 'Project')
+    write_collection(os.path.join(project, 'Sample_1'), 'Sample')
+    write_collection(os.path.join(project, 'Sample_2'), 'Sample')
+    write_collection(os.path.join(project, 'Primary_Analysis_1'), 'Analysis')
+    write_object(os.path.join(project, 'Sample_1', 's1.R1.fastq.gz'), 200000, sample='s1')
+    write_object(os.path.join(project, 'Sample_1', 'big.bam'), 1500000, sample='s1', analysis_id=ANALYSIS_ID)
+    write_object(os.path.join(project, 'Sample_2', 's2.R1.fastq.gz'), 300000, sample='s2')
+    write_object(os.path.join(project, 'Primary_Analysis_1', 'report.html'), 5000, analysis_id=ANALYSIS_ID)
+    return str(upload)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""dme_server: a local stand-in for the HPC DME REST API
+About:
+      This program serves the subset of the HPC DME REST API that pyrkit uses,
+    so the upload tools can be exercised without a DME account or the DME
+    command line toolkit. Collections and metadata are kept in memory and the
+    contents of each data object are written under --root. Like DME, the parent
+    collection must exist before a collection or data object can be added to it.
+      Data objects can be sent in the body of the registration request, or to
+    presigned URLs (one per part for multipart uploads) when the registration
+    asks for them with 'generateUploadRequestURL'. --part-error-rate makes a
+    fraction of the presigned part uploads fail to exercise part retries, and
+    --error-rate does the same for registration requests. A registration with
+    'linkSourcePath' creates a link to an existing data object, and compound
+    metadata queries (AND, OR with EQUAL, NOT_EQUAL and LIKE) of data objects
+    and collections are answered one page at a time, of at most --max-page-size
+    records. Data objects can be downloaded whole or by byte range, and
+    --error-rate also fails a fraction of the downloads. Registering an existing
+    collection, or an existing data object without contents, adds or modifies
+    attributes and keeps the others, like DME.
+      Bulk registrations read the contents of each item from the local file
+    system ('fileSystemUploadSource'). They are processed before the task ID is
+    returned, and --error-rate fails a fraction of their items, so the status of
+    the task reports completed and failed items on its first poll.
+USAGE:
+	$ python tests/dme_server.py [--port PORT] [--root DIRECTORY]
+Example:
+    $ python tests/dme_server.py --port 8080 --root /tmp/dme &
+    $ python src/upload.py /scratch/ccbr123/RNA_hg38/DME /CCBR_Archive \
+        --dme-url http://localhost:8080 --dme-token test
+"""
+
+from __future__ import print_function
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import sys, os, re, json, uuid, random, hashlib, threading
+
+
+def merge(existing, entries):
+    """Adds or modifies attributes like DME, attributes that are not listed are kept."""
+    values = dict((p['attribute'], p['value']) for p in entries)
+    merged = [dict(p, value=values.pop(p['attribute'])) if p['attribute'] in values else p for p in existing]
+    return merged + [p for p in entries if p['attribute'] in values]
+
+
+class DMEState(object):
+    """In-memory collections and data objects of the stand-in server."""
+    def __init__(self, root):
+        self.root = root
+        self.collections = {}
+        self.objects = {}
+        self.uploads = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def parent_exists(self, path):
+        """Vaults (i.e. /CCBR_Archive) always exist, anything below must be registered."""
+        parent = os.path.dirname(path)
+        return parent.count('/') <= 1 or parent in self.collections
+
+
+class DMEHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without TCP_NODELAY every response
+    # on a kept-alive connection would wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send(self, code, body=None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _route(self):
+        url = urlparse(self.path)
+        for endpoint in ('/v2/dataObject', '/dataObject', '/collection', '/upload', '/registration'):
+            if url.path.startswith(endpoint + '/'):
+                return endpoint, unquote(url.path[len(endpoint):]), parse_qs(url.query)
+        return '', unquote(url.path), parse_qs(url.query)
+
+    def _drain(self):
+        length = int(self.headers.get('Content-Length', 0))
+        while length > 0:
+            length -= len(self.rfile.read(min(length, 1048576)))
+
+    def do_GET(self):
+        endpoint, path, query = self._route()
+        state = self.server.state
+        if endpoint == '/collection':
+            if path not in state.collections:
+                return self._send(404, {'message': 'Collection not found: {}'.format(path)})
+            objects = [{'path': p} for p in sorted(state.objects) if os.path.dirname(p) == path]
+            children = [{'collectionName': p} for p in sorted(state.collections) if os.path.dirname(p) == path]
+            return self._send(200, {'collections': [{
+                'collection': {'collectionName': path, 'dataObjects': objects, 'subCollections': children},
+                'metadataEntries': {'selfMetadataEntries': state.collections[path]}
+            }]})
+        if endpoint == '/registration':
+            task = state.tasks.get(path.lstrip('/'))
+            if task is None:
+                return self._send(404, {'message': 'Bulk registration task not found: {}'.format(path)})
+            return self._send(200, task)
+        if endpoint == '/v2/dataObject' and path.endswith('/download'):
+            return self._download(path[:-len('/download')])
+        if endpoint == '/v2/dataObject':
+            if path not in state.objects:
+                return self._send(404, {'message': 'Data object not found: {}'.format(path)})
+            obj = state.objects[path]
+            system = self._system_metadata(obj)
+            return self._send(200, {'metadataEntries': {'selfMetadataEntries': [
+                {'userMetadataEntries': obj['metadata'], 'systemMetadataEntries': system}
+            ]}})
+        return self._send(404, {'message': 'Unknown endpoint: {}'.format(self.path)})
+
+    def do_PUT(self):
+        endpoint, path, query = self._route()
+        state = self.server.state
+        if endpoint == '' and path == '/v2/registration':
+            length = int(self.headers.get('Content-Length', 0))
+            return self._send(200, self._bulk(json.loads(self.rfile.read(length) or b'{}')))
+        if endpoint in ('/collection', '/v2/dataObject') and random.random() < self.server.error_rate:
+            self._drain()
+            return self._send(503, {'message': 'Service unavailable'})
+        if endpoint == '/collection':
+            length = int(self.headers.get('Content-Length', 0))
+            metadata = json.loads(self.rfile.read(length) or b'{}')
+            if not state.parent_exists(path):
+                return self._send(400, {'message': 'Parent collection does not exist: {}'.format(path)})
+            with state.lock:
+                created = path not in state.collections
+                state.collections[path] = merge(state.collections.get(path, []), metadata.get('metadataEntries', []))
+            return self._send(201 if created else 200)
+        if endpoint == '/v2/dataObject':
+            if not state.parent_exists(path):
+                self._drain()
+                return self._send(400, {'message': 'Parent collection does not exist: {}'.format(path)})
+            registration, size, md5 = self._receive_multipart(path)
+            if size is None:
+                source = registration.get('linkSourcePath')
+                if source:
+                    if source not in state.objects:
+                        return self._send(404, {'message': 'Link source not found: {}'.format(source)})
+                    obj = state.objects[source]
+                    return self._send(self._store(path, registration.get('metadataEntries', []),
+                                                  obj['size'], obj['md5'],
+                                                  obj.get('file', os.path.join(state.root, source.lstrip('/')))))
+                if not registration.get('generateUploadRequestURL'):
+                    if path not in state.objects:
+                        return self._send(400, {'message': 'Missing dataObject part: {}'.format(path)})
+                    # Metadata update of an existing data object
+                    with state.lock:
+                        obj = state.objects[path]
+                        obj['metadata'] = merge(obj['metadata'], registration.get('metadataEntries', []))
+                    return self._send(200)
+                return self._send(200, self._presign(path, registration))
+            return self._send(self._store(path, registration.get('metadataEntries', []), size, md5))
+        if endpoint == '/upload':
+            return self._receive_part(path)
+        self._drain()
+        return self._send(404, {'message': 'Unknown endpoint: {}'.format(self.path)})
+
+    def do_POST(self):
+        endpoint, path, query = self._route()
+        state = self.server.state
+        if endpoint == '/v2/dataObject' and (path == '/query' or path.startswith('/query/')):
+            length = int(self.headers.get('Content-Length', 0))
+            return self._send(200, self._query(path[len('/query'):] or '/', json.loads(self.rfile.read(length) or b'{}')))
+        if endpoint == '/collection' and (path == '/query' or path.startswith('/query/')):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            return self._send(200, self._query_collections(path[len('/query'):] or '/', body))
+        if endpoint == '/dataObject' and path.endswith('/completeMultipartUpload'):
+            path = path[:-len('/completeMultipartUpload')]
+            length = int(self.headers.get('Content-Length', 0))
+            completion = json.loads(self.rfile.read(length) or b'{}')
+            with state.lock:
+                upload = state.uploads.pop(completion.get('multipartUploadId'), None)
+            if upload is None or upload['path'] != path:
+                return self._send(400, {'message': 'Unknown multipart upload for {}'.format(path)})
+            numbers = sorted(int(p['partNumber']) for p in completion.get('uploadParts', []))
+            if numbers != list(range(1, upload['nparts'] + 1)):
+                return self._send(400, {'message': 'Incomplete list of parts for {}'.format(path)})
+            size, md5 = self._assemble(path, [upload['parts'][n] for n in numbers])
+            return self._send(self._store(path, upload['metadata'], size, md5))
+        self._drain()
+        return self._send(404, {'message': 'Unknown endpoint: {}'.format(self.path)})
+
+    def _download(self, path):
+        """Sends the contents of a data object, or the byte range in the Range header."""
+        state = self.server.state
+        if path not in state.objects:
+            return self._send(404, {'message': 'Data object not found: {}'.format(path)})
+        if random.random() < self.server.error_rate:
+            return self._send(503, {'message': 'Service unavailable'})
+        obj = state.objects[path]
+        start, end = 0, obj['size'] - 1
+        ranged = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if ranged:
+            start = int(ranged.group(1))
+            end = min(int(ranged.group(2)), end) if ranged.group(2) else end
+        self.send_response(206 if ranged else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(max(end - start + 1, 0)))
+        if ranged:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, obj['size']))
+        self.end_headers()
+        with open(obj.get('file', os.path.join(state.root, path.lstrip('/'))), 'rb') as fh:
+            fh.seek(start)
+            left = end - start + 1
+            while left > 0:
+                buf = fh.read(min(left, 1048576))
+                if not buf:
+                    break
+                self.wfile.write(buf)
+                left -= len(buf)
+
+    def _system_metadata(self, obj):
+        return [{'attribute': 'source_file_size', 'value': str(obj['size'])},
+                {'attribute': 'checksum', 'value': obj['md5']}]
+
+    def _matches(self, query, values):
+        """Evaluates a compound query against the metadata of a data object."""
+        if 'attribute' in query:
+            value = values.get(query['attribute'])
+            operator = query.get('operator', 'EQUAL')
+            if operator == 'NOT_EQUAL':
+                return value is not None and value != query['value']
+            if value is None:
+                return False
+            if operator == 'LIKE':
+                pattern = '^' + re.escape(query['value']).replace('%', '.*').replace('_', '.') + '$'
+                return re.match(pattern, value, re.DOTALL) is not None
+            return value == query['value']
+        results = [self._matches(q, values) for q in query.get('queries', []) + query.get('compoundQueries', [])]
+        return any(results) if query.get('operator', 'AND') == 'OR' else all(results)
+
+    def _query(self, scope, body):
+        """Returns one page of the data objects under scope matching a compound query."""
+        state = self.server.state
+        compound = body.get('compoundQuery', {})
+        page, size = int(body.get('page', 1)), int(body.get('pageSize', 100))
+        if self.server.max_page_size:
+            size = min(size, self.server.max_page_size)
+        with state.lock:
+            objects = sorted(state.objects.items())
+        matches = []
+        for path, obj in objects:
+            if not path.startswith(scope.rstrip('/') + '/'):
+                continue
+            values = dict((p['attribute'], p['value']) for p in obj['metadata'] + self._system_metadata(obj))
+            if self._matches(compound, values):
+                matches.append({'dataObject': {'absolutePath': path}, 'metadataEntries': {'selfMetadataEntries': {
+                    'userMetadataEntries': obj['metadata'], 'systemMetadataEntries': self._system_metadata(obj)}}})
+        return {'dataObjects': matches[(page - 1) * size:page * size], 'page': page,
+                'limit': size, 'totalCount': len(matches)}
+
+    def _query_collections(self, scope, body):
+        """Returns one page of the collections under scope matching a compound query."""
+        state = self.server.state
+        compound = body.get('compoundQuery', {})
+        page, size = int(body.get('page', 1)), int(body.get('pageSize', 100))
+        if self.server.max_page_size:
+            size = min(size, self.server.max_page_size)
+        with state.lock:
+            collections = sorted(state.collections.items())
+        matches = []
+        for path, metadata in collections:
+            if not path.startswith(scope.rstrip('/') + '/'):
+                continue
+            if self._matches(compound, dict((p['attribute'], p['value']) for p in metadata)):
+                matches.append({'collection': {'absolutePath': path, 'collectionName': path},
+                                'metadataEntries': {'selfMetadataEntries': metadata}})
+        return {'collections': matches[(page - 1) * size:page * size], 'page': page,
+                'limit': size, 'totalCount': len(matches)}
+
+    def _store(self, path, metadata, size, md5, filename=None):
+        state = self.server.state
+        with state.lock:
+            created = path not in state.objects
+            state.objects[path] = {'metadata': metadata, 'size': size, 'md5': md5}
+            if filename is not None:
+                state.objects[path]['file'] = filename # Links share the contents of their source
+        return 201 if created else 200
+
+    def _bulk(self, registration):
+        """Registers the items of a bulk registration from the local file system."""
+        state = self.server.state
+        task = {'taskId': uuid.uuid4().hex, 'completed': True, 'result': True,
+                'completedItems': [], 'failedItems': [], 'inProgressItems': []}
+        for item in registration.get('dataObjectRegistrationItems', []):
+            path = item['path']
+            source = item.get('fileSystemUploadSource', {}).get('sourceLocation', {}).get('fileId', '')
+            message = None
+            if random.random() < self.server.error_rate:
+                message = 'Service unavailable'
+            elif not state.parent_exists(path):
+                message = 'Parent collection does not exist: {}'.format(path)
+            elif not os.path.isfile(source):
+                message = 'File not found: {}'.format(source)
+            if message is not None:
+                task['failedItems'].append({'request': {'path': path}, 'message': message})
+                continue
+            destination = os.path.join(state.root, path.lstrip('/'))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            hasher, size = hashlib.md5(), 0
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                for buf in iter(lambda: src.read(1048576), b''):
+                    hasher.update(buf)
+                    dst.write(buf)
+                    size += len(buf)
+            self._store(path, item.get('dataObjectMetadataEntries', []), size, hasher.hexdigest())
+            task['completedItems'].append({'request': {'path': path}})
+        task['result'] = not task['failedItems']
+        with state.lock:
+            state.tasks[task['taskId']] = task
+        return task
+
+    def _presign(self, path, registration):
+        """Creates presigned URLs for a data object registered without contents."""
+        upload_id = uuid.uuid4().hex
+        nparts = int(registration.get('uploadParts', 1))
+        base = 'http://{}/upload/{}'.format(self.headers['Host'], upload_id)
+        with self.server.state.lock:
+            self.server.state.uploads[upload_id] = {'path': path, 'nparts': nparts, 'parts': {},
+                                                    'metadata': registration.get('metadataEntries', [])}
+        if nparts <= 1:
+            return {'uploadRequestURL': '{}/1'.format(base)}
+        return {'multipartUpload': {'id': upload_id, 'parts': [
+            {'partNumber': n, 'partUploadRequestURL': '{}/{}'.format(base, n)} for n in range(1, nparts + 1)
+        ]}}
+
+    def _receive_part(self, path):
+        """Stores one part sent to a presigned URL, returns its MD5 as the ETag."""
+        state = self.server.state
+        upload_id, number = path.strip('/').split('/')
+        upload = state.uploads.get(upload_id)
+        if upload is None or random.random() < self.server.part_error_rate:
+            self._drain()
+            return self._send(503 if upload else 404, {'message': 'Part upload failed'})
+        destination = os.path.join(state.root, '.parts', '{}.{}'.format(upload_id, number))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        hasher, left = hashlib.md5(), int(self.headers.get('Content-Length', 0))
+        with open(destination, 'wb') as fh:
+            while left > 0:
+                buf = self.rfile.read(min(left, 1048576))
+                if not buf:
+                    break
+                fh.write(buf)
+                hasher.update(buf)
+                left -= len(buf)
+        with state.lock:
+            upload['parts'][int(number)] = destination
+        if upload['nparts'] <= 1:
+            # A single presigned URL needs no completion request
+            with state.lock:
+                state.uploads.pop(upload_id, None)
+            size, md5 = self._assemble(upload['path'], [destination])
+            self._store(upload['path'], upload['metadata'], size, md5)
+        self.send_response(200)
+        self.send_header('ETag', '"{}"'.format(hasher.hexdigest()))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _assemble(self, path, parts):
+        """Concatenates uploaded parts into the data object, returns its size and MD5."""
+        destination = os.path.join(self.server.state.root, path.lstrip('/'))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        hasher, size = hashlib.md5(), 0
+        with open(destination, 'wb') as out:
+            for part in parts:
+                with open(part, 'rb') as fh:
+                    buf = fh.read(1048576)
+                    while buf:
+                        out.write(buf)
+                        hasher.update(buf)
+                        size += len(buf)
+                        buf = fh.read(1048576)
+                os.remove(part)
+        return size, hasher.hexdigest()
+
+    def _receive_multipart(self, path):
+        """Streams a dataObjectRegistration + dataObject multipart body to disk.
+        Returns the registration, and the size and MD5 of the data object, or
+        None for both when the body holds no dataObject part."""
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+        remaining = int(self.headers['Content-Length'])
+        trailer = len(b'\r\n--' + boundary + b'--\r\n')
+
+        consumed = [0]
+        def readline():
+            line = self.rfile.readline(65536)
+            consumed[0] += len(line)
+            return line
+
+        def skip_headers():
+            line = readline()
+            while line not in (b'\r\n', b''):
+                line = readline()
+
+        # Registration JSON part
+        readline()
+        skip_headers()
+        registration = b''
+        line = readline()
+        while line and not line.startswith(b'--' + boundary):
+            registration += line
+            line = readline()
+        registration = json.loads(registration.rstrip(b'\r\n') or b'{}')
+        if not line or line.rstrip(b'\r\n').endswith(b'--'):
+            self.rfile.read(remaining - consumed[0])
+            return registration, None, None
+        skip_headers()
+
+        # File part, everything up to the closing boundary
+        destination = os.path.join(self.server.state.root, path.lstrip('/'))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        hasher, size, left = hashlib.md5(), 0, remaining - consumed[0] - trailer
+        with open(destination, 'wb') as fh:
+            while left > 0:
+                buf = self.rfile.read(min(left, 1048576))
+                if not buf:
+                    break
+                fh.write(buf)
+                hasher.update(buf)
+                size += len(buf)
+                left -= len(buf)
+        self.rfile.read(trailer)
+
+        return registration, size, hasher.hexdigest()
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'dme_server: a local stand-in for the HPC DME REST API.')
+    parser.add_argument('--host', type = str, default = '127.0.0.1',
+                        help = 'Optional: Address to listen on. Default: 127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8080,
+                        help = 'Optional: Port to listen on. Default: 8080')
+    parser.add_argument('--root', type = str, default = 'dme_server',
+                        help = 'Optional: Directory where data object contents are written. Default: dme_server')
+    parser.add_argument('--part-error-rate', type = float, default = 0.0,
+                        help = 'Optional: Fraction of presigned part uploads that fail with 503. Default: 0')
+    parser.add_argument('--error-rate', type = float, default = 0.0,
+                        help = 'Optional: Fraction of collection and data object registrations, \
+                                and of downloads, that fail with 503. Default: 0')
+    parser.add_argument('--max-page-size', type = int, default = 0,
+                        help = 'Optional: Largest page of query results, whatever pageSize the \
+                                query asks for. Default: 0 (no limit)')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False,
+                        help = 'Optional: Log every request to standard error.')
+
+    return parser.parse_args()
+
+
+def main():
+
+    args = parsed_arguments()
+    server = ThreadingHTTPServer((args.host, args.port), DMEHandler)
+    server.state = DMEState(os.path.abspath(args.root))
+    server.verbose = args.verbose
+    server.part_error_rate = args.part_error_rate
+    server.error_rate = args.error_rate
+    server.max_page_size = args.max_page_size
+    print('Serving stand-in DME API on http://{}:{}'.format(args.host, server.server_port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""s3_server: a local stand-in for an S3-compatible object store
+About:
+      This program serves the subset of the S3 REST API that the S3 backend of
+    upload.py uses (see src/storage.py), so it can be exercised without an
+    object store. Buckets are addressed by path (http://host/<bucket>/<key>)
+    and only the buckets given with --bucket exist. Object contents are written
+    under --root and their tags are kept in memory.
+      Every request must be signed with AWS Signature Version 4 for the
+    --access-key and --secret-key of the server, otherwise it is rejected with
+    403 like S3 does. Objects can be stored with a single PUT or with a
+    multipart upload (create, upload parts, complete or abort), read whole, and
+    listed with ListObjectsV2. --error-rate makes a fraction of the object and
+    part uploads fail with 503 to exercise retries.
+USAGE:
+	$ python tests/s3_server.py [--port PORT] [--root DIRECTORY] [--bucket NAME]
+Example:
+    $ python tests/s3_server.py --port 9000 --root /tmp/s3 --bucket staging &
+    $ AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=testsecret \
+        python src/upload.py /scratch/ccbr123/RNA_hg38/DME /CCBR_Archive \
+        --backend s3 --s3-endpoint http://localhost:9000 --s3-bucket staging
+"""
+
+from __future__ import print_function
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl, unquote, quote
+from xml.sax.saxutils import escape
+import sys, os, re, hmac, uuid, random, hashlib, threading
+
+
+class S3State(object):
+    """In-memory objects and multipart uploads of the stand-in server."""
+    def __init__(self, root, buckets):
+        self.root = root
+        self.buckets = set(buckets)
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without TCP_NODELAY every response
+    # on a kept-alive connection would wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send(self, code, body=b'', headers=None):
+        payload = body.encode() if isinstance(body, str) else body
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/xml')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _error(self, code, name, message, drain=True):
+        if drain:
+            self._drain()
+        return self._send(code, '<Error><Code>{}</Code><Message>{}</Message></Error>'.format(name, escape(message)))
+
+    def _drain(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        while length > 0:
+            length -= len(self.rfile.read(min(length, 1048576)))
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _route(self):
+        """Returns the bucket, key and query of a path-style request."""
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        return unquote(bucket), unquote(key), dict(parse_qsl(url.query, keep_blank_values=True))
+
+    def _authorized(self):
+        """Recomputes the AWS Signature Version 4 of the request."""
+        match = re.match(r'AWS4-HMAC-SHA256 Credential=([^/]+)/(\d{8})/([^/]+)/([^/]+)/aws4_request, '
+                         r'SignedHeaders=([^,]+), Signature=([0-9a-f]+)$', self.headers.get('Authorization', ''))
+        if not match or match.group(1) != self.server.access_key:
+            return False
+        _, date, region, service, names, signature = match.groups()
+        url = urlparse(self.path)
+        query = sorted((quote(unquote(k), safe='-_.~'), quote(unquote(v), safe='-_.~'))
+                       for k, v in parse_qsl(url.query, keep_blank_values=True))
+        canonical = '\n'.join([
+            self.command, url.path,
+            '&'.join('{}={}'.format(k, v) for k, v in query),
+            ''.join('{}:{}\n'.format(n, (self.headers.get(n) or '').strip()) for n in names.split(';')),
+            names, self.headers.get('x-amz-content-sha256', '')
+        ])
+        amz_date = self.headers.get('x-amz-date', '')
+        scope = '{}/{}/{}/aws4_request'.format(date, region, service)
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+        key = ('AWS4' + self.server.secret_key).encode()
+        for value in (date, region, service, 'aws4_request'):
+            key = hmac.new(key, value.encode(), hashlib.sha256).digest()
+        return hmac.compare_digest(hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest(), signature)
+
+    def _checked(self):
+        """Authenticates the request and checks that its bucket exists."""
+        bucket, key, query = self._route()
+        if not self._authorized():
+            self._error(403, 'SignatureDoesNotMatch', 'The request signature does not match')
+            return None
+        if bucket not in self.server.state.buckets:
+            self._error(404, 'NoSuchBucket', 'The specified bucket does not exist: {}'.format(bucket))
+            return None
+        return bucket, key, query
+
+    def _signed_body(self):
+        """Reads the body of the request and checks its payload hash."""
+        body = self._body()
+        expected = self.headers.get('x-amz-content-sha256', '')
+        if expected != 'UNSIGNED-PAYLOAD' and hashlib.sha256(body).hexdigest() != expected:
+            return None
+        return body
+
+    def _write(self, destination):
+        """Streams the body of the request to a file and returns its size and MD5."""
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        hasher, size = hashlib.md5(), 0
+        with open(destination, 'wb') as fh:
+            while size < length:
+                buf = self.rfile.read(min(length - size, 1048576))
+                if not buf:
+                    break
+                hasher.update(buf)
+                fh.write(buf)
+                size += len(buf)
+        return size, hasher.hexdigest()
+
+    def do_HEAD(self):
+        routed = self._checked()
+        if routed is None:
+            return
+        bucket, key, _ = routed
+        obj = self.server.state.objects.get((bucket, key))
+        if obj is None:
+            return self._send(404)
+        self.send_response(200)
+        self.send_header('ETag', '"{}"'.format(obj['etag']))
+        self.send_header('Content-Length', str(obj['size']))
+        self.end_headers()
+
+    def do_GET(self):
+        routed = self._checked()
+        if routed is None:
+            return
+        bucket, key, query = routed
+        state = self.server.state
+        if not key:
+            prefix = query.get('prefix', '')
+            with state.lock:
+                keys = sorted((k, o) for (b, k), o in state.objects.items() if b == bucket and k.startswith(prefix))
+            contents = ''.join('<Contents><Key>{}</Key><Size>{}</Size><ETag>"{}"</ETag></Contents>'.format(
+                               escape(k), o['size'], o['etag']) for k, o in keys)
+            return self._send(200, '<ListBucketResult><Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount>'
+                                   '<IsTruncated>false</IsTruncated>{}</ListBucketResult>'.format(
+                                   escape(bucket), escape(prefix), len(keys), contents))
+        obj = state.objects.get((bucket, key))
+        if obj is None:
+            return self._error(404, 'NoSuchKey', 'The specified key does not exist: {}'.format(key))
+        if 'tagging' in query:
+            tagset = ''.join('<Tag><Key>{}</Key><Value>{}</Value></Tag>'.format(escape(k), escape(v))
+                             for k, v in obj['tags'])
+            return self._send(200, '<Tagging><TagSet>{}</TagSet></Tagging>'.format(tagset))
+        with open(os.path.join(state.root, bucket, key), 'rb') as fh:
+            return self._send(200, fh.read(), {'ETag': '"{}"'.format(obj['etag'])})
+
+    def do_PUT(self):
+        routed = self._checked()
+        if routed is None:
+            return
+        bucket, key, query = routed
+        state = self.server.state
+        if random.random() < self.server.error_rate:
+            return self._error(503, 'SlowDown', 'Please reduce your request rate')
+        if 'uploadId' in query:
+            with state.lock:
+                upload = state.uploads.get(query['uploadId'])
+            if upload is None or upload['key'] != key:
+                return self._error(404, 'NoSuchUpload', 'The specified upload does not exist')
+            number = int(query.get('partNumber', 0))
+            destination = os.path.join(state.root, '.parts', '{}.{}'.format(query['uploadId'], number))
+            size, md5 = self._write(destination)
+            with state.lock:
+                upload['parts'][number] = (destination, size, md5)
+            return self._send(200, headers={'ETag': '"{}"'.format(md5)})
+
+        tags = parse_qsl(self.headers.get('x-amz-tagging', ''), keep_blank_values=True)
+        if len(tags) > 10:
+            return self._error(400, 'InvalidTag', 'Object tags cannot be greater than 10')
+        if self.headers.get('x-amz-content-sha256') == 'UNSIGNED-PAYLOAD':
+            size, md5 = self._write(os.path.join(state.root, bucket, key))
+        else:
+            body = self._signed_body()
+            if body is None:
+                return self._error(400, 'XAmzContentSHA256Mismatch', 'The payload hash does not match', drain=False)
+            destination = os.path.join(state.root, bucket, key)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, 'wb') as fh:
+                fh.write(body)
+            size, md5 = len(body), hashlib.md5(body).hexdigest()
+        with state.lock:
+            state.objects[(bucket, key)] = {'size': size, 'etag': md5, 'tags': tags}
+        return self._send(200, headers={'ETag': '"{}"'.format(md5)})
+
+    def do_POST(self):
+        routed = self._checked()
+        if routed is None:
+            return
+        bucket, key, query = routed
+        state = self.server.state
+        body = self._signed_body()
+        if body is None:
+            return self._error(400, 'XAmzContentSHA256Mismatch', 'The payload hash does not match', drain=False)
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with state.lock:
+                state.uploads[upload_id] = {'key': key, 'parts': {},
+                                            'tags': parse_qsl(self.headers.get('x-amz-tagging', ''))}
+            return self._send(200, '<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>'
+                                   '<UploadId>{}</UploadId></InitiateMultipartUploadResult>'.format(
+                                   escape(bucket), escape(key), upload_id))
+        if 'uploadId' in query:
+            with state.lock:
+                upload = state.uploads.pop(query['uploadId'], None)
+            if upload is None or upload['key'] != key:
+                return self._error(404, 'NoSuchUpload', 'The specified upload does not exist')
+            listed = [(int(n), e) for n, e in re.findall(
+                r'<PartNumber>(\d+)</PartNumber>\s*<ETag>"?([0-9a-f]+)"?</ETag>', body.decode())]
+            if [n for n, _ in listed] != list(range(1, len(upload['parts']) + 1)) or \
+                    any(upload['parts'][n][2] != e for n, e in listed):
+                return self._send(200, '<Error><Code>InvalidPart</Code><Message>One or more of the specified '
+                                       'parts could not be found</Message></Error>')
+            destination = os.path.join(state.root, bucket, key)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            digests, size = hashlib.md5(), 0
+            with open(destination, 'wb') as fh:
+                for number, _ in listed:
+                    filename, length, md5 = upload['parts'][number]
+                    with open(filename, 'rb') as part:
+                        for buf in iter(lambda: part.read(1048576), b''):
+                            fh.write(buf)
+                    os.remove(filename)
+                    digests.update(bytes.fromhex(md5))
+                    size += length
+            etag = '{}-{}'.format(digests.hexdigest(), len(listed))
+            with state.lock:
+                state.objects[(bucket, key)] = {'size': size, 'etag': etag, 'tags': upload['tags']}
+            return self._send(200, '<CompleteMultipartUploadResult><Key>{}</Key><ETag>"{}"</ETag>'
+                                   '</CompleteMultipartUploadResult>'.format(escape(key), etag))
+        return self._error(400, 'InvalidRequest', 'Unsupported POST request', drain=False)
+
+    def do_DELETE(self):
+        routed = self._checked()
+        if routed is None:
+            return
+        bucket, key, query = routed
+        state = self.server.state
+        if 'uploadId' in query:
+            with state.lock:
+                upload = state.uploads.pop(query['uploadId'], None)
+            for filename, _, _ in (upload or {'parts': {}})['parts'].values():
+                if os.path.exists(filename):
+                    os.remove(filename)
+            return self._send(204)
+        with state.lock:
+            state.objects.pop((bucket, key), None)
+        filename = os.path.join(state.root, bucket, key)
+        if os.path.exists(filename):
+            os.remove(filename)
+        return self._send(204)
+
+
+def parsed_arguments():
+    """Parses user-provided command-line arguments. Requires argparse package.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 's3_server: a local stand-in for an S3-compatible object store.')
+    parser.add_argument('--host', type = str, default = '127.0.0.1',
+                        help = 'Optional: Address to listen on. Default: 127.0.0.1')
+    parser.add_argument('--port', type = int, default = 9000,
+                        help = 'Optional: Port to listen on. Default: 9000')
+    parser.add_argument('--root', type = str, default = 's3_server',
+                        help = 'Optional: Directory where object contents are written. Default: s3_server')
+    parser.add_argument('--bucket', type = str, action = 'append', default = [],
+                        help = 'Optional: Bucket that exists, can be provided more than once. Default: pyrkit')
+    parser.add_argument('--access-key', type = str, default = 'test',
+                        help = 'Optional: Access key requests must be signed with. Default: test')
+    parser.add_argument('--secret-key', type = str, default = 'testsecret',
+                        help = 'Optional: Secret key requests must be signed with. Default: testsecret')
+    parser.add_argument('--error-rate', type = float, default = 0.0,
+                        help = 'Optional: Fraction of object and part uploads that fail with 503. Default: 0')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False,
+                        help = 'Optional: Log every request to standard error.')
+
+    return parser.parse_args()
+
+
+def main():
+
+    args = parsed_arguments()
+    server = ThreadingHTTPServer((args.host, args.port), S3Handler)
+    server.state = S3State(os.path.abspath(args.root), args.bucket or ['pyrkit'])
+    server.verbose = args.verbose
+    server.access_key = args.access_key
+    server.secret_key = args.secret_key
+    server.error_rate = args.error_rate
+    print('Serving stand-in S3 API on http://{}:{}'.format(args.host, server.server_port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_batch: several projects archived with one shared upload pool"""
+
+from __future__ import print_function
+import os, sys, subprocess
+import pytest
+
+import dme_utils as dme
+from conftest import TESTS, write_collection, write_object
+from batch import projects, gather, progress
+from journal import Journal
+from upload import Uploader, manifest, pending
+
+VAULT = '/CCBR_Archive'
+
+
+@pytest.fixture
+def batch(tmp_path):
+    """Two prepared projects of the same PI_Lab, and the list of projects.
+    @return filename, projects <tuple>:
+    """
+    lines = []
+    for name, sizes in (('RNA_1', (300000, 5000)), ('RNA_2', (20000,))):
+        upload = os.path.join(str(tmp_path / name), 'DME', 'upload')
+        project = os.path.join(upload, 'PI_Lab_A', 'Project_{}'.format(name))
+        write_collection(os.path.join(upload, 'PI_Lab_A'), 'PI_Lab')
+        write_collection(project, 'Project')
+        write_collection(os.path.join(project, 'Sample_1'), 'Sample')
+        for i, size in enumerate(sizes):
+            write_object(os.path.join(project, 'Sample_1', 'file_{}.bam'.format(i)), size)
+        lines.append('{} {} {}\n'.format(str(tmp_path / name), str(tmp_path / 'template.xlsx'),
+                                         str(tmp_path / name / 'multiqc')))
+    filename = str(tmp_path / 'projects.tsv')
+    with open(filename, 'w') as fh:
+        fh.write('# input\ttemplate\tmultiqc\n' + ''.join(lines))
+    return filename, projects(filename)
+
+
+def test_projects(tmp_path):
+    filename = str(tmp_path / 'projects.tsv')
+    with open(filename, 'w') as fh:
+        fh.write('/data/a/RNA\tt.xlsx\tmqc\n\n/data/b/RNA t.xlsx mqc CCBR-123\n')
+    found = projects(filename)
+    # Projects with the same directory name are told apart by their path
+    assert [p['name'] for p in found] == ['RNA', '/data/b/RNA']
+    assert [p['project_id'] for p in found] == ['', 'CCBR-123']
+    with open(filename, 'a') as fh:
+        fh.write('/data/c/RNA t.xlsx\n')
+    with pytest.raises(ValueError):
+        projects(filename)
+
+
+def test_gather_lists_shared_collections_once(batch):
+    entries = gather(batch[1], VAULT)
+    paths = [e['path'] for e in entries]
+    assert paths.count(VAULT + '/PI_Lab_A') == 1
+    assert len(paths) == len(set(paths)) == 1 + 2 * 2 + 3
+    assert set(e['project'] for e in entries if e['type'] == 'dataObject') == set(['RNA_1', 'RNA_2'])
+
+
+def test_progress(batch, dme_server):
+    entries = gather(batch[1], VAULT)
+    totals = {'RNA_1': 305000, 'RNA_2': 20000}
+    journals = dict((p['name'], Journal(os.path.join(p['input'], 'DME', 'upload.journal'))) for p in batch[1])
+    uploader = Uploader(dme.DMESession(dme_server, 'test'), journals=journals)
+    assert progress(uploader, totals) == [
+        'RNA_1: 0.00/0.00 GB (0.0%), 0 data objects, 0 failed',
+        'RNA_2: 0.00/0.00 GB (0.0%), 0 data objects, 0 failed']
+    assert uploader.run(entries)['failed'] == 0
+    assert [line.split(', ', 1)[1] for line in progress(uploader, totals)] == [
+        '2 data objects, 0 failed', '1 data objects, 0 failed']
+    assert all('(100.0%)' in line for line in progress(uploader, totals))
+    # Each project keeps its own journal
+    for project in batch[1]:
+        journal = Journal(os.path.join(project['input'], 'DME', 'upload.journal'))
+        objects = [e for e in manifest(os.path.join(project['input'], 'DME', 'upload'), VAULT)
+                   if e['type'] == 'dataObject']
+        assert pending(objects, journal) == []
+
+
+def test_batch_upload(batch, dme_server, tmp_path):
+    command = [sys.executable, os.path.join(os.path.dirname(TESTS), 'src', 'batch.py'), batch[0], VAULT,
+               '--skip-prepare', '--threads', '4', '--progress', '0.01', '--dme-url', dme_server,
+               '--dme-token', 'test', '--history', str(tmp_path / 'history.jsonl')]
+    first = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    assert first.returncode == 0
+    assert 'RNA_1: 0.00 GB to upload' in first.stdout
+    assert 'RNA_2: ' in first.stdout and ', 0 failed' in first.stdout
+    session = dme.DMESession(dme_server, 'test')
+    for project in batch[1]:
+        for entry in manifest(os.path.join(project['input'], 'DME', 'upload'), VAULT):
+            if entry['type'] == 'dataObject':
+                assert int(session.get_dataObject_attributes(entry['path'])['source_file_size']) == entry['size']
+
+    # The journals of the projects tell the next batch there is nothing left
+    second = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    assert second.returncode == 0
+    assert 'Registered dataObject ' not in second.stdout
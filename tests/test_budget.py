@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_budget: upload jobs that stop before their time limit and are requeued"""
+
+from __future__ import print_function
+import os, sys, time, subprocess
+
+import dme_utils as dme
+from conftest import TESTS
+from budget import TimeBudget, job_end_time, EXIT_REQUEUE
+from scheduler import Scheduler
+from upload import Uploader, manifest
+
+VAULT = '/CCBR_Archive'
+
+
+def test_job_end_time(monkeypatch):
+    monkeypatch.delenv('SLURM_JOB_ID', raising=False)
+    monkeypatch.delenv('SLURM_JOB_END_TIME', raising=False)
+    assert job_end_time() is None
+    monkeypatch.setenv('SLURM_JOB_END_TIME', '1700000000')
+    assert job_end_time() == 1700000000.0
+
+
+def test_budget_keeps_a_reserve():
+    budget = TimeBudget(time.time() + 1000, reserve=600, safety=2.0)
+    assert 399 < budget.remaining() <= 400
+    assert budget.allows(150)
+    assert not budget.allows(250)
+
+
+def test_deferred_entries(hierarchy):
+    budget = TimeBudget(time.time() + 100, reserve=0)
+    # About 1 kB/s, so only report.html fits in the time left
+    scheduler = Scheduler(2, throughput=1024, overhead=0)
+    uploader = Uploader(dme.DMESession('http://127.0.0.1:1', 'test'), budget=budget, scheduler=scheduler)
+    uploader.session.register_collection = lambda path, metadata: None
+    uploader.session.register_dataobject = lambda path, source, metadata, **kwargs: None
+    stats = uploader.run(manifest(hierarchy, VAULT))
+    assert stats['collections'] == 5 and stats['dataObjects'] == 1
+    assert stats['deferred'] == 3
+    assert sorted(os.path.basename(e['path']) for e in uploader.deferred) == [
+        'big.bam', 's1.R1.fastq.gz', 's2.R1.fastq.gz']
+
+
+def test_upload_exits_to_be_requeued(dme_server, hierarchy):
+    directory = os.path.dirname(hierarchy)
+    command = [sys.executable, os.path.join(os.path.dirname(TESTS), 'src', 'upload.py'), directory, VAULT,
+               '--dme-url', dme_server, '--dme-token', 'test', '--throughput', '0.001', '--reserve', '0',
+               '--history', os.path.join(directory, 'history.jsonl')]
+    first = subprocess.run(command + ['--deadline', str(time.time() + 100)],
+                           stdout=subprocess.PIPE, universal_newlines=True)
+    assert first.returncode == EXIT_REQUEUE
+    assert 'Stopped before the time limit of the job, 3 entries left to upload' in first.stdout
+
+    # The next job uploads what is left, the journal tells it what that is
+    second = subprocess.run(command + ['--deadline', 'none'], stdout=subprocess.PIPE, universal_newlines=True)
+    assert second.returncode == 0
+    assert second.stdout.count('Registered dataObject ') == 3
+    assert ', 6 skipped, 0 failed' in second.stdout
+    session = dme.DMESession(dme_server, 'test')
+    for entry in manifest(hierarchy, VAULT):
+        if entry['type'] == 'dataObject':
+            assert int(session.get_dataObject_attributes(entry['path'])['source_file_size']) == entry['size']
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_conform: the rules of the vaults, and the hierarchy initialize.py builds"""
+
+from __future__ import print_function
+import os, sys, json, subprocess
+import pytest
+
+from conftest import TESTS
+from conform import rules, load, check
+
+VAULT = '/CCBR_Archive'
+REPO = os.path.dirname(TESTS)
+
+# Answers of a project request, on the sheet lint.py reads
+PROJECT = {
+    'Data Owner': 'Harris, Curtis', 'Data Owner Affiliation': 'Laboratory of Human Carcinogenesis (LHC)',
+    'Data Generator (for the Data Owner)': 'Doe, Jane', 'Project Scientist/Project POC': 'Mullis, Kary',
+    'Project Scientist/Project POC Email': 'kary.mullis@nih.gov', 'Key Collaborator(s)': 'Franklin, Rosalind',
+    'Start Date': '2021-07-07', 'Project ID': 'CCBR-123', 'Project Title': 'Profiling the transcriptome',
+    'Project Description': 'Expression profile of tumors', 'Data Generating Facility': 'ATRF SF',
+    'Sequencing Platform': 'Illumina NovaSeq', 'Is Cell Line?': 'No', 'Organism': 'Homo sapiens'
+}
+SAMPLES = [{'Sample Name': name, 'Raw Data Sample Name': name, 'Subject ID': subject, 'Disease': 'Lung Cancer',
+            'Library Strategy': 'RNA-Seq', 'Analyte Type': 'RNA'} for name, subject in (('WT1', 'S1'), ('KO1', 'S2'))]
+
+
+def pairs(**values):
+    return {'metadataEntries': [{'attribute': k, 'value': v} for k, v in sorted(values.items())]}
+
+
+def write(directory, name, metadata=None, contents=None):
+    """Adds a collection, or a data object with contents, and its metadata."""
+    path = os.path.join(directory, name)
+    if contents is None:
+        os.makedirs(path)
+    else:
+        with open(path, 'w') as fh:
+            fh.write(contents)
+    if metadata is not None:
+        with open(path + '.metadata.json', 'w') as fh:
+            json.dump(metadata, fh)
+    return path
+
+
+def data_object(path, **values):
+    metadata = dict(object_name=path, file_type='bam', md5_checksum='0' * 32, phi_content='Unspecified',
+                    pii_content='Unspecified', data_encryption_status='Not Encrypted',
+                    data_compression_status='Compressed', analysis_team='CCBR')
+    metadata.update(values)
+    return pairs(**metadata)
+
+
+@pytest.fixture
+def upload(tmp_path):
+    """Upload hierarchy that follows the rules of /CCBR_Archive."""
+    root = str(tmp_path / 'upload')
+    lab = write(root, 'PI_Lab_CurtisHarris_LHC', pairs(collection_type='PI_Lab', pi_name='Harris, Curtis',
+                                                        data_owner='Harris, Curtis', affiliation='LHC'))
+    project = write(lab, 'Project_KaryMullis_ATRF-SF_2RNA-Seq_Homo-sapiens_2021-07-07', pairs(
+        collection_type='Project', project_title='T', project_description='D', project_start_date='2021-07-07',
+        contact_name='Mullis, Kary', poc_email='k@nih.gov', origin='ATRF SF', method='RNA-Seq',
+        organism='Homo sapiens'))
+    sample = write(project, 'Sample_S1_WT1', pairs(collection_type='Sample', sample_name='WT1'))
+    name = 'WT1.Aligned.toGenome.bam'
+    write(sample, name, data_object('{}/{}'.format(VAULT, os.path.relpath(os.path.join(sample, name), root))),
+          contents='bam')
+    return root
+
+
+def test_rules_of_a_vault():
+    common = rules(VAULT)
+    assert 'project_id' not in common['Project']
+    dtb = rules('/CCR_DTB_Archive')
+    assert dtb['Project'][:len(common['Project'])] == common['Project']
+    assert dtb['Project'][len(common['Project']):] == ['project_id', 'project_scientist', 'project_completed_date']
+
+
+def test_a_conforming_hierarchy(upload):
+    records = load(upload, VAULT)
+    assert [r['type'] for r in records] == ['collection'] * 3 + ['dataObject']
+    assert check(records, VAULT) == []
+    # The DTB vault requires more of Project collections
+    dtb = check(load(upload, 'CCR_DTB_Archive'), 'CCR_DTB_Archive')
+    assert [v[2] for v in dtb if v[1] == 'required'] == [
+        'missing {} required on Project'.format(a) for a in ('project_id', 'project_scientist',
+                                                             'project_completed_date')]
+
+
+def test_every_violation_is_reported(upload):
+    project = os.path.join(upload, 'PI_Lab_CurtisHarris_LHC',
+                           'Project_KaryMullis_ATRF-SF_2RNA-Seq_Homo-sapiens_2021-07-07')
+    sample = os.path.join(project, 'Sample_S1_WT1')
+    prefix = '{}/{}/'.format(VAULT, os.path.relpath(sample, upload))
+    write(sample, 'no_metadata.bam', contents='bam')
+    write(sample, 'WT1 copy.bam', data_object(prefix + 'WT1 copy.bam'), contents='bam')
+    write(sample, 'moved.bam', data_object(prefix + 'elsewhere.bam', phi_content='None'), contents='bam')
+    write(sample, 'unreadable.bam', contents='bam')
+    with open(os.path.join(sample, 'unreadable.bam.metadata.json'), 'w') as fh:
+        fh.write('{"metadataEntries": [')
+    write(project, 'Analysis_1', pairs(collection_type='Analysis', number_of_cases='1', method='RNA-Seq',
+                                       assembly_name='hg38', gtf_ver='v36'))
+    write(project, 'Notes', pairs(sample_name='WT1'))
+    write(project, 'Group_1', pairs(collection_type='Group'))
+
+    violations = check(load(upload, VAULT), VAULT)
+    unreadable = [v for v in violations if v[0].endswith('/unreadable.bam')]
+    assert len(unreadable) == 1 and unreadable[0][2].startswith('unreadable metadata file')
+    found = dict(((os.path.relpath(path, VAULT + '/PI_Lab_CurtisHarris_LHC'), rule), detail)
+                 for path, rule, detail in violations if not path.endswith('/unreadable.bam'))
+    project = os.path.basename(project)
+    assert found == {
+        (project + '/Analysis_1', 'required'): 'missing md5_all_inputs_serial required on Analysis',
+        (project + '/Analysis_1', 'naming'): 'Analysis collection must be named Primary_Analysis_\\S+',
+        (project + '/Group_1', 'collection_type'): "unknown collection_type 'Group'",
+        (project + '/Notes', 'required'): 'collection has no collection_type',
+        (project + '/Sample_S1_WT1/WT1 copy.bam', 'naming'): 'name may only contain letters, digits and . _ + -',
+        (project + '/Sample_S1_WT1/moved.bam', 'naming'):
+            'object_name {}elsewhere.bam does not match the DME path'.format(prefix),
+        (project + '/Sample_S1_WT1/moved.bam', 'vocabulary'):
+            "phi_content='None' is not one of PHI Present, PHI Not Present, Unspecified",
+        (project + '/Sample_S1_WT1/no_metadata.bam', 'metadata'):
+            'missing metadata file {}.metadata.json'.format(os.path.join(sample, 'no_metadata.bam')),
+    }
+    assert len(violations) == len(found) + 1
+
+
+def test_initialized_hierarchy_conforms(tmp_path):
+    """Runs lint.py and initialize.py like the CI does, on a filled out project
+    request, then checks the collections they build."""
+    pytest.importorskip('pandas')
+    openpyxl = pytest.importorskip('openpyxl')
+    template = os.path.join(REPO, 'data', 'experiment_metadata_v15.xlsx')
+    workbook = openpyxl.load_workbook(template)
+    sheet = workbook['Required Fields - User Form']
+    # The header of the samples refers to another sheet, its values are kept
+    cached = openpyxl.load_workbook(template, data_only=True)['Required Fields - User Form']
+    for row in (18, 19, 20):
+        for cell in sheet[row]:
+            cell.value = cached.cell(row=row, column=cell.column).value
+    for row in range(2, 16):
+        sheet.cell(row=row, column=2).value = PROJECT.get((sheet.cell(row=row, column=1).value or '').strip())
+    header = [cell.value for cell in sheet[18]]
+    for i, sample in enumerate(SAMPLES):
+        for j, field in enumerate(header, 1):
+            if field:
+                sheet.cell(row=21 + i, column=j).value = sample.get(field, 'NA')
+    request = str(tmp_path / 'experiment_metadata.xlsx')
+    workbook.save(request)
+
+    dme = str(tmp_path / 'DME')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, os.path.join(REPO, 'src', 'lint.py'), request, dme, '--dry-run'],
+                              stdout=devnull, stderr=devnull)
+        subprocess.check_call([sys.executable, os.path.join(REPO, 'src', 'initialize.py'), dme,
+                               os.path.join(dme, 'meta'), 'CCBR_EXT_Archive', '--convert'],
+                              stdout=devnull, stderr=devnull)
+
+    records = load(os.path.join(dme, 'meta'), 'CCBR_EXT_Archive')
+    assert [r['path'] for r in records if r['type'] == 'collection'] == [
+        '/CCBR_EXT_Archive/PI_Lab_CurtisHarris_LHC',
+        '/CCBR_EXT_Archive/PI_Lab_CurtisHarris_LHC/Project_KaryMullis_ATRF-SF_2RNA-Seq_Homo-sapiens_2021-07-07',
+        '/CCBR_EXT_Archive/PI_Lab_CurtisHarris_LHC/Project_KaryMullis_ATRF-SF_2RNA-Seq_Homo-sapiens_2021-07-07/'
+        'Sample_KO1_KO1',
+        '/CCBR_EXT_Archive/PI_Lab_CurtisHarris_LHC/Project_KaryMullis_ATRF-SF_2RNA-Seq_Homo-sapiens_2021-07-07/'
+        'Sample_WT1_WT1']
+    assert check(records, 'CCBR_EXT_Archive') == []
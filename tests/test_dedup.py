@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_dedup: content-addressed references across the data objects of a vault"""
+
+from __future__ import print_function
+import os, shutil
+import pytest
+
+import dme_utils as dme
+from dedup import DedupIndex, content_checksum
+from upload import Uploader, manifest, load_metadata
+
+VAULT = '/CCBR_Archive'
+
+
+def test_index_is_shared_through_its_file(tmp_path):
+    filename = str(tmp_path / 'vault.index')
+    index = DedupIndex(filename)
+    index.add('abc', 10, '/CCBR_Archive/A/first.fastq.gz')
+    index.add('abc', 10, '/CCBR_Archive/B/second.fastq.gz')
+    index.add(None, 10, '/CCBR_Archive/B/unchecked.fastq.gz')
+    assert index.lookup('abc', 10) == '/CCBR_Archive/A/first.fastq.gz'
+    assert index.lookup('abc', 11) is None
+    assert index.lookup(None, 10) is None
+
+    # A partial line left by a killed job does not hide later records
+    with open(filename, 'a') as fh:
+        fh.write('{"checksum": "def"')
+    DedupIndex(filename).add('def', 20, '/CCBR_Archive/A/other.bam')
+    other = DedupIndex(filename)
+    assert other.entries == {'abc:10': '/CCBR_Archive/A/first.fastq.gz', 'def:20': '/CCBR_Archive/A/other.bam'}
+
+    other.discard('abc', 10)
+    assert DedupIndex(filename).lookup('abc', 10) is None
+
+
+@pytest.mark.parametrize('dme_server', [['--max-page-size', '2']], indirect=True)
+def test_duplicates_are_registered_as_references(dme_server, hierarchy, tmp_path):
+    project = os.path.join(hierarchy, 'PI_Lab_A', 'Project_B')
+    original = os.path.join(project, 'Sample_1', 's1.R1.fastq.gz')
+    duplicate = os.path.join(project, 'Primary_Analysis_1', 's1.R1.fastq.gz')
+    shutil.copy(original, duplicate)
+    shutil.copy(original + '.metadata.json', duplicate + '.metadata.json')
+
+    session = dme.DMESession(dme_server, 'test')
+    index = DedupIndex(str(tmp_path / 'vault.index'))
+    entries = manifest(hierarchy, VAULT)
+    stats = Uploader(session, threads=1, index=index).run(entries)
+    assert stats['failed'] == 0
+    assert stats['references'] == 1
+    assert stats['dataObjects'] == 5
+
+    # Whichever copy was sent first is the canonical one
+    paths = [e['path'] for e in entries if e['local'] in (original, duplicate)]
+    canonical = index.lookup(content_checksum(load_metadata(original + '.metadata.json')), os.path.getsize(original))
+    assert canonical in paths
+    reference = [p for p in paths if p != canonical][0]
+    values = session.get_dataObject_attributes(reference)
+    assert values['canonical_path'] == canonical
+    assert values['checksum'] == session.get_dataObject_attributes(canonical)['checksum']
+
+    # The index rebuilt from DME resolves the reference to the same copy
+    rebuilt = DedupIndex(str(tmp_path / 'rebuilt.index'))
+    rebuilt.rebuild(session, VAULT, page_size=100)
+    assert rebuilt.entries == index.entries
+    assert DedupIndex(rebuilt.filename).entries == index.entries
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_dme_utils: the pooled HTTP session of DMESession, paged metadata queries, and AsyncDMESession"""
+
+from __future__ import print_function
+import json, asyncio, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+import dme_utils as dme
+from upload import Uploader, manifest
+
+VAULT = '/CCBR_Archive'
+COLLECTION = json.dumps({'collections': [{'metadataEntries': {'selfMetadataEntries': [
+    {'attribute': 'collection_type', 'value': 'PI_Lab'}]}}]}).encode()
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Answers the first request of each method and path with 503, the next ones
+    with a collection."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        seen = self.server.requests.get((self.command, self.path), 0)
+        self.server.requests[(self.command, self.path)] = seen + 1
+        payload = b'' if seen == 0 else COLLECTION
+        self.send_response(503 if seen == 0 else 200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_HEAD = do_POST = do_PUT = _answer
+
+
+@pytest.fixture
+def flaky_server():
+    """URL of a server that is unavailable once for each request, and its request counts."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    server.requests = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1]), server.requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_session_pools_every_scheme():
+    session = dme.http_session(pool_size=6, retries=2)
+    adapter = session.get_adapter('https://hpcdmeapi.nci.nih.gov:8080')
+    assert session.get_adapter('http://localhost:8080') is adapter
+    assert adapter.poolmanager.connection_pool_kw['maxsize'] == 6
+    assert adapter.max_retries.total == 2
+    assert dme.http_session(pool_size=0).get_adapter('http://localhost').poolmanager.connection_pool_kw['maxsize'] == 1
+
+
+def test_only_idempotent_requests_are_retried(flaky_server):
+    url, requests = flaky_server
+    session = dme.http_session(retries=2, backoff=0)
+    assert session.get(url + '/collection/a').status_code == 200
+    assert session.head(url + '/collection/a').status_code == 200
+    assert requests == {('GET', '/collection/a'): 2, ('HEAD', '/collection/a'): 2}
+    # The body of a registration is a stream that cannot be sent twice
+    assert session.put(url + '/v2/dataObject/a', data=b'contents').status_code == 503
+    assert session.post(url + '/collection/query', json={}).status_code == 503
+    assert requests[('PUT', '/v2/dataObject/a')] == requests[('POST', '/collection/query')] == 1
+
+
+def test_requests_reuse_one_connection(dme_server):
+    session = dme.DMESession(dme_server, 'test', pool_size=4)
+    session.register_collection(VAULT + '/PI_Lab_A', {'metadataEntries': [
+        {'attribute': 'collection_type', 'value': 'PI_Lab'}]})
+    for _ in range(20):
+        assert session.get_collection_dme_meta(VAULT + '/PI_Lab_A') == {'collection_type': 'PI_Lab'}
+    pools = session.http.get_adapter(dme_server).poolmanager.pools
+    assert len(pools) == 1
+    pool = pools[list(pools.keys())[0]]
+    assert pool.num_connections == 1 and pool.num_requests == 21
+    session.close()
+
+
+def recorded(session, name):
+    """Records the pages a query method of the session is asked for and the number of records of each."""
+    calls, query = [], getattr(session, name)
+
+    def record(collection_path, compound_query, page=1, page_size=100):
+        response = query(collection_path, compound_query, page=page, page_size=page_size)
+        calls.append((page, len(response['collections' if 'collections' in response else 'dataObjects'])))
+        return response
+    setattr(session, name, record)
+    return calls
+
+
+def test_query_collections(dme_server, hierarchy):
+    session = dme.DMESession(dme_server, 'test')
+    Uploader(session).run(manifest(hierarchy, VAULT))
+    samples = {'operator': 'AND', 'queries': [
+        {'attribute': 'collection_type', 'operator': 'EQUAL', 'value': 'Sample'}]}
+    response = session.query_collections(VAULT + '/PI_Lab_A', samples, page=2, page_size=1)
+    assert response['totalCount'] == 2
+    assert [c['collection']['absolutePath'] for c in response['collections']] == [
+        VAULT + '/PI_Lab_A/Project_B/Sample_2']
+    assert response['collections'][0]['metadataEntries']['selfMetadataEntries'] == [
+        {'attribute': 'collection_type', 'value': 'Sample'}]
+
+
+@pytest.mark.parametrize('dme_server', [['--max-page-size', '2']], indirect=True)
+def test_query_metadata_pages(dme_server, hierarchy):
+    session = dme.DMESession(dme_server, 'test')
+    Uploader(session).run(manifest(hierarchy, VAULT))
+    project = VAULT + '/PI_Lab_A/Project_B'
+    collections, dataobjects = recorded(session, 'query_collections'), recorded(session, 'query_dataobjects')
+    # The server returns 2 records of the 3 asked for, every record is still received
+    pages = list(session.query_metadata(VAULT + '/PI_Lab_A', page_size=3))
+    assert collections == dataobjects == [(1, 2), (2, 2)]
+    assert [sorted(page) for page in pages] == [
+        [project, project + '/Primary_Analysis_1'], [project + '/Sample_1', project + '/Sample_2'],
+        [project + '/Primary_Analysis_1/report.html', project + '/Sample_1/big.bam'],
+        [project + '/Sample_1/s1.R1.fastq.gz', project + '/Sample_2/s2.R1.fastq.gz']]
+    assert pages[1][project + '/Sample_1'] == {'collection_type': 'Sample'}
+    assert pages[3][project + '/Sample_2/s2.R1.fastq.gz']['sample_name'] == 's2'
+    assert 'checksum' not in pages[3][project + '/Sample_2/s2.R1.fastq.gz']
+
+
+def test_query_metadata_kinds(dme_server, hierarchy):
+    session = dme.DMESession(dme_server, 'test')
+    Uploader(session).run(manifest(hierarchy, VAULT))
+    project = VAULT + '/PI_Lab_A/Project_B'
+    s1 = {'operator': 'AND', 'queries': [{'attribute': 'sample_name', 'operator': 'EQUAL', 'value': 's1'}]}
+    found = {}
+    for page in session.query_metadata(project, dataobject_query=s1, system=True, kinds=('dataObject',)):
+        found.update(page)
+    assert sorted(found) == [project + '/Sample_1/big.bam', project + '/Sample_1/s1.R1.fastq.gz']
+    values = found[project + '/Sample_1/big.bam']
+    assert values['source_file_size'] == '1500000' and values['checksum'] == values['md5_checksum']
+
+    found = {}
+    for page in session.query_metadata(project, in_pairs=False, kinds=('collection',)):
+        found.update(page)
+    assert sorted(found) == [project + '/Primary_Analysis_1', project + '/Sample_1', project + '/Sample_2']
+    assert found[project + '/Sample_2'] == {'metadataEntries': [{'attribute': 'collection_type', 'value': 'Sample'}]}
+
+
+def test_query_metadata_stops_at_an_empty_page(dme_server, hierarchy):
+    session = dme.DMESession(dme_server, 'test')
+    Uploader(session).run(manifest(hierarchy, VAULT))
+    query = session.query_dataobjects
+    # A totalCount larger than what the server holds
+    session.query_dataobjects = lambda *args, **kwargs: dict(query(*args, **kwargs), totalCount=100)
+    calls = recorded(session, 'query_dataobjects')
+    pages = list(session.query_metadata(VAULT + '/PI_Lab_A', kinds=('dataObject',), page_size=3))
+    assert calls == [(1, 3), (2, 1), (3, 0)]
+    assert sum(len(page) for page in pages) == 4
+
+
+def test_async_lookups(dme_server, hierarchy):
+    pytest.importorskip('aiohttp')
+    Uploader(dme.DMESession(dme_server, 'test')).run(manifest(hierarchy, VAULT))
+    project = VAULT + '/PI_Lab_A/Project_B'
+    paths = [project + '/Sample_1/s1.R1.fastq.gz', project + '/Sample_1/big.bam', project + '/Sample_2/s2.R1.fastq.gz']
+
+    async def lookups():
+        async with dme.AsyncDMESession(dme_server, 'test', concurrency=2) as session:
+            return (await session.get_collection_dme_meta(project),
+                    await session.get_collection_dme_meta(project + '/Sample_3'),
+                    await asyncio.gather(*[session.get_dataObject_dme_meta(p) for p in paths]),
+                    await session.get_dataObject_dme_meta(project + '/Sample_2/missing.bam', in_pairs=False),
+                    await session.get_dataObject_attributes(paths[1]),
+                    await session.get_dataObject_attributes(project + '/Sample_2/missing.bam'),
+                    await session.list_collection(project + '/Sample_1'))
+    collection, missing, objects, missing_object, attributes, missing_attributes, listing = asyncio.run(lookups())
+    assert collection == {'collection_type': 'Project'} and missing == {}
+    assert [values['sample_name'] for values in objects] == ['s1', 's1', 's2']
+    assert missing_object == {} and missing_attributes is None
+    assert attributes['source_file_size'] == '1500000' and attributes['object_name'] == paths[1]
+    assert listing == ([], sorted(paths[:2]))
+
+
+def test_async_lookups_are_retried(flaky_server, monkeypatch):
+    pytest.importorskip('aiohttp')
+    url, requests = flaky_server
+    monkeypatch.setattr(dme, 'decorrelated_jitter', lambda delay, base, cap: 0)
+
+    async def lookup(path, retries):
+        async with dme.AsyncDMESession(url, 'test', retries=retries) as session:
+            return await session.get_collection_dme_meta(path)
+    with pytest.raises(dme.DMEError) as error:
+        asyncio.run(lookup(VAULT + '/A', 0))
+    assert error.value.status_code == 503
+    assert asyncio.run(lookup(VAULT + '/B', 1)) == {'collection_type': 'PI_Lab'}
+    assert requests == {('GET', '/collection' + VAULT + '/A'): 1, ('GET', '/collection' + VAULT + '/B'): 2}
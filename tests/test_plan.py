@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_plan: offline plan of an upload, the throughput history and SLURM sizing"""
+
+from __future__ import print_function
+import os, sys, json, time, subprocess
+
+from conftest import TESTS
+from history import History
+from plan import plan, scan, report, resources
+from upload import manifest
+
+VAULT = '/CCBR_Archive'
+MB = 1024**2
+
+
+def test_scan_lists_what_upload_would_register(hierarchy):
+    collections, objects = scan(hierarchy, VAULT)
+    entries = manifest(hierarchy, VAULT)
+    assert sorted(collections) == sorted(e['path'] for e in entries if e['type'] == 'collection')
+    assert sorted(objects) == sorted((e['path'], e['size']) for e in entries if e['type'] == 'dataObject')
+    # Parents are listed before their children
+    for i, path in enumerate(collections):
+        assert os.path.dirname(path) in collections[:i] + [VAULT]
+
+
+def test_plan(hierarchy):
+    result = plan(hierarchy, VAULT, workers=2, throughput=MB)
+    assert result['collections'] == 5
+    assert result['dataObjects'] == 4
+    assert result['bytes'] == 200000 + 1500000 + 300000 + 5000
+    assert result['largest']['path'].endswith('/Sample_1/big.bam')
+    assert result['throughput_source'] == 'option'
+    assert result['throughput_mbps'] == 1.0
+    # big.bam keeps one worker busy while the other sends the rest, and each
+    # request, collections included, costs 0.2 seconds
+    assert result['predicted_seconds'] == round(0.2 + 1500000.0 / MB + 5 * 0.2 / 2, 1)
+    assert report(result).splitlines()[5] == \
+        'Plan: 5 collections and 4 data objects (0.00 GB) into /CCBR_Archive'
+
+
+def test_plan_uses_the_history(hierarchy, tmp_path):
+    history = History(str(tmp_path / 'history.jsonl'))
+    assert plan(hierarchy, VAULT, history=history)['throughput_source'] == 'default'
+    assert history.record({'bytes': 0, 'dataObjects': 0, 'collections': 0, 'elapsed': 1.0}, 4) is None
+    for mbps in (10, 30, 20):
+        history.record({'bytes': 4 * mbps * MB, 'dataObjects': 1, 'collections': 0, 'elapsed': 1.0}, 4)
+    # Median throughput of a single connection over the recent runs
+    assert History(history.filename).throughput() == 20 * MB
+    result = plan(hierarchy, VAULT, history=History(history.filename))
+    assert result['throughput_source'] == 'history'
+    assert result['throughput_mbps'] == 20.0
+
+
+def test_plan_of_10k_objects_takes_under_a_second(tmp_path):
+    upload = tmp_path / 'upload'
+    for sample in range(100):
+        directory = upload / 'PI_Lab_A' / 'Project_B' / 'Sample_{}'.format(sample)
+        os.makedirs(str(directory))
+        for i in range(100):
+            with open(str(directory / 'file_{}.fastq.gz'.format(i)), 'wb') as fh:
+                fh.write(b'@' * i)
+    start = time.time()
+    result = plan(str(upload), VAULT, throughput=MB)
+    assert time.time() - start < 1.0
+    assert result['dataObjects'] == 10000
+    assert result['collections'] == 102
+
+
+def test_json_output(hierarchy):
+    directory = os.path.dirname(hierarchy)
+    output = subprocess.check_output([sys.executable, os.path.join(os.path.dirname(TESTS), 'src', 'plan.py'),
+                                      directory, VAULT, '--json', '--throughput', '1',
+                                      '--history', os.path.join(directory, 'history.jsonl')])
+    result = json.loads(output.decode())
+    assert result['dataObjects'] == 4
+    assert result['collection_paths'][0] == '/CCBR_Archive/PI_Lab_A'
+    assert set(result['slurm']) == set(['time', 'cpus-per-task', 'mem'])
+
+
+def sizing(seconds, workers=8):
+    return {'shard_predicted_seconds': seconds, 'workers': workers}
+
+
+def test_resources_of_a_small_upload():
+    # The time limit is never below an hour
+    assert resources(sizing(60)) == {'time': '01:00:00', 'cpus-per-task': 2, 'mem': '6g'}
+
+
+def test_resources_scale_with_the_predicted_duration():
+    # 1.5 times 10 hours, plus 15 minutes of start-up, rounded up to 15 minutes
+    assert resources(sizing(36000))['time'] == '15:15:00'
+    assert resources(sizing(36001))['time'] == '15:30:00'
+    assert resources(sizing(86400))['time'] == '1-12:15:00'
+    assert resources(sizing(10**7))['time'] == '10-00:00:00'
+    assert resources(sizing(36000), margin=1.0)['time'] == '10:15:00'
+
+
+def test_resources_of_the_job():
+    assert resources(sizing(60, workers=32))['cpus-per-task'] == 8
+    # dm_register_directory needs a CPU and a GB per thread
+    assert resources(sizing(60, workers=8), native=False) == {'time': '01:00:00', 'cpus-per-task': 8,
+                                                               'mem': '15g'}
+
+
+def test_memory_comes_from_the_history(tmp_path):
+    history = History(str(tmp_path / 'history.jsonl'))
+    for peak in (3000, 9000, 5000):
+        history.record({'bytes': MB, 'dataObjects': 1, 'collections': 0, 'elapsed': 1.0}, 8, maxrss_mb=peak)
+    assert resources(sizing(60), history)['mem'] == '14g'
+    # The history only sizes native uploads
+    assert resources(sizing(60), history, native=False)['mem'] == '15g'
+
+
+def test_shards_shorten_the_job(hierarchy):
+    whole = plan(hierarchy, VAULT, workers=1, throughput=MB)
+    sharded = plan(hierarchy, VAULT, workers=1, throughput=MB, nshards=2)
+    assert sharded['shard_predicted_seconds'] < whole['shard_predicted_seconds'] == whole['predicted_seconds']
+    # big.bam alone is the largest shard
+    assert sharded['shard_predicted_seconds'] == round(0.2 + 1500000.0 / MB + 5 * 0.2, 1)
+
+
+def test_slurm_options(hierarchy):
+    directory = os.path.dirname(hierarchy)
+    output = subprocess.check_output([sys.executable, os.path.join(os.path.dirname(TESTS), 'src', 'plan.py'),
+                                      directory, VAULT, '--slurm', '--threads', '8', '--shards', '2',
+                                      '--history', os.path.join(directory, 'history.jsonl')])
+    # The options pyrkit passes to sbatch
+    assert output.decode().split() == ['--cpus-per-task=2', '--mem=6g', '--time=01:00:00']
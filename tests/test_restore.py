@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_restore: downloads of archived collections from the stand-in DME server"""
+
+from __future__ import print_function
+import os, hashlib
+import pytest
+
+import dme_utils as dme
+from retry import Retry
+from restore import Restorer, walk, inventory, layout, ranges
+from upload import Uploader, manifest, transient
+
+VAULT = '/CCBR_Archive'
+PROJECT = '/CCBR_Archive/PI_Lab_A/Project_B'
+PART_SIZE = 262144
+
+
+def md5(filename):
+    with open(filename, 'rb') as fh:
+        return hashlib.md5(fh.read()).hexdigest()
+
+
+@pytest.fixture
+def archived(dme_server, hierarchy, tmp_path):
+    """Data objects of the test hierarchy archived in the stand-in DME server,
+    laid out to be restored under tmp_path/restore."""
+    session = dme.DMESession(dme_server, 'test')
+    retry = Retry(attempts=30, base=0.01, cap=0.05, transient=transient)
+    assert Uploader(session, retry=retry).run(manifest(hierarchy, VAULT))['failed'] == 0
+    entries, duplicates = layout(inventory(session, walk(session, PROJECT)), PROJECT, str(tmp_path / 'restore'))
+    assert not duplicates
+    return session, dict((os.path.basename(e['path']), e) for e in entries)
+
+
+def local(hierarchy, name):
+    return [e['local'] for e in manifest(hierarchy, VAULT) if e['local'].endswith('/' + name)][0]
+
+
+def test_ranges():
+    assert ranges(10, 4) == [(0, 4), (4, 4), (8, 2)]
+    assert ranges(0, 4) == []
+
+
+def test_layout_from_aliases(tmp_path):
+    entries = [
+        {'path': PROJECT + '/Sample_1/s1.R1.fastq.gz', 'alias': '/data/run/fastq/s1.R1.fastq.gz', 'checksum': 'a'},
+        {'path': PROJECT + '/Primary_Analysis_1/s1.bam', 'alias': '/data/run/bams/s1.bam', 'checksum': 'b'},
+        {'path': PROJECT + '/Sample_1/s1.bam', 'alias': '/data/run/bams/s1.bam', 'checksum': 'b'},
+        {'path': PROJECT + '/Sample_1/notes.txt', 'alias': None, 'checksum': 'c'}]
+    restored, duplicates = layout(entries, PROJECT, str(tmp_path))
+    assert [os.path.relpath(e['local'], str(tmp_path)) for e in restored] == [
+        'fastq/s1.R1.fastq.gz', 'bams/s1.bam', 'Project_B/Sample_1/notes.txt']
+    # The same file linked into two collections is downloaded once
+    assert [e['path'] for e in duplicates] == [PROJECT + '/Sample_1/s1.bam']
+    restored, _ = layout(entries, PROJECT, str(tmp_path), use_alias=False)
+    assert os.path.relpath(restored[0]['local'], str(tmp_path)) == 'Project_B/Sample_1/s1.R1.fastq.gz'
+
+
+def test_restore(archived, hierarchy):
+    session, entries = archived
+    stats = Restorer(session, threads=4, part_size=PART_SIZE).run(list(entries.values()))
+    assert stats['dataObjects'] == 4 and stats['failed'] == 0
+    for name, entry in entries.items():
+        assert md5(entry['local']) == md5(local(hierarchy, name))
+        assert not os.path.exists(entry['local'] + '.part')
+
+    # Restoring again downloads nothing
+    stats = Restorer(session, threads=4, part_size=PART_SIZE).run(list(entries.values()))
+    assert stats['skipped'] == 4 and stats['bytes'] == 0
+
+
+def test_resume_from_completed_ranges(archived, hierarchy):
+    session, entries = archived
+    entry = entries['big.bam']
+    os.makedirs(os.path.dirname(entry['local']))
+    # Interrupted after the first two ranges were downloaded
+    with open(local(hierarchy, 'big.bam'), 'rb') as fh:
+        head = fh.read(2 * PART_SIZE)
+    with open(entry['local'] + '.part', 'wb') as fh:
+        fh.write(head)
+        fh.truncate(entry['size'])
+    with open(entry['local'] + '.part.ranges', 'w') as fh:
+        fh.write('0\n{}\n'.format(PART_SIZE))
+
+    stats = Restorer(session, threads=4, part_size=PART_SIZE).run([entry])
+    assert stats['resumed'] == 1 and stats['dataObjects'] == 1
+    assert stats['bytes'] == entry['size'] - 2 * PART_SIZE
+    assert md5(entry['local']) == md5(local(hierarchy, 'big.bam'))
+    assert not os.path.exists(entry['local'] + '.part.ranges')
+
+
+def test_truncated_part_starts_over(archived, hierarchy):
+    session, entries = archived
+    entry = entries['big.bam']
+    os.makedirs(os.path.dirname(entry['local']))
+    with open(entry['local'] + '.part', 'wb') as fh:
+        fh.write(b'\0' * PART_SIZE)
+    with open(entry['local'] + '.part.ranges', 'w') as fh:
+        fh.write('0\n')
+
+    stats = Restorer(session, threads=4, part_size=PART_SIZE).run([entry])
+    assert stats['resumed'] == 0 and stats['bytes'] == entry['size']
+    assert md5(entry['local']) == md5(local(hierarchy, 'big.bam'))
+
+
+def test_existing_files_are_verified(archived, hierarchy):
+    session, entries = archived
+    entry = entries['s1.R1.fastq.gz']
+    os.makedirs(os.path.dirname(entry['local']))
+    # A different file of the same size
+    with open(entry['local'], 'wb') as fh:
+        fh.write(b'\0' * entry['size'])
+
+    stats = Restorer(session, part_size=PART_SIZE, trust_size=True).run([entry])
+    assert stats['skipped'] == 1 and stats['bytes'] == 0
+
+    stats = Restorer(session, part_size=PART_SIZE).run([entry])
+    assert stats['skipped'] == 0 and stats['dataObjects'] == 1
+    assert md5(entry['local']) == md5(local(hierarchy, 's1.R1.fastq.gz'))
+
+
+def test_checksum_mismatch_fails(archived):
+    session, entries = archived
+    entry = dict(entries['report.html'], checksum='0' * 32)
+    restorer = Restorer(session, part_size=PART_SIZE)
+    stats = restorer.run([entry])
+    assert stats['failed'] == 1
+    assert not os.path.exists(entry['local']) and not os.path.exists(entry['local'] + '.part')
+
+
+@pytest.mark.parametrize('dme_server', [['--error-rate', '0.3']], indirect=True)
+def test_failed_ranges_are_retried(archived, hierarchy):
+    session, entries = archived
+    # Without transport-level retries, every failed download reaches the Retry policy
+    session = dme.DMESession(session.dme_url, 'test', retries=0)
+    retry = Retry(attempts=30, base=0.01, cap=0.05, transient=transient)
+    stats = Restorer(session, threads=4, part_size=65536, retry=retry).run([entries['big.bam']])
+    assert stats['failed'] == 0 and stats['retries'] > 0
+    assert md5(entries['big.bam']['local']) == md5(local(hierarchy, 'big.bam'))
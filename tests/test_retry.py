@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_retry: per-request retries and the circuit breaker"""
+
+from __future__ import print_function
+import time, random, threading
+import pytest
+
+import dme_utils as dme
+from retry import Retry, CircuitBreaker, decorrelated_jitter
+from upload import Uploader, manifest, transient
+
+VAULT = '/CCBR_Archive'
+
+
+class Flaky(object):
+    """Request that fails a number of times before it succeeds."""
+    def __init__(self, failures, error=None):
+        self.failures = failures
+        self.error = error or dme.DMEError(503, 'Service Unavailable')
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return value
+
+
+def test_decorrelated_jitter():
+    random.seed(0)
+    delay = 0.0
+    for _ in range(20):
+        previous, delay = delay, decorrelated_jitter(delay, base=1.0, cap=10.0)
+        assert 1.0 <= delay <= min(10.0, max(1.0, previous * 3))
+    assert decorrelated_jitter(1000.0, base=1.0, cap=10.0) <= 10.0
+
+
+def test_retries_transient_failures():
+    retry = Retry(attempts=5, base=0.001, cap=0.01, transient=transient)
+    request = Flaky(3)
+    assert retry(request, 'registered') == 'registered'
+    assert request.calls == 4
+    assert retry.retries == 3
+    assert retry.waited > 0
+
+
+def test_gives_up_after_the_last_attempt():
+    retry = Retry(attempts=3, base=0.001, cap=0.01, transient=transient)
+    request = Flaky(10)
+    with pytest.raises(dme.DMEError):
+        retry(request, 'registered')
+    assert request.calls == 3
+
+
+def test_does_not_retry_rejected_requests():
+    retry = Retry(attempts=5, base=0.001, cap=0.01, transient=transient)
+    request = Flaky(1, dme.DMEError(400, 'Bad Request'))
+    with pytest.raises(dme.DMEError):
+        retry(request, 'registered')
+    assert request.calls == 1
+    assert retry.retries == 0
+
+
+def test_breaker_opens_and_probes():
+    breaker = CircuitBreaker(threshold=3, cooldown=0.2, max_cooldown=1.0)
+    for _ in range(3):
+        breaker.failure()
+    assert breaker.state == 'open' and breaker.trips == 1
+
+    # Only one thread probes once the cooldown is over
+    waited = breaker.wait()
+    assert waited >= 0.15 and breaker.state == 'half-open'
+    blocked = threading.Thread(target=breaker.wait)
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+
+    # A failed probe opens the breaker with a longer cooldown
+    breaker.failure()
+    assert breaker.state == 'open' and breaker.trips == 2
+    start = time.time()
+    blocked.join(5)
+    assert time.time() - start >= 0.3
+    breaker.success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+    assert breaker.wait() < 0.05
+
+
+def test_breaker_ignores_isolated_failures():
+    breaker = CircuitBreaker(threshold=3)
+    for _ in range(5):
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+    assert breaker.state == 'closed' and breaker.trips == 0
+
+
+@pytest.mark.parametrize('dme_server', [['--error-rate', '0.5']], indirect=True)
+def test_upload_retries_each_failed_request(dme_server, hierarchy):
+    breaker = CircuitBreaker(threshold=5, cooldown=0.05, max_cooldown=0.2)
+    retry = Retry(attempts=30, base=0.01, cap=0.05, breaker=breaker, transient=transient)
+    entries = manifest(hierarchy, VAULT)
+    stats = Uploader(dme.DMESession(dme_server, 'test'), retry=retry).run(entries)
+    assert stats['failed'] == 0
+    assert stats['collections'] == 5 and stats['dataObjects'] == 4
+    assert stats['retries'] == retry.retries > 0
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_scheduler: ordering of data objects and predicted makespan"""
+
+from __future__ import print_function
+
+from scheduler import Scheduler, hms, shards
+
+MB = 1024**2
+
+
+def objects(*sizes):
+    return [{'path': '/CCBR_Archive/file_{}'.format(i), 'size': size} for i, size in enumerate(sizes)]
+
+
+def test_hms():
+    assert hms(0) == '00:00:00'
+    assert hms(3725.4) == '01:02:05'
+
+
+def test_order_interleaves_small_files_after_the_largest():
+    scheduler = Scheduler(workers=2, small=10 * MB)
+    entries = objects(1 * MB, 100 * MB, 2 * MB, 50 * MB, 3 * MB, 4 * MB)
+    sizes = [e['size'] // MB for e in scheduler.order(entries)]
+    assert sizes == [100, 4, 50, 3, 2, 1]
+
+
+def test_order_is_longest_first_when_all_files_are_large():
+    scheduler = Scheduler(workers=4, small=0)
+    entries = objects(5 * MB, 500 * MB, 50 * MB, 50 * MB)
+    ordered = scheduler.order(entries)
+    assert [e['size'] for e in ordered] == [500 * MB, 50 * MB, 50 * MB, 5 * MB]
+    # Ties are broken by path, so every run computes the same order
+    assert [e['path'] for e in ordered[1:3]] == ['/CCBR_Archive/file_2', '/CCBR_Archive/file_3']
+
+
+def test_order_counts_multipart_uploads_as_several_streams():
+    scheduler = Scheduler(workers=2, throughput=MB, overhead=0, small=0,
+                          multipart_threshold=100 * MB, part_threads=4)
+    entries = objects(120 * MB, 60 * MB)
+    assert scheduler.cost(entries[0]) == 30
+    assert [e['size'] for e in scheduler.order(entries)] == [60 * MB, 120 * MB]
+
+
+def test_makespan():
+    scheduler = Scheduler(workers=2, throughput=MB, overhead=0, small=0)
+    entries = objects(40 * MB, 30 * MB, 20 * MB, 10 * MB)
+    # 40 + 10 on one worker, 30 + 20 on the other
+    assert scheduler.makespan(scheduler.order(entries)) == 50
+    assert scheduler.lower_bound(entries) == 50
+    # Directory order leaves one worker with the largest file at the end
+    assert scheduler.makespan(objects(10 * MB, 20 * MB, 30 * MB, 40 * MB)) == 60
+
+
+def test_lower_bound_is_the_longest_transfer():
+    scheduler = Scheduler(workers=8, throughput=MB, overhead=0)
+    assert scheduler.lower_bound(objects(100 * MB, 1 * MB)) == 100
+    assert scheduler.lower_bound([]) == 0
+
+
+def test_report():
+    scheduler = Scheduler(workers=2, throughput=MB, overhead=0, small=0)
+    report = scheduler.report(scheduler.order(objects(40 * MB, 30 * MB, 20 * MB, 10 * MB)))
+    assert report.startswith('Scheduled 4 data objects (0.10 GB) over 2 workers')
+    assert report.endswith('predicted makespan 00:00:50 (lower bound 00:00:50)')
+
+
+def test_shards_are_byte_balanced():
+    entries = objects(10 * MB, 50 * MB, 30 * MB, 20 * MB, 40 * MB, 30 * MB)
+    split = shards(entries, 3)
+    assert sorted(sum(e['size'] for e in shard) // MB for shard in split) == [60, 60, 60]
+    assert sorted(e['path'] for shard in split for e in shard) == sorted(e['path'] for e in entries)
+
+
+def test_shards_do_not_depend_on_listing_order():
+    entries = objects(*[(i % 7 + 1) * MB for i in range(20)])
+    paths = lambda split: [[e['path'] for e in shard] for shard in split]
+    assert paths(shards(entries, 4)) == paths(shards(list(reversed(entries)), 4))
+
+
+def test_more_shards_than_objects():
+    split = shards(objects(MB, MB), 3)
+    assert [len(shard) for shard in split] == [1, 1, 0]
+    assert len(shards(objects(MB), 0)) == 1
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_throttle: adaptive concurrency and the bandwidth limit of uploads"""
+
+from __future__ import print_function
+import time, threading
+
+import dme_utils as dme
+from throttle import AIMDController, RateLimiter
+from upload import Uploader, manifest
+
+VAULT = '/CCBR_Archive'
+
+
+def request(controller, size=1048576, **outcome):
+    started = controller.acquire()
+    controller.release(started, size, **outcome)
+    return started
+
+
+def test_additive_increase():
+    controller = AIMDController(initial=4, maximum=8)
+    for _ in range(4):
+        request(controller)
+    # About one more request per round of four requests
+    assert 4.9 < controller.limit < 5.0
+    assert controller.increases == 4
+    for _ in range(100):
+        request(controller)
+    assert controller.limit == 8
+
+
+def test_multiplicative_decrease_once_per_round():
+    controller = AIMDController(initial=16, minimum=2)
+    started = [controller.acquire() for _ in range(4)]
+    for start in started:
+        # A burst of errors of requests started before the first cut
+        controller.release(start, status_code=503)
+    assert controller.limit == 8
+    assert controller.decreases == 1
+
+    request(controller, status_code=429)
+    request(controller, failed=True)
+    request(controller, status_code=500)
+    assert controller.limit == 2
+    assert controller.decreases == 4
+
+
+def test_client_errors_do_not_change_the_limit():
+    controller = AIMDController(initial=4)
+    request(controller, status_code=404)
+    assert controller.limit == 4
+    assert controller.increases == controller.decreases == 0
+
+
+def test_latency_spike_cuts_the_limit():
+    controller = AIMDController(initial=8, spike=3.0)
+    controller.average = 0.01
+    controller.release(controller.acquire() - 1.0, size=1048576)
+    assert controller.limit == 4
+
+
+def test_acquire_waits_for_a_free_slot():
+    controller = AIMDController(initial=1, maximum=1)
+    started = controller.acquire()
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(controller.acquire()))
+    thread.start()
+    thread.join(0.2)
+    assert not acquired
+    controller.release(started)
+    thread.join(5)
+    assert acquired and controller.active == 1
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=1000000, burst=100000)
+    start = time.time()
+    for _ in range(4):
+        limiter.consume(100000)
+    # The first 100 kB are the burst, the other 300 kB take 0.3 seconds
+    assert 0.25 < time.time() - start < 1.0
+
+
+def test_adaptive_rate_limited_upload(dme_server, hierarchy):
+    session = dme.DMESession(dme_server, 'test')
+    session.rate_limiter = RateLimiter(rate=4000000, burst=200000)
+    controller = AIMDController(initial=2, maximum=4)
+    entries = manifest(hierarchy, VAULT)
+    size = sum(e['size'] for e in entries if e['type'] == 'dataObject')
+
+    start = time.time()
+    stats = Uploader(session, controller=controller).run(entries)
+    assert stats['failed'] == 0
+    assert time.time() - start > (size - 200000) / 4000000.0
+    assert controller.increases > 0
+    assert controller.active == 0
+    assert controller.minimum <= controller.limit <= controller.maximum
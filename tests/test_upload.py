@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_upload: uploads into the stand-in DME server (see dme_server.py)"""
+
+from __future__ import print_function
+import os, json, time, hashlib, threading
+import pytest
+
+import dme_utils as dme
+from journal import Journal
+from throttle import AIMDController
+from upload import Uploader, manifest, mirror, shard, status, differential
+
+VAULT = '/CCBR_Archive'
+
+
+def md5(filename):
+    with open(filename, 'rb') as fh:
+        return hashlib.md5(fh.read()).hexdigest()
+
+
+def uploader(url, hierarchy, **kwargs):
+    journal = Journal(os.path.join(os.path.dirname(hierarchy), 'upload.journal'))
+    return Uploader(dme.DMESession(url, 'test'), journal=journal, **kwargs)
+
+
+def assert_stored(url, entries):
+    """Checks that every data object is in DME with the contents of its local file."""
+    session = dme.DMESession(url, 'test')
+    for entry in entries:
+        if entry['type'] == 'collection':
+            assert session.get_collection_dme_meta(entry['path']), entry['path']
+            continue
+        values = session.get_dataObject_attributes(entry['path'])
+        assert values is not None, entry['path']
+        assert values['checksum'] == md5(entry['local'])
+        assert int(values['source_file_size']) == entry['size']
+
+
+def test_register(dme_server, hierarchy):
+    entries = manifest(hierarchy, VAULT)
+    stats = uploader(dme_server, hierarchy).run(entries)
+    assert stats['failed'] == 0
+    assert stats['collections'] == 5
+    assert stats['dataObjects'] == 4
+    assert_stored(dme_server, entries)
+
+
+class Recorder(dme.StorageBackend):
+    """Storage backend that records when each registration starts and ends.
+    Registrations of the paths ending with one of slow take a while, and those
+    ending with one of fail are rejected."""
+    def __init__(self, slow=(), fail=()):
+        self.slow = slow
+        self.fail = fail
+        self.events = []
+        self._lock = threading.Lock()
+
+    def _register(self, path):
+        with self._lock:
+            self.events.append(('start', os.path.basename(path)))
+        if path.endswith(self.slow):
+            time.sleep(0.5)
+        if path.endswith(self.fail):
+            raise dme.DMEError(400, 'Rejected', path)
+        with self._lock:
+            self.events.append(('done', os.path.basename(path)))
+
+    def register_collection(self, collection_path, metadata):
+        self._register(collection_path)
+
+    def register_dataobject(self, data_object_path, source_file, metadata, blocksize=1048576, fileobj=None):
+        self._register(data_object_path)
+
+    def register_dataobject_multipart(self, data_object_path, source_file, metadata, part_size=536870912,
+                                      threads=4, retries=3, blocksize=1048576):
+        self._register(data_object_path)
+
+
+def test_registration_is_pipelined(hierarchy):
+    recorder = Recorder(slow=('Sample_2',))
+    stats = Uploader(recorder, threads=4).run(manifest(hierarchy, VAULT))
+    assert stats['failed'] == 0
+    events = recorder.events
+    # Sibling collections are created at the same time, and the files of a Sample
+    # start as soon as it is confirmed, while Sample_2 is still being created
+    assert events.index(('start', 'Sample_1')) < events.index(('done', 'Sample_2'))
+    assert events.index(('done', 's1.R1.fastq.gz')) < events.index(('done', 'Sample_2'))
+    assert events.index(('done', 'report.html')) < events.index(('done', 'Sample_2'))
+    assert events.index(('done', 'Sample_2')) < events.index(('start', 's2.R1.fastq.gz'))
+
+
+def test_children_of_a_failed_collection_fail_fast(hierarchy):
+    recorder = Recorder(fail=('Sample_1',))
+    stats = Uploader(recorder, threads=4).run(manifest(hierarchy, VAULT))
+    assert stats['failed'] == 3
+    assert stats['collections'] == 4 and stats['dataObjects'] == 2
+    started = [name for event, name in recorder.events if event == 'start']
+    assert 's1.R1.fastq.gz' not in started and 'big.bam' not in started
+
+
+def test_resume_from_journal(dme_server, hierarchy):
+    entries = manifest(hierarchy, VAULT)
+    uploader(dme_server, hierarchy).run(entries)
+
+    stats = uploader(dme_server, hierarchy).run(manifest(hierarchy, VAULT))
+    assert stats['skipped'] == len(entries)
+    assert stats['collections'] == stats['dataObjects'] == 0
+
+    # A changed file is sent again, along with nothing else
+    changed = [e for e in entries if e['local'].endswith('report.html')][0]
+    with open(changed['local'], 'ab') as fh:
+        fh.write(b'changed')
+    with open(changed['metadata'], 'r') as fh:
+        metadata = json.load(fh)
+    for pair in metadata['metadataEntries']:
+        if pair['attribute'] == 'md5_checksum':
+            pair['value'] = md5(changed['local'])
+    with open(changed['metadata'], 'w') as fh:
+        json.dump(metadata, fh)
+    stats = uploader(dme_server, hierarchy).run(manifest(hierarchy, VAULT))
+    assert stats['dataObjects'] == 1
+    assert stats['skipped'] == len(entries) - 1
+    assert_stored(dme_server, manifest(hierarchy, VAULT))
+
+
+def test_shards_share_the_journal(dme_server, hierarchy, capsys):
+    entries = manifest(hierarchy, VAULT)
+    first = shard(entries, 0, 2)
+    second = shard(entries, 1, 2)
+    # Each shard holds whole data objects and every collection above them
+    objects = lambda part: set(e['path'] for e in part if e['type'] == 'dataObject')
+    assert objects(first) | objects(second) == objects(entries)
+    assert not objects(first) & objects(second)
+    for part in (first, second):
+        for path in objects(part):
+            assert os.path.dirname(path) in set(e['path'] for e in part)
+
+    uploader(dme_server, hierarchy).run(first)
+    capsys.readouterr()
+    status(entries, uploader(dme_server, hierarchy).journal, 2)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith('Shard 0/2: {0}/{0} data objects'.format(len(objects(first))))
+    assert lines[1].startswith('Shard 1/2: 0/{} data objects'.format(len(objects(second))))
+
+    uploader(dme_server, hierarchy).run(second)
+    capsys.readouterr()
+    status(entries, uploader(dme_server, hierarchy).journal, 2)
+    for i, line in enumerate(capsys.readouterr().out.splitlines()):
+        done = len(objects(shard(entries, i, 2)))
+        assert line.startswith('Shard {}/2: {}/{} data objects'.format(i, done, done))
+    assert_stored(dme_server, entries)
+
+
+@pytest.mark.parametrize('dme_server', [['--max-page-size', '2']], indirect=True)
+def test_sync_skips_unchanged_objects(dme_server, hierarchy):
+    entries = manifest(hierarchy, VAULT)
+    uploader(dme_server, hierarchy).run([e for e in entries if not e['local'].endswith('big.bam')])
+    os.remove(os.path.join(os.path.dirname(hierarchy), 'upload.journal'))
+
+    session = dme.DMESession(dme_server, 'test')
+    lookups = []
+    lookup = session.get_dataObject_attributes
+    session.get_dataObject_attributes = lambda path: lookups.append(path) or lookup(path)
+    journal = Journal(os.path.join(os.path.dirname(hierarchy), 'sync.journal'))
+    changed, unchanged = differential(session, entries, journal)
+    assert sorted(e['local'].rsplit('/', 1)[1] for e, _ in unchanged) == [
+        'report.html', 's1.R1.fastq.gz', 's2.R1.fastq.gz']
+    assert [e for e in changed if e['type'] == 'dataObject'][0]['local'].endswith('big.bam')
+    assert len(changed) == len(entries) - 3
+    # The checksums come from the paged query, not from a request per data object
+    assert lookups == []
+
+    # A data object without an md5_checksum is looked up on its own, a new one is not
+    report = [e for e, _ in unchanged if e['local'].endswith('report.html')][0]
+    path = os.path.dirname(report['path']) + '/unchecked.html'
+    session.register_dataobject(path, report['local'], {'metadataEntries': [
+        {'attribute': 'object_name', 'value': 'unchecked.html'}]})
+    checksums = session.get_remote_checksums([path, path + '.new'])
+    assert checksums == {path: md5(report['local']), path + '.new': None}
+    assert lookups == [path]
+
+
+def test_multipart(dme_server, hierarchy):
+    entries = manifest(hierarchy, VAULT)
+    stats = uploader(dme_server, hierarchy, multipart_threshold=1000000, part_size=262144, part_threads=3).run(entries)
+    assert stats['failed'] == 0
+    assert stats['dataObjects'] == 4
+    assert_stored(dme_server, entries)
+
+
+def test_bulk(dme_server, hierarchy):
+    entries = manifest(hierarchy, VAULT)
+    stats = uploader(dme_server, hierarchy, bulk_count=10, bulk_max_size=1000000).run(entries)
+    assert stats['failed'] == 0
+    assert stats['dataObjects'] == 4
+    assert stats['bulk'] == 3
+    assert_stored(dme_server, entries)
+
+
+def test_mirror(dme_server, hierarchy):
+    entries = mirror(manifest(hierarchy, VAULT), VAULT, ['/CCR_DTB_Archive'])
+    # A single request at a time, and blocks small enough for big.bam to fill the
+    # window of its Tee before the copy for the other vault can start
+    upload = uploader(dme_server, hierarchy, blocksize=65536, controller=AIMDController(initial=1, maximum=1))
+    finished = []
+    thread = threading.Thread(target=lambda: finished.append(upload.run(entries)))
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), 'the copies of a data object are waiting on each other'
+    assert finished, 'the upload stopped with an error'
+    assert finished[0]['failed'] == 0
+    assert upload.vault_stats['/CCBR_Archive']['dataObjects'] == 4
+    assert upload.vault_stats['/CCR_DTB_Archive']['dataObjects'] == 4
+    assert_stored(dme_server, entries)
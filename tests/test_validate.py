@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_validate: metadata differences with DME and metadata-only updates"""
+
+from __future__ import print_function
+import os, sys, json, subprocess
+import pytest
+
+import dme_utils as dme
+from conftest import TESTS
+from upload import Uploader, manifest, load_metadata
+from validate import evaluate_differences, push_updates, fetch_metadata
+
+VAULT = '/CCBR_Archive'
+PROJECT = '/CCBR_Archive/PI_Lab_A/Project_B'
+
+
+def pairs(*items):
+    return [{'attribute': attribute, 'value': value} for attribute, value in items]
+
+
+def edit(filename, **values):
+    """Appends or modifies attributes of a local metadata file."""
+    metadata = load_metadata(filename)
+    for pair in metadata['metadataEntries']:
+        if pair['attribute'] in values:
+            pair['value'] = values.pop(pair['attribute'])
+    metadata['metadataEntries'] += pairs(*sorted(values.items()))
+    with open(filename, 'w') as fh:
+        json.dump(metadata, fh)
+
+
+def validate(ipath, *options):
+    return subprocess.run([sys.executable, os.path.join(os.path.dirname(TESTS), 'src', 'validate.py'),
+                           ipath, VAULT] + list(options), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+def test_evaluate_differences():
+    remote = pairs(('organism', 'Homo sapiens'), ('read_length', '100'), ('dme_only', 'kept'))
+    local = pairs(('organism', 'Mus musculus'), ('read_length', '100.0'), ('strandedness', 'reverse'))
+    # Numbers that only differ in their formatting are not modified
+    assert evaluate_differences(remote, local) == pairs(('strandedness', 'reverse'), ('organism', 'Mus musculus'))
+    assert evaluate_differences(remote, remote) == []
+
+
+def test_fetch_metadata(dme_server, hierarchy):
+    pytest.importorskip('aiohttp')
+    session = dme.DMESession(dme_server, 'test')
+    Uploader(session).run(manifest(hierarchy, VAULT))
+    lookups = [(PROJECT, True), (PROJECT + '/Sample_2', True), (PROJECT + '/Sample_3', True),
+               (PROJECT + '/Sample_1/big.bam', False), (PROJECT + '/Sample_2/missing.bam', False)]
+    remote = fetch_metadata(session, lookups, concurrency=2)
+    assert list(remote) == [path for path, _ in lookups]
+    assert remote[PROJECT] == session.get_collection_dme_meta(PROJECT, in_pairs=False)
+    assert remote[PROJECT + '/Sample_2'] == {'metadataEntries': pairs(('collection_type', 'Sample'))}
+    big = remote[PROJECT + '/Sample_1/big.bam']
+    assert big == session.get_dataObject_dme_meta(PROJECT + '/Sample_1/big.bam', in_pairs=False)
+    assert dict((p['attribute'], p['value']) for p in big['metadataEntries'])['object_name'] == \
+        PROJECT + '/Sample_1/big.bam'
+    # What does not exist in DME is empty
+    assert remote[PROJECT + '/Sample_3'] == remote[PROJECT + '/Sample_2/missing.bam'] == {}
+
+
+def test_push_updates(dme_server, hierarchy):
+    session = dme.DMESession(dme_server, 'test')
+    Uploader(session).run(manifest(hierarchy, VAULT))
+    updates = [(PROJECT, True, pairs(('status', 'published'))),
+               (PROJECT + '/Sample_1/big.bam', False, pairs(('phi_content', 'PHI Not Present'))),
+               (PROJECT + '/Sample_2/missing.bam', False, pairs(('phi_content', 'PHI Not Present')))]
+    collections, objects, failed = push_updates(session, updates, threads=2)
+    assert (collections, objects) == (1, 1)
+    assert [path for path, _ in failed] == [PROJECT + '/Sample_2/missing.bam']
+    assert session.get_collection_dme_meta(PROJECT) == {'collection_type': 'Project', 'status': 'published'}
+    values = session.get_dataObject_attributes(PROJECT + '/Sample_1/big.bam')
+    assert values['phi_content'] == 'PHI Not Present' and values['pii_content'] == 'Unspecified'
+
+
+def test_update(hpc_dm_utils, dme_server, hierarchy):
+    session = dme.DMESession(dme_server, 'test')
+    Uploader(session).run(manifest(hierarchy, VAULT))
+    project = os.path.join(hierarchy, 'PI_Lab_A', 'Project_B')
+    edit(project + '.metadata.json', status='published')
+    edit(os.path.join(project, 'Sample_1', 's1.R1.fastq.gz.metadata.json'), phi_content='PHI Not Present')
+
+    # Without --update, the differences are only reported
+    result = validate(hierarchy)
+    assert result.returncode == 0
+    assert "The attribute 'status' will be appended with value as 'published'" in result.stdout
+    assert "The attribute 'phi_content' will be modified from 'Unspecified' to 'PHI Not Present'" in result.stdout
+    assert 'status' not in session.get_collection_dme_meta(PROJECT)
+
+    result = validate(hierarchy, '--update', '--threads', '2')
+    assert result.returncode == 0
+    assert 'Updated the metadata of 1 collections and 1 data objects, 0 failed' in result.stdout
+    assert session.get_collection_dme_meta(PROJECT)['status'] == 'published'
+    values = session.get_dataObject_attributes(PROJECT + '/Sample_1/s1.R1.fastq.gz')
+    assert values['phi_content'] == 'PHI Not Present' and values['pii_content'] == 'Unspecified'
+
+    # Nothing is left to update
+    assert 'Metadata update: 0 collections and data objects changed' in validate(hierarchy, '--update').stdout
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_verify: post-upload verification against the stand-in DME server"""
+
+from __future__ import print_function
+import os, sys, json, subprocess
+import pytest
+
+import dme_utils as dme
+from conftest import TESTS
+from upload import Uploader, manifest, load_metadata
+from verify import compare, sample, verify, summarize
+
+VAULT = '/CCBR_Archive'
+
+
+def data_objects(hierarchy):
+    entries = []
+    for entry in manifest(hierarchy, VAULT):
+        if entry['type'] == 'dataObject':
+            values = dict((p['attribute'], p['value']) for p in load_metadata(entry['metadata'])['metadataEntries'])
+            entries.append(dict(entry, md5=values.get('md5_checksum')))
+    return entries
+
+
+def test_compare():
+    entry = {'size': 10, 'md5': 'a' * 32}
+    assert compare(entry, None) == 'missing'
+    assert compare(entry, {'source_file_size': '11', 'checksum': 'a' * 32}) == 'size_mismatch'
+    assert compare(entry, {'source_file_size': '10', 'checksum': 'a' * 32}) == 'ok'
+    assert compare(entry, {'source_file_size': '10', 'checksum': 'b' * 32}) == 'mismatch'
+    assert compare(entry, {'source_file_size': '10', 'checksum': 'a' * 32 + '-3'}) == 'unverifiable'
+    assert compare(dict(entry, md5=None), {'source_file_size': '10', 'checksum': 'a' * 32}) == 'no_local_checksum'
+
+
+def test_sample():
+    results = [{'path': '/v/{}'.format(i), 'size': i, 'status': 'ok'} for i in range(1, 11)]
+    results.append({'path': '/v/missing', 'size': 100, 'status': 'missing'})
+    picked = sample(results, 3, seed=1)
+    assert len(picked) == 3 and picked == sample(results, 3, seed=1)
+    assert '/v/missing' not in [r['path'] for r in sample(results, 20, seed=1)]
+    assert [r['size'] for r in sample(results, larger_than=8, smaller_than=2)] == [1, 9, 10]
+
+
+@pytest.mark.parametrize('dme_server', [['--max-page-size', '2']], indirect=True)
+def test_verify(dme_server, hierarchy, tmp_path):
+    session = dme.DMESession(dme_server, 'test')
+    entries = data_objects(hierarchy)
+    # report.html is never uploaded
+    assert Uploader(session).run([e for e in manifest(hierarchy, VAULT)
+                                  if not e['local'].endswith('report.html')])['failed'] == 0
+
+    # The bytes stored for s2.R1.fastq.gz are damaged after DME computed its checksum
+    damaged = [e for e in entries if e['local'].endswith('s2.R1.fastq.gz')][0]
+    with open(os.path.join(str(tmp_path / 'dme'), damaged['path'].lstrip('/')), 'r+b') as fh:
+        fh.write(b'damaged')
+    # The local copy of s1.R1.fastq.gz changed after the upload
+    changed = [e for e in entries if e['local'].endswith('s1.R1.fastq.gz')][0]
+    changed['md5'] = '0' * 32
+
+    results = verify(session, entries, VAULT + '/PI_Lab_A', threads=4,
+                     picked=lambda results: sample(results, larger_than=250000))
+    status = dict((os.path.basename(r['path']), (r['status'], r.get('download'))) for r in results)
+    assert status == {'s1.R1.fastq.gz': ('mismatch', None), 'big.bam': ('ok', 'download_ok'),
+                      's2.R1.fastq.gz': ('ok', 'download_mismatch'), 'report.html': ('missing', None)}
+    assert summarize(results) == {'ok': 2, 'mismatch': 1, 'missing': 1, 'download_ok': 1, 'download_mismatch': 1}
+
+
+def test_report(dme_server, hierarchy):
+    directory = os.path.dirname(hierarchy)
+    Uploader(dme.DMESession(dme_server, 'test')).run(manifest(hierarchy, VAULT))
+    command = [sys.executable, os.path.join(os.path.dirname(TESTS), 'src', 'verify.py'), directory, VAULT,
+               '--dme-url', dme_server, '--dme-token', 'test', '--sample', '2', '--seed', '7']
+    assert subprocess.call(command, stdout=subprocess.DEVNULL) == 0
+    with open(os.path.join(directory, 'verify.report.json')) as fh:
+        report = json.load(fh)
+    assert report['summary'] == {'ok': 4, 'download_ok': 2}
+
+    os.remove(os.path.join(hierarchy, 'PI_Lab_A', 'Project_B', 'Sample_1', 's1.R1.fastq.gz.metadata.json'))
+    os.rename(os.path.join(hierarchy, 'PI_Lab_A', 'Project_B', 'Sample_1', 's1.R1.fastq.gz'),
+              os.path.join(hierarchy, 'PI_Lab_A', 'Project_B', 'Sample_1', 's1.R2.fastq.gz'))
+    with open(os.path.join(hierarchy, 'PI_Lab_A', 'Project_B', 'Sample_1', 's1.R2.fastq.gz.metadata.json'),
+              'w') as fh:
+        json.dump({'metadataEntries': []}, fh)
+    # A data object that is not in DME fails the verification
+    assert subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 1
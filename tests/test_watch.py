@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""test_watch: archiving the outputs of a running pipeline, and its parity with pyrkit"""
+
+from __future__ import print_function
+import os, re, json, shutil, subprocess
+import pytest
+
+import dme_utils as dme
+from conftest import TESTS, write_collection
+from upload import Uploader
+from watch import Watch, load_modules, renamed, reformat, expected_samples
+
+VAULT = '/CCBR_Archive'
+PYRKIT = os.path.join(os.path.dirname(TESTS), 'pyrkit')
+META = os.path.join(os.path.dirname(TESTS), 'src', 'meta')
+ANALYSIS = {'assembly_name': 'mm10', 'gtf_ver': 'M21', 'md5_all_inputs_serial': 'f63-93-b750',
+            'md5_all_inputs': 'f63ab9966e22f548934c31172388b750'}
+
+# Outputs of a sample, as the pipeline names them
+OUTPUTS = ['{}.R1.fastq.gz', '{}.R2.fastq.gz', 'bams/{}.star_rg_added.sorted.dmark.bam',
+           'bams/{}.p2.Aligned.toTranscriptome.out.bam', 'fusions/{}.p2.arriba.Aligned.sortedByCoord.out.bam',
+           'fusions/{}_fusions.tsv', 'fusions/{}_fusions.arriba.pdf']
+COMBINED = ['DEG_ALL/RSEM.{}.{}.all_samples.txt'.format(kind, unit) for kind in ('genes', 'isoforms')
+            for unit in ('expected_count', 'FPKM', 'TPM')] + ['Reports/multiqc_report.html', 'Reports/RNA_Report.html']
+COUNTS = 'gene_id\tGeneName\tWT1_expected_count\tWT2_expected_count\nENSG01\tA1BG\t1.00\t2.00\n'
+
+
+def modules():
+    return load_modules(os.path.join(os.path.dirname(TESTS), 'dev', 'config', 'rnaseq.yaml'))
+
+
+def write(directory, name, contents='data\n'):
+    filename = os.path.join(directory, name)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as fh:
+        fh.write(contents)
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    """Working directory of a pipeline, and its DME base directory with the
+    collections pyrkit creates before watching it.
+    @return pipeline, dme_directory <tuple>:
+    """
+    dme_directory = str(tmp_path / 'DME')
+    project = os.path.join(dme_directory, 'upload', 'PI_Lab_A', 'Project_B')
+    write_collection(os.path.join(dme_directory, 'upload', 'PI_Lab_A'), 'PI_Lab')
+    write_collection(project, 'Project')
+    write_collection(os.path.join(project, 'Primary_Analysis_2RNA-seq_mm10_M21_f63-93-b750'), 'Analysis')
+    write_collection(os.path.join(project, 'Sample_S_1_WT1'), 'Sample')
+    with open(os.path.join(project, 'Sample_S_1_WT1.metadata.json'), 'w') as fh:
+        json.dump({'metadataEntries': [{'attribute': 'collection_type', 'value': 'Sample'},
+                                       {'attribute': 'sample_name', 'value': 'WT1'}]}, fh)
+    # Without a sample_name, the sample is the end of the name of the collection
+    write_collection(os.path.join(project, 'Sample_2_WT2'), 'Sample')
+    with open(os.path.join(dme_directory, 'run_metadata.txt'), 'w') as fh:
+        fh.write(''.join('{}\t{}\n'.format(k, v) for k, v in sorted(ANALYSIS.items())))
+    return str(tmp_path / 'pipeline'), dme_directory
+
+
+def test_expected_samples(pipeline):
+    assert expected_samples(os.path.join(pipeline[1], 'upload')) == set(['WT1', 'WT2'])
+
+
+def test_a_late_sample_is_waited_for(pipeline, dme_server):
+    directory, dme_directory = pipeline
+    for name in OUTPUTS:
+        write(directory, name.format('WT1'))
+    for name in OUTPUTS[:2]:
+        write(directory, name.format('WT2'))
+    for name in COMBINED:
+        write(directory, name, COUNTS if name.startswith('DEG_ALL') else '<html></html>\n')
+
+    uploader = Uploader(dme.DMESession(dme_server, 'test'))
+    watch = Watch(directory, dme_directory, VAULT, modules(), META, uploader=uploader, stable=0)
+    # Every multi-sample file is complete, but WT2 has only its FastQ files yet
+    assert not watch.step()
+    assert watch.waiting() == ['WT2']
+    assert uploader.stats['failed'] == 0
+    assert not watch.step()
+
+    for name in OUTPUTS[2:]:
+        write(directory, name.format('WT2'))
+    assert watch.step()
+    assert watch.waiting() == [] and not watch.failed
+    session = dme.DMESession(dme_server, 'test')
+    bam = VAULT + '/PI_Lab_A/Project_B/Sample_2_WT2/WT2.mm10_M21.Aligned.toGenome.sorted.dmark.f63-93-b750.bam'
+    assert session.get_dataObject_attributes(bam)['sample_name'] == 'WT2'
+
+
+def test_a_missing_sample_is_waited_for(pipeline):
+    directory, dme_directory = pipeline
+    for name in OUTPUTS:
+        write(directory, name.format('WT1'))
+    for name in COMBINED:
+        write(directory, name, COUNTS if name.startswith('DEG_ALL') else '<html></html>\n')
+    watch = Watch(directory, dme_directory, VAULT, modules(), META, stable=0)
+    assert not watch.step()
+    assert watch.waiting() == ['WT2']
+
+
+def pyrkit_functions(*names):
+    """Returns the definitions of functions of pyrkit, to run them in bash."""
+    with open(PYRKIT, 'r') as fh:
+        content = fh.read()
+    return '\n'.join(re.search(r'^function {}\(\)\s*\{{.*?^\}}$'.format(re.escape(name)), content,
+                               re.S | re.M).group(0) for name in names)
+
+
+def test_names_match_pyrkit_links(pipeline, tmp_path):
+    directory, dme_directory = pipeline
+    for sample in ('WT1', 'WT2'):
+        for name in OUTPUTS:
+            write(directory, name.format(sample))
+    # The names are all that is compared, the metadata is not generated
+    noop = str(tmp_path / 'meta')
+    write(str(tmp_path), 'meta', '')
+    project = os.path.join(dme_directory, 'upload', 'PI_Lab_A', 'Project_B')
+    functions = pyrkit_functions('_sym_link_fastqs', '_sym_link_gbam', '_sym_link_tbam', '_sym_link_cbam',
+                                 '_sym_link_arriba_fusions', '_sym_link_arriba_pdfs', 'links')
+    subprocess.check_call(['bash', '-c', functions + '\nlinks "$@"', 'pyrkit', directory, dme_directory, VAULT,
+                           noop, ANALYSIS['assembly_name'], ANALYSIS['gtf_ver'], ANALYSIS['md5_all_inputs_serial'],
+                           ANALYSIS['md5_all_inputs'], VAULT + '/PI_Lab_A/Project_B/Primary_Analysis'])
+    linked = set()
+    for collection in ('Sample_S_1_WT1', 'Sample_2_WT2'):
+        linked.update(os.path.join(collection, name) for name in os.listdir(os.path.join(project, collection)))
+
+    watch = Watch(directory, dme_directory, VAULT, modules(), META)
+    collections = {'WT1': 'Sample_S_1_WT1', 'WT2': 'Sample_2_WT2'}
+    names = set(os.path.join(collections[sample], renamed(module, os.path.basename(path), sample, watch.analysis))
+                for module, path, sample in watch.discover() if sample is not None)
+    assert len(linked) == 2 * len(OUTPUTS)
+    assert names == linked
+
+
+def test_reformat_matches_pyrkit_fix(tmp_path):
+    source = str(tmp_path / 'RSEM.genes.expected_count.all_samples.txt')
+    with open(source, 'w') as fh:
+        fh.write(COUNTS + 'ENSG02\tA2M\t3.00\t4.00\n')
+    fixed = str(tmp_path / 'RSEM_genes_expected_counts.tsv')
+    shutil.copy(source, fixed)
+    subprocess.check_call(['bash', '-c', pyrkit_functions('fix') + '\nfix "$@"', 'pyrkit', fixed])
+
+    reformatted = str(tmp_path / 'reformatted.tsv')
+    reformat(source, reformatted)
+    with open(fixed) as expected, open(reformatted) as observed:
+        assert observed.read() == expected.read()
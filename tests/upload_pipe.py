@@ -5,11 +5,17 @@ from __future__ import print_function, division
 import pandas as pd
 import sys, os, re, json
 
+# Local imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+import dme_utils as dme
+from upload import Uploader, summarize
+
 # Configuration for defining valid sheets and other default values
 config = {
     ".warning": ["\033[93m", "\033[00m"],
     ".error": ["\033[91m", "\033[00m"],
     ".vaults": ["CCBR_Archive", "CCBR_EXT_Archive"],
+    ".threads": 4,
 }
 
 
@@ -159,10 +165,16 @@ def validate(user_inputs):
     return meta_sheet, input_path, output_path, vault, multiQC_path, dryrun, update, full_pipe
 
 
-def _replace(s):
-    """Replace issue characters of the input string to be handled by bash."""
-    s = s.replace('(','\(').replace(')','\)')
-    return s
+def json2dict(file):
+    """Reads in JSON file into a python dictionary."""
+    with open(file) as fh:
+        return json.load(fh)
+
+
+def _entry(kind, local, path, metadata):
+    """Returns a collection or data object to register, see upload.manifest()."""
+    return {'type': kind, 'local': local, 'path': path, 'metadata': metadata,
+            'size': os.path.getsize(local) if kind == 'dataObject' and os.path.exists(local) else 0}
 
 
 def _get_sample_id(sample_metadata):
@@ -201,44 +213,34 @@ def main():
         else:
             exit_code(os.system(f"python src/initialize.py {output_path} {output_path}/meta {vault} --convert"))
 
-    # With the data/metadata created, register PI_Lab collection
+    # With the data/metadata created, register the PI_Lab, Project and Sample
+    # collections and the sample data. Each collection or data object starts as
+    # soon as its parent collection is confirmed, so sibling Samples and their
+    # data are registered in parallel instead of one after another.
     pi_dir = [f for f in os.listdir(f"{output_path}/meta") if ".metadata.json" not in f][0]
-    pi_meta_fadd = f"{output_path}/meta/{pi_dir}.metadata.json"
-    pi_meta_file = open(pi_meta_fadd)
-    pi_meta = json.load(pi_meta_file)
-    pi_command = _replace(f"dm_register_collection {pi_meta_fadd} /{vault}/{pi_dir}")
-    print('- Uploading PI_Lab metadata')
-    exit_code(os.system(pi_command))
-
-    # With the data/metadata created, register Project collection
     project_dir = [f for f in os.listdir(f"{output_path}/meta/{pi_dir}") if ".metadata.json" not in f][0]
-    project_meta_fadd = f"{output_path}/meta/{pi_dir}/{project_dir}.metadata.json"
-    project_meta_file = open(project_meta_fadd)
-    project_meta = json.load(project_meta_file)
-    project_command = _replace(f"dm_register_collection {project_meta_fadd} /{vault}/{pi_dir}/{project_dir}")
-    print('- Uploading Project metadata')
-    exit_code(os.system(project_command))
-
-    # With the data/metadata created, register Sample collections
     samples_dir = [f for f in os.listdir(f"{output_path}/meta/{pi_dir}/{project_dir}") if ".metadata.json" not in f]
-    samples_meta_fadd = [f"{output_path}/meta/{pi_dir}/{project_dir}/{sd}.metadata.json" for sd in samples_dir]
-    samples_meta_file = [open(sa) for sa in samples_meta_fadd]
-    samples_meta = [json.load(f) for f in samples_meta_file]
-    print(f"- Uploading Sample metadata{' (but not files - update mode)' if update else ''}")
-    for i in range(len(samples_dir)):
-        print(f"  > Sample {i+1}/{len(samples_dir)}")
-        sample_command = _replace(f"dm_register_collection {samples_meta_fadd[i]} /{vault}/{pi_dir}/{project_dir}/{samples_dir[i]}")
-        exit_code(os.system(sample_command))
-
+    project_path = f"/{vault}/{pi_dir}/{project_dir}"
+    entries = [
+        _entry('collection', '', f"/{vault}/{pi_dir}", f"{output_path}/meta/{pi_dir}.metadata.json"),
+        _entry('collection', '', project_path, f"{output_path}/meta/{pi_dir}/{project_dir}.metadata.json")
+    ]
+    print(f"- Uploading PI_Lab, Project and {len(samples_dir)} Sample collections{' (but not files - update mode)' if update else ''}")
+    for sd in samples_dir:
+        sample_meta_fadd = f"{output_path}/meta/{pi_dir}/{project_dir}/{sd}.metadata.json"
+        entries.append(_entry('collection', '', f"{project_path}/{sd}", sample_meta_fadd))
         if (update):
             continue
-        data_name = _get_sample_id(samples_meta[i]['metadataEntries'])
-        print(f"    - Uploading {data_name} (R1) data")
-        data_command = _replace(f"dm_register_dataobject {samples_meta_fadd[i]} /{vault}/{pi_dir}/{project_dir}/{samples_dir[i]}/{data_name}.R1.fastq.gz {input_path}/{data_name}.R1.fastq.gz")
-        exit_code(os.system(data_command))
-        print(f"    - Uploading {data_name} (R2) data")
-        data_command = _replace(f"dm_register_dataobject {samples_meta_fadd[i]} /{vault}/{pi_dir}/{project_dir}/{samples_dir[i]}/{data_name}.R2.fastq.gz {input_path}/{data_name}.R2.fastq.gz")
-        exit_code(os.system(data_command))
+        data_name = _get_sample_id(json2dict(sample_meta_fadd)['metadataEntries'])
+        for read in ['R1', 'R2']:
+            data_file = f"{input_path}/{data_name}.{read}.fastq.gz"
+            entries.append(_entry('dataObject', data_file, f"{project_path}/{sd}/{data_name}.{read}.fastq.gz", sample_meta_fadd))
+
+    uploader = Uploader(dme.DMESession(), threads=config['.threads'])
+    stats = uploader.run(entries)
+    print(summarize(stats))
+    if uploader.failed:
+        exit_code(1)
 
 
 if __name__ == '__main__':